@@ -0,0 +1,136 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: run the analyses (finalAnalysis, numpy/scipy) off the analyzer server's gevent loop
+
+AnalysisPool (in the analyzer server, gevent side):
+    - queues (userID, historyCount, testID) jobs, at most maxQueue of them, and ignores the jobs
+      already queued or running
+    - runs them in `workers` long lived worker processes (this file with --worker, see
+      worker_process.py), a batch of up to batchSize jobs at a time each. A worker that takes more
+      than `timeout` seconds per job of its batch is killed and restarted, and the jobs of the batch
+      count as failed (and can be submitted again)
+    - exports the queued jobs, the time they wait and run, and the rejected and failed ones to
+      Prometheus
+
+The gevent loop only waits on the workers' pipes, so GET requests are served during the analyses.
+This is not a concurrent.futures.ProcessPoolExecutor: a job it runs cannot be cancelled or timed out
+(a hung analysis would hold its worker, and its job, forever), its futures complete in a thread the
+gevent loop cannot wait on without a thread per job, and it sends the jobs one by one.
+
+Usage (the analyzer server starts the workers):
+    python analysis_pool.py --worker
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, time, logging
+import gevent, gevent.queue
+from prometheus_client import Summary, Counter, Gauge
+from python_lib import *
+from worker_process import WorkerProcess, serve
+
+ANALYSIS_QUEUED = Gauge('analysis_queued_jobs', 'Number of tests waiting for or in analysis')
+ANALYSIS_WAIT = Summary('analysis_wait_seconds', 'Time tests waited for an analysis worker')
+ANALYSIS_DURATION = Summary('analysis_duration_seconds', 'Time analysis batches took in a worker')
+ANALYSIS_REJECTED = Counter('analysis_rejected_jobs', 'Number of tests not queued', ['reason'])
+ANALYSIS_FAILURES = Counter('analysis_failed_jobs', 'Number of tests the analysis failed for')
+
+logger = logging.getLogger('replay_analyzer')
+
+
+def worker():
+    import finalAnalysis as FA
+
+    def analyze(batch):
+        resultObjs = FA.finalAnalyzerBatch([tuple(job) for job in batch['jobs']], batch['path'], batch['alpha'])
+        return {'ok': True, 'done': [resultObj is not None for resultObj in resultObjs]}
+
+    serve(analyze)
+
+
+class AnalysisPool(object):
+    '''
+    self.pending[(userID, historyCount, testID)] = time queued, for every job queued or running
+    '''
+
+    def __init__(self, path, alpha, workers=4, maxQueue=5000, batchSize=50, errorlog_q=None, timeout=300):
+        self.path = path
+        self.alpha = alpha
+        self.workers = workers
+        self.maxQueue = maxQueue
+        self.batchSize = batchSize
+        self.errorlog_q = errorlog_q
+        self.timeout = timeout
+        self.command = [sys.executable, os.path.abspath(__file__), '--worker']
+        self.queue = gevent.queue.Queue()
+        self.pending = {}
+
+    def run(self):
+        for i in range(self.workers):
+            gevent.Greenlet.spawn(self.worker_loop)
+
+    def submit(self, job):
+        '''
+        Queues job, returns False if it could not be (the queue is full)
+        '''
+        job = (str(job[0]), int(job[1]), int(job[2]))
+        if job in self.pending:
+            ANALYSIS_REJECTED.labels('duplicate').inc()
+            return True
+        if len(self.pending) >= self.maxQueue:
+            ANALYSIS_REJECTED.labels('full').inc()
+            return False
+        self.pending[job] = time.time()
+        self.queue.put(job)
+        ANALYSIS_QUEUED.set(len(self.pending))
+        return True
+
+    def worker_loop(self):
+        worker = WorkerProcess(self.command, 'Analysis')
+        while True:
+            # Started before the jobs come, importing numpy/scipy takes seconds
+            if not worker.running():
+                worker.start()
+            jobs = [self.queue.get()]
+            while len(jobs) < self.batchSize and not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+
+            start = time.time()
+            for job in jobs:
+                ANALYSIS_WAIT.observe(start - self.pending[job])
+            result = worker.request({'jobs': jobs, 'path': self.path, 'alpha': self.alpha},
+                                    self.timeout * len(jobs))
+            self.finish(jobs, result, time.time() - start)
+
+    def finish(self, jobs, result, duration):
+        ANALYSIS_DURATION.observe(duration)
+        done = result.get('done', [False] * len(jobs))
+        for (job, ok) in zip(jobs, done):
+            del self.pending[job]
+            if not ok:
+                ANALYSIS_FAILURES.inc()
+        if not result['ok'] and self.errorlog_q is not None:
+            self.errorlog_q.put(('analysis failed', jobs, result.get('error')))
+        LOG_ACTION(logger, 'Analyzed {} tests in {:.3f} seconds'.format(len(jobs), duration), indent=1, action=False)
+        ANALYSIS_QUEUED.set(len(self.pending))
+
+
+if __name__ == "__main__":
+    if '--worker' in sys.argv:
+        worker()
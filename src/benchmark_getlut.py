@@ -0,0 +1,131 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: measure getClosestCSP lookups with the GetLUT index against the linear scan
+
+Builds a getLUT the same way replay_parser.py does, from the first GET request of every TCP
+stream in the shipped replayTraces. To emulate many loaded replays, every entry is copied
+--copies times with a different path, host and cookie.
+Then looks up every original request:
+    - with an injected header (e.g. a perma-cookie), the GET line still matches
+    - with a rewritten GET line, so all the headers have to be compared
+
+Usage:
+    python benchmark_getlut.py [--replay_parent_folder=../replayTraces] [--copies=1,100,1000]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, re, time
+from python_lib import *
+from replay_trace import load_client_json, load_client_trace
+from replay_server import GetLUT, getClosestCSP
+
+
+def read_requests(parent_folder):
+    '''
+    Returns [(replayName, csp, headersDict)] for the first GET request of every TCP stream
+    '''
+    requests = []
+    for folder in sorted(os.listdir(parent_folder)):
+        folder = os.path.join(parent_folder, folder)
+        if not os.path.isdir(folder):
+            continue
+        for file in sorted(os.listdir(folder)):
+            if file.endswith('_client_all.wtrace'):
+                Q, udpClientPorts, tcpCSPs, replayName = load_client_trace(os.path.join(folder, file))
+            elif file.endswith('_client_all.json'):
+                Q, udpClientPorts, tcpCSPs, replayName = load_client_json(os.path.join(folder, file))
+            else:
+                continue
+
+            seen = set()
+            for p in Q:
+                if p.c_s_pair not in tcpCSPs or p.c_s_pair in seen:
+                    continue
+                seen.add(p.c_s_pair)
+                payload = p.payload if not isinstance(p.payload, str) else bytes.fromhex(p.payload)
+                toHash = bytes(payload).decode('ascii', 'ignore')[:400]
+                if toHash[0:3] == 'GET':
+                    theDict = dict(re.findall(r"(?P<name>.*?): (?P<value>.*?)\r\n", toHash.partition('\n')[2]))
+                    theDict['GET'] = toHash.partition('\r\n')[0]
+                    requests.append((replayName, p.c_s_pair, theDict))
+            break
+    return requests
+
+
+def build_getLUT(requests, copies):
+    getLUT = {}
+    for c in range(copies):
+        for (replayName, csp, headersDict) in requests:
+            theDict = dict(headersDict)
+            if c > 0:
+                theDict['GET'] = 'GET /copy{}{}'.format(c, theDict['GET'][3:])
+                theDict['Host'] = 'copy{}.{}'.format(c, theDict.get('Host', ''))
+                theDict['Cookie'] = 'copy={}'.format(c)
+            getLUT[('{}_copy{}'.format(replayName, c), csp)] = theDict
+    return getLUT
+
+
+def make_queries(requests):
+    queries = []
+    for (replayName, csp, headersDict) in requests:
+        injected = dict(headersDict)
+        injected['X-UIDH'] = 'injected'
+        queries.append(('injected', injected))
+
+        rewritten = dict(headersDict)
+        rewritten['GET'] = 'GET /rewritten{}'.format(rewritten['GET'][3:])
+        queries.append(('rewritten', rewritten))
+    return queries
+
+
+def time_lookups(getLUT, queries, repeat):
+    results = []
+    start = time.time()
+    for i in range(repeat):
+        results = [getClosestCSP(getLUT, headersDict) for (kind, headersDict) in queries]
+    return (time.time() - start) / (repeat * len(queries)), results
+
+
+def main():
+    configs = Configs()
+    configs.set('replay_parent_folder', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'replayTraces')))
+    configs.set('copies', '1,100,1000')
+    configs.set('repeat', 5)
+    configs.read_args(sys.argv)
+
+    requests = read_requests(configs.get('replay_parent_folder'))
+    queries = make_queries(requests)
+    print('{} GET requests, {} lookups per round'.format(len(requests), len(queries)))
+
+    print('entries\tlinear us/lookup\tindexed us/lookup\tbuild ms\tsame results')
+    for copies in map(int, str(configs.get('copies')).split(',')):
+        plain = build_getLUT(requests, copies)
+        start = time.time()
+        indexed = GetLUT(plain)
+        build = time.time() - start
+
+        linear, expected = time_lookups(plain, queries, configs.get('repeat'))
+        fast, results = time_lookups(indexed, queries, configs.get('repeat'))
+        print('{}\t{:>16.1f}\t{:>17.1f}\t{:>8.1f}\t{}'.format(len(plain), 1e6 * linear, 1e6 * fast, 1000 * build,
+                                                               results == expected))
+
+
+if __name__ == "__main__":
+    main()
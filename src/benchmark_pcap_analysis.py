@@ -0,0 +1,105 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: measure the throughput analysis of pcap_analysis.py against the tshark commands it replaces
+
+For every shipped replay, writes the capture a server would take of it (see benchmark_pcap_clean.py),
+then computes the throughput buckets with pcap_analysis.xput_stats and with
+    tshark -r <pcap> -qz io,stat,<duration / buckets>,not tcp.analysis.retransmission
+(as testHypothesis.xputTshark did), and compares the bytes of every interval. tshark is skipped
+when it is not installed.
+
+Usage:
+    python benchmark_pcap_analysis.py [--replay_parent_folder=../replayTraces] [--replays=Amazon_11252020,...]
+                                      [--buckets=100] [--workFolder=/tmp/benchmark_pcap_analysis/]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, re, time, shutil, subprocess
+from python_lib import *
+from benchmark_pcap_clean import load_trace, write_capture
+from pcap_analysis import read_frames, bucket_bytes
+
+
+def numpy_buckets(pcap, buckets):
+    frames = read_frames(pcap)
+    starts, ends, counts = bucket_bytes(frames, frames.duration() / buckets, ~frames.retransmissions())
+    return [int(count) for count in counts]
+
+
+def tshark_buckets(pcap, buckets):
+    times = subprocess.check_output(['tshark', '-r', pcap, '-T', 'fields', '-e', 'frame.time_relative'])
+    interval = float(times.splitlines()[-1]) / buckets
+    output = subprocess.check_output(['tshark', '-r', pcap, '-qz',
+                                      'io,stat,{},not tcp.analysis.retransmission'.format(interval)])
+    return [int(match.group(1)) for match in
+            re.finditer(r'<>\s*(?:[\d.]+|Dur)\s*\|\s*\d+\s*\|\s*(\d+)', output.decode('ascii', 'ignore'))]
+
+
+def main():
+    configs = Configs()
+    configs.set('replay_parent_folder', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'replayTraces')))
+    configs.set('replays', '')
+    configs.set('buckets', 100)
+    configs.set('workFolder', '/tmp/benchmark_pcap_analysis/')
+    configs.read_args(sys.argv)
+
+    workFolder = configs.get('workFolder')
+    if not os.path.isdir(workFolder):
+        os.makedirs(workFolder)
+    parent = configs.get('replay_parent_folder')
+    replays = configs.get('replays').split(',') if configs.get('replays') else sorted(os.listdir(parent))
+    compare = shutil.which('tshark') is not None
+    if not compare:
+        print('tshark not installed, only timing pcap_analysis')
+
+    print('replay\tMB\tnumpy s\ttshark s\tspeedup\tbytes numpy/tshark\tsame intervals')
+    total = [0.0, 0.0]
+    for replay in replays:
+        folder = os.path.join(parent, replay)
+        trace = load_trace(folder) if os.path.isdir(folder) else None
+        if trace is None:
+            continue
+        pcap = os.path.join(workFolder, replay + '.pcap')
+        write_capture(pcap, trace[0], 0)
+        size = os.path.getsize(pcap) / 1e6
+
+        start = time.time()
+        mine = numpy_buckets(pcap, configs.get('buckets'))
+        numpyTime = time.time() - start
+        total[0] += numpyTime
+
+        tsharkTime, speedup, volume, same = '-', '-', '{}/-'.format(sum(mine)), '-'
+        if compare:
+            start = time.time()
+            theirs = tshark_buckets(pcap, configs.get('buckets'))
+            elapsed = time.time() - start
+            total[1] += elapsed
+            tsharkTime, speedup = '{:.3f}'.format(elapsed), '{:.1f}x'.format(elapsed / max(numpyTime, 1e-6))
+            volume = '{}/{}'.format(sum(mine), sum(theirs))
+            same = '{}/{}'.format(sum(1 for a, b in zip(mine, theirs) if a == b), max(len(mine), len(theirs)))
+
+        print('{}\t{:.1f}\t{:.3f}\t{}\t{}\t{}\t{}'.format(replay, size, numpyTime, tsharkTime, speedup, volume, same))
+        os.remove(pcap)
+
+    print('total\t\t{:.3f}\t{}'.format(total[0], '{:.3f}'.format(total[1]) if compare else '-'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: measure pcap cleaning in one pass (pcap_tools.rewrite_pcap) against tcpdump/editcap/tcprewrite
+
+For every shipped replay, writes the Ethernet capture a server would take of it: the client
+packets (split in 1448 bytes segments), the server responses (response_len bytes for TCP), an
+ACK for every segment, and --noise packets on port 22 for every replay packet.
+Then cleans it with both and compares the outputs record by record (the external tools are
+skipped when not installed).
+
+Usage:
+    python benchmark_pcap_clean.py [--replay_parent_folder=../replayTraces] [--replays=Amazon_11252020,...]
+                                   [--noise=1] [--workFolder=/tmp/benchmark_pcap_clean/]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, time, struct, shutil
+from python_lib import *
+from replay_trace import load_client_json, load_client_trace
+from pcap_tools import PcapReader, checksum_add, checksum_fold, rewrite_pcap, rewrite_pcap_external
+
+CLIENT_IP = '155.33.17.68'
+SERVER_IP = '52.95.120.35'
+MSS = 1448
+
+
+def load_trace(folder):
+    for file in sorted(os.listdir(folder)):
+        if file.endswith('_client_all.wtrace'):
+            return load_client_trace(os.path.join(folder, file))
+    for file in sorted(os.listdir(folder)):
+        if file.endswith('_client_all.json'):
+            return load_client_json(os.path.join(folder, file))
+    return None
+
+
+class CaptureWriter(object):
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 262144, 1))
+        self.seq = {}
+        self.ipID = 0
+
+    def packet(self, timestamp, src, dst, sport, dport, protocol, payload=b'', flags=0x18):
+        if protocol == socket.IPPROTO_TCP:
+            seq = self.seq.get((src, sport), 1000)
+            self.seq[(src, sport)] = seq + len(payload)
+            ack = self.seq.get((dst, dport), 1000)
+            l4 = struct.pack('!HHIIBBHHH', sport, dport, seq, ack, 5 << 4, flags, 65535, 0, 0) + payload
+            checksumAt = 16
+        else:
+            l4 = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0) + payload
+            checksumAt = 6
+        srcIP, dstIP = socket.inet_aton(src), socket.inet_aton(dst)
+        l4 = bytearray(l4)
+        l4[checksumAt:checksumAt + 2] = struct.pack('!H', checksum_fold(
+            checksum_add(l4, checksum_add(srcIP + dstIP + struct.pack('!HH', protocol, len(l4))))))
+
+        self.ipID = (self.ipID + 1) & 0xffff
+        ip = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), self.ipID, 0x4000, 64, protocol, 0,
+                                   srcIP, dstIP))
+        ip[10:12] = struct.pack('!H', checksum_fold(checksum_add(ip)))
+        frame = b'\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02\x08\x00' + bytes(ip) + bytes(l4)
+        self.f.write(struct.pack('<IIII', int(timestamp), int((timestamp % 1) * 1e6), len(frame), len(frame)))
+        self.f.write(frame)
+
+    def segments(self, timestamp, src, dst, sport, dport, payload, noise):
+        for start in range(0, max(len(payload), 1), MSS):
+            self.packet(timestamp, src, dst, sport, dport, socket.IPPROTO_TCP, payload[start:start + MSS])
+            self.packet(timestamp, dst, src, dport, sport, socket.IPPROTO_TCP, flags=0x10)
+            for i in range(noise):
+                self.packet(timestamp, src, dst, 40000 + i, 22, socket.IPPROTO_TCP, payload[start:start + 100])
+
+    def close(self):
+        self.f.close()
+
+
+def write_capture(path, Q, noise):
+    '''
+    Returns the server ports of the replay
+    '''
+    capture = CaptureWriter(path)
+    ports = set()
+    start = time.time()
+    for p in Q:
+        clientPort = int(p.c_s_pair.partition('-')[0].rpartition('.')[2])
+        serverPort = int(p.c_s_pair.rpartition('.')[2])
+        ports.add(serverPort)
+        payload = bytes(p.payload) if not isinstance(p.payload, str) else bytes.fromhex(p.payload)
+        if isinstance(p, UDPset):
+            capture.packet(start + p.timestamp, CLIENT_IP, SERVER_IP, clientPort, serverPort, socket.IPPROTO_UDP,
+                           payload)
+            capture.packet(start + p.timestamp, SERVER_IP, CLIENT_IP, serverPort, clientPort, socket.IPPROTO_UDP,
+                           payload)
+        else:
+            capture.segments(start + p.timestamp, CLIENT_IP, SERVER_IP, clientPort, serverPort, payload, noise)
+            capture.segments(start + p.timestamp, SERVER_IP, CLIENT_IP, serverPort, clientPort,
+                             b'\x00' * p.response_len, noise)
+    capture.close()
+    return sorted(ports)
+
+
+def read_records(path):
+    with open(path, 'rb') as f:
+        reader = PcapReader(f)
+        return [(reader.record.unpack(header)[2:], bytes(data)) for header, data in reader]
+
+
+def external_tools():
+    return all(shutil.which(tool) for tool in ['tcpdump', 'editcap', 'tcprewrite'])
+
+
+def main():
+    configs = Configs()
+    configs.set('replay_parent_folder', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'replayTraces')))
+    configs.set('replays', '')
+    configs.set('noise', 1)
+    configs.set('workFolder', '/tmp/benchmark_pcap_clean/')
+    configs.read_args(sys.argv)
+
+    workFolder = configs.get('workFolder')
+    if not os.path.isdir(workFolder):
+        os.makedirs(workFolder)
+    parent = configs.get('replay_parent_folder')
+    replays = configs.get('replays').split(',') if configs.get('replays') else sorted(os.listdir(parent))
+    compare = external_tools()
+    if not compare:
+        print('tcpdump/editcap/tcprewrite not installed, only timing the one pass cleaning')
+
+    anonymizedIP = get_anonymizedIP(CLIENT_IP)
+    print('replay\tMB\tpackets in/out\tone pass s\texternal s\tsame records')
+    total = [0.0, 0.0]
+    for replay in replays:
+        folder = os.path.join(parent, replay)
+        trace = load_trace(folder) if os.path.isdir(folder) else None
+        if trace is None:
+            continue
+        in_pcap = os.path.join(workFolder, replay + '.pcap')
+        ports = write_capture(in_pcap, trace[0], configs.get('noise'))
+        size = os.path.getsize(in_pcap) / 1e6
+
+        out_pcap = os.path.join(workFolder, replay + '_out.pcap')
+        start = time.time()
+        read, written = rewrite_pcap(in_pcap, out_pcap, ports, CLIENT_IP, anonymizedIP)
+        onePass = time.time() - start
+        total[0] += onePass
+
+        external, same = '-', '-'
+        if compare:
+            ext_pcap = os.path.join(workFolder, replay + '_ext.pcap')
+            start = time.time()
+            rewrite_pcap_external(in_pcap, ext_pcap, ports, CLIENT_IP, anonymizedIP)
+            external = time.time() - start
+            total[1] += external
+            mine, theirs = read_records(out_pcap), read_records(ext_pcap)
+            same = '{}/{}'.format(sum(1 for a, b in zip(mine, theirs) if a == b), max(len(mine), len(theirs)))
+            os.remove(ext_pcap)
+            external = '{:.3f}'.format(external)
+
+        print('{}\t{:.1f}\t{}/{}\t{:.3f}\t{}\t{}'.format(replay, size, read, written, onePass, external, same))
+        os.remove(in_pcap)
+        os.remove(out_pcap)
+
+    print('total\t\t\t{:.3f}\t{}'.format(total[0], '{:.3f}'.format(total[1]) if compare else '-'))
+
+
+if __name__ == "__main__":
+    main()
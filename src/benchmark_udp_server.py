@@ -0,0 +1,144 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: measure UDP send throughput and pacing of the replay server
+
+Runs N concurrent UDP flows through a UDPServer on localhost (the scheduler and the
+outbound queue used by replay_server.py) and through the previous implementation
+(one greenlet per flow, sleeping before every datagram and sending under a global lock).
+
+Usage:
+    python benchmark_udp_server.py [--clients=1,10,100] [--packets=2000] [--size=1000] [--interval=0.001]
+                                   [--rounds=5]
+
+    For every number of clients, prints datagrams/second with timing off, and the mean/max
+    pacing error with timing on (one datagram every interval seconds per client).
+    Both implementations run in turn for every round, and the median over the rounds is printed,
+    so a single scheduling hiccup of the machine does not decide the comparison.
+#######################################################################################################
+#######################################################################################################
+'''
+
+import gevent.monkey
+
+gevent.monkey.patch_all()
+import sys, time, socket, statistics
+import gevent, gevent.queue
+from gevent.lock import RLock
+from python_lib import *
+from replay_server import UDPServer, UDPFlow
+
+
+def make_Q(packets, size, interval):
+    payload = b'x' * size
+    return [UDPset(payload, i * interval, 'benchmark') for i in range(packets)]
+
+
+def make_receivers(clients):
+    receivers = []
+    for i in range(clients):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        receivers.append(sock)
+    return receivers
+
+
+def run_scheduler(server, receivers, Q, timing):
+    flows = []
+    time_origin = time.time()
+    for sock in receivers:
+        flow = UDPFlow(Q, time_origin, sock.getsockname(), timing, 3600)
+        server.scheduler.add(flow)
+        flows.append(flow)
+    for flow in flows:
+        flow.done.wait()
+    duration = time.time() - time_origin
+    sent = sum(flow.sent for flow in flows)
+    errorMean = sum(flow.errorSum for flow in flows) / sent
+    errorMax = max(flow.errorMax for flow in flows)
+    return sent, duration, errorMean, errorMax
+
+
+def run_legacy(sock, receivers, Q, timing):
+    lock = RLock()
+    errors = []
+
+    def send_Q(address, time_origin):
+        errorSum = 0.0
+        errorMax = 0.0
+        for udp_set in Q:
+            if timing:
+                gevent.sleep((time_origin + udp_set.timestamp) - time.time())
+            with lock:
+                sock.sendto(udp_set.payload, address)
+            error = time.time() - (time_origin + udp_set.timestamp if timing else time_origin)
+            errorSum += abs(error)
+            errorMax = max(errorMax, error)
+        errors.append((errorSum, errorMax))
+
+    time_origin = time.time()
+    greenlets = [gevent.spawn(send_Q, r.getsockname(), time_origin) for r in receivers]
+    gevent.joinall(greenlets)
+    duration = time.time() - time_origin
+    sent = len(Q) * len(receivers)
+    return sent, duration, sum(e[0] for e in errors) / sent, max(e[1] for e in errors)
+
+
+def main():
+    configs = Configs()
+    configs.set('clients', '1,10,100')
+    configs.set('packets', 2000)
+    configs.set('size', 1000)
+    configs.set('interval', 0.001)
+    configs.set('workers', 1)
+    configs.set('rounds', 5)
+    configs.read_args(sys.argv)
+
+    server = UDPServer(('127.0.0.1', 0), {}, gevent.queue.Queue(), gevent.queue.Queue(), gevent.queue.Queue(),
+                       gevent.queue.Queue(), {}, {}, {})
+    server.run()
+    legacySock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    legacySock.bind(('127.0.0.1', 0))
+
+    print('clients\timpl\t\tdgrams/s (timing off)\tpacing error mean/max ms (timing on)')
+    for clients in map(int, str(configs.get('clients')).split(',')):
+        receivers = make_receivers(clients)
+        # keep the paced runs short, they last packets * interval seconds
+        pacedQ = make_Q(min(configs.get('packets'), 500), configs.get('size'), configs.get('interval'))
+        fastQ = make_Q(configs.get('packets'), configs.get('size'), configs.get('interval'))
+
+        impls = [('scheduler', lambda Q, timing: run_scheduler(server, receivers, Q, timing)),
+                 ('legacy   ', lambda Q, timing: run_legacy(legacySock, receivers, Q, timing))]
+        results = {name: [] for name, run in impls}
+        for i in range(configs.get('rounds')):
+            for name, run in impls:
+                sent, duration, _, _ = run(fastQ, False)
+                _, _, errorMean, errorMax = run(pacedQ, True)
+                results[name].append((sent / duration, errorMean, errorMax))
+
+        for name, run in impls:
+            rate, errorMean, errorMax = [statistics.median(column) for column in zip(*results[name])]
+            print('{}\t{}\t{:>12.0f}\t\t{:.3f} / {:.3f}'.format(clients, name, rate, 1000 * errorMean,
+                                                                 1000 * errorMax))
+
+        for sock in receivers:
+            sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: one packet capture for all the replays of a server, instead of one tcpdump per replay
+
+The capture process (this file, started by CaptureEngine) runs a single
+    tcpdump -i <interface> -s <snaplen> -U -w -
+and splits its output by client IP address and replay ports into one pcap file per replay, as
+`tcpdump -w <file> host <ip> and (port <p1> or port <p2> ...)` would have written it. By default
+(snaplen 0) whole packets are kept, like the per replay tcpdump does. With snaplen 128 only the bytes
+clean_pcap keeps are copied out of the kernel, but the raw dumps that are kept as they are
+(ContentModification replays are not cleaned) are then truncated too.
+
+The replay server talks to it over its stdin/stdout, one JSON line per request and per answer
+(see worker_process.py):
+    {"cmd": "start", "path": <pcap file>, "host": <ip or null for all packets>,
+     "ports": <[port, ...] or null for all ports>}                  --> {"ok": true}
+    {"cmd": "stop", "path": <pcap file>}                            --> {"ok": true, "packets": n}
+It exits (and stops tcpdump) when its stdin is closed, e.g. when the replay server dies.
+
+With several replay server workers only worker 0 runs the capture process. It serves the same
+requests to the other workers over a unix socket (CaptureRelay, CaptureClient), so every packet
+is still copied out of the kernel and parsed once.
+
+SharedDump has the interface of python_lib.tcpdump (dump_name, start, stop, status), so
+ClientObj uses either one the same way.
+
+Usage (CaptureEngine starts it):
+    python capture.py [--interface=eth0] [--snaplen=0] [--filter='not port 22']
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, json, time, struct, threading, subprocess, ipaddress
+import gevent, gevent.lock, gevent.server, gevent.socket
+from pcap_tools import PcapReader, network_offset
+from worker_process import WorkerProcess, serve, answers_stream
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+
+class Demux(object):
+    '''
+    self.writers[packed IP] = [(file, ports), ...]: the pcap files the packets from or to that IP go
+                              to, only the TCP/UDP ones from or to one of ports unless ports is None
+    self.everything = files that get all the packets
+    self.files[path] = (file, packed IP or None, packet counter)
+    '''
+
+    def __init__(self, header, endian, linktype):
+        self.header = header
+        self.linktype = linktype
+        self.writers = {}
+        self.everything = []
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def start(self, path, host=None, ports=None):
+        f = open(path, 'wb', buffering=1 << 16)
+        f.write(self.header)
+        ip = ipaddress.ip_address(host).packed if host else None
+        ports = frozenset(int(port) for port in ports) if ports is not None else None
+        with self.lock:
+            self.files[path] = [f, ip, 0]
+            if ip is None:
+                self.everything = self.everything + [f]
+            else:
+                self.writers[ip] = self.writers.get(ip, []) + [(f, ports)]
+
+    def stop(self, path):
+        with self.lock:
+            f, ip, packets = self.files.pop(path)
+            if ip is None:
+                self.everything = [w for w in self.everything if w is not f]
+            else:
+                self.writers[ip] = [w for w in self.writers[ip] if w[0] is not f]
+                if not self.writers[ip]:
+                    del self.writers[ip]
+            f.close()
+        return packets
+
+    def write(self, header, data):
+        offset, version = network_offset(self.linktype, data)
+        candidates = []
+        if offset is not None and version == 4 and len(data) >= offset + 20:
+            candidates = self.writers.get(data[offset + 12:offset + 16], []) + \
+                         self.writers.get(data[offset + 16:offset + 20], [])
+            protocol = data[offset + 9]
+            transport = offset + (data[offset] & 0x0f) * 4
+        elif offset is not None and version == 6 and len(data) >= offset + 40:
+            candidates = self.writers.get(data[offset + 8:offset + 24], []) + \
+                         self.writers.get(data[offset + 24:offset + 40], [])
+            protocol = data[offset + 6]
+            transport = offset + 40
+
+        targets = self.everything
+        if candidates:
+            # (source port, destination port), or None for packets without ports (e.g. ICMP)
+            ports = None
+            if protocol in (IPPROTO_TCP, IPPROTO_UDP) and len(data) >= transport + 4:
+                ports = struct.unpack_from('!HH', data, transport)
+            targets = targets + [f for (f, wanted) in candidates if wanted is None or
+                                 (ports is not None and (ports[0] in wanted or ports[1] in wanted))]
+        if not targets:
+            return
+        with self.lock:
+            for f in targets:
+                if f.closed:
+                    continue
+                f.write(header)
+                f.write(data)
+                self.files[f.name][2] += 1
+
+    def close(self):
+        for path in list(self.files):
+            self.stop(path)
+
+
+def control_loop(demux, tcpdumpProcess, results):
+    def handle(request):
+        if request['cmd'] == 'start':
+            demux.start(request['path'], request.get('host'), request.get('ports'))
+            return {'ok': True}
+        if request['cmd'] == 'stop':
+            return {'ok': True, 'packets': demux.stop(request['path'])}
+        return {'ok': False, 'error': 'Unknown command {}'.format(request['cmd'])}
+
+    serve(handle, results)
+    demux.close()
+    tcpdumpProcess.terminate()
+
+
+def capture(interface=None, snaplen=0, capture_filter=''):
+    command = ['tcpdump', '-U', '-w', '-', '-s', str(snaplen)]
+    if interface:
+        command += ['-i', interface]
+    if capture_filter:
+        command += capture_filter.split()
+    tcpdumpProcess = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    reader = PcapReader(tcpdumpProcess.stdout)
+    demux = Demux(reader.header, reader.endian, reader.linktype)
+    results = answers_stream()
+    # Ready once tcpdump is capturing
+    results.write(json.dumps({'ok': True}) + '\n')
+    results.flush()
+    threading.Thread(target=control_loop, args=(demux, tcpdumpProcess, results), daemon=True).start()
+
+    for header, data in reader:
+        demux.write(header, data)
+
+
+class CaptureEngine(object):
+    '''
+    Runs and talks to the capture process (see the top of this file)
+    '''
+
+    def __init__(self, interface=None, snaplen=0, capture_filter=''):
+        self.interface = interface
+        self.snaplen = snaplen
+        self.capture_filter = capture_filter
+        self.lock = gevent.lock.Semaphore()
+        command = [sys.executable, os.path.abspath(__file__), '--snaplen={}'.format(self.snaplen)]
+        if self.interface:
+            command.append('--interface={}'.format(self.interface))
+        if self.capture_filter:
+            command.append('--filter={}'.format(self.capture_filter))
+        self.worker = WorkerProcess(command, 'Capture', ready=True)
+
+    def start(self):
+        try:
+            self.worker.start()
+        except RuntimeError as e:
+            raise RuntimeError('{} (is tcpdump installed and allowed to capture?)'.format(e))
+
+    def request(self, **request):
+        with self.lock:
+            return self.worker.request(request)
+
+    def stop(self):
+        self.worker.stop()
+
+
+class CaptureRelay(object):
+    '''
+    Serves the requests of the other replay server workers to a CaptureEngine, over a unix socket
+    with the same JSON lines as the capture process
+    '''
+
+    def __init__(self, engine, path):
+        self.engine = engine
+        self.path = path
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        sock = gevent.socket.socket(gevent.socket.AF_UNIX, gevent.socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(128)
+        self.server = gevent.server.StreamServer(sock, self.handle)
+        self.server.start()
+
+    def handle(self, connection, address):
+        f = connection.makefile('rwb')
+        for line in f:
+            try:
+                answer = self.engine.request(**json.loads(line))
+            except (ValueError, TypeError) as e:
+                answer = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+            f.write((json.dumps(answer) + '\n').encode())
+            f.flush()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+
+class CaptureClient(object):
+    '''
+    CaptureEngine of the workers that use the capture of worker 0, through its CaptureRelay.
+    It (re)connects on demand, so it does not matter which worker starts first.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.file = None
+        self.lock = gevent.lock.Semaphore()
+
+    def start(self):
+        pass
+
+    def connect(self):
+        self.sock = gevent.socket.socket(gevent.socket.AF_UNIX, gevent.socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, **request):
+        with self.lock:
+            try:
+                if self.file is None:
+                    self.connect()
+                self.file.write((json.dumps(request) + '\n').encode())
+                self.file.flush()
+                line = self.file.readline()
+            except (OSError, ValueError):
+                line = b''
+            if not line:
+                self.stop()
+                return {'ok': False, 'error': 'The capture relay of worker 0 is not reachable'}
+            return json.loads(line)
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.file = None
+
+
+class SharedDump(object):
+    '''
+    python_lib.tcpdump on top of a CaptureEngine (or CaptureClient). Only the packets on ports
+    are kept, if given.
+    '''
+
+    def __init__(self, engine, dump_name=None, targetFolder='./', ports=None):
+        self.engine = engine
+        self.ports = list(ports) if ports is not None else None
+        self._running = False
+
+        if dump_name is None:
+            self.dump_name = 'dump_' + time.strftime('%Y-%b-%d-%H-%M-%S', time.gmtime()) + '.pcap'
+        else:
+            self.dump_name = 'dump_' + dump_name + '.pcap'
+
+        self.dump_name = targetFolder + self.dump_name
+
+    def start(self, host=None):
+        answer = self.engine.request(cmd='start', path=os.path.abspath(self.dump_name), host=host, ports=self.ports)
+        self._running = answer['ok']
+        return 'shared capture of {} to {}: {}'.format(host, self.dump_name, answer)
+
+    def stop(self):
+        if not self._running:
+            return 'None'
+        self._running = False
+        answer = self.engine.request(cmd='stop', path=os.path.abspath(self.dump_name))
+        return '{} packets captured'.format(answer['packets']) if answer['ok'] else answer['error']
+
+    def status(self):
+        return self._running
+
+
+def main():
+    from python_lib import Configs
+    configs = Configs()
+    configs.set('interface', None)
+    configs.set('snaplen', 0)
+    configs.set('filter', '')
+    configs.read_args(sys.argv)
+    capture(configs.get('interface'), configs.get('snaplen'), configs.get('filter'))
+
+
+if __name__ == "__main__":
+    main()
@@ -24,11 +24,12 @@ import matplotlib
 import copy
 
 matplotlib.use('Agg')
-import sys, glob, pickle, os, time
+import sys, pickle, os, time
 
 sys.path.append('testHypothesis')
 import matplotlib.pyplot as plt
 import testHypothesis as TH
+import result_files as RF
 
 DEBUG = 0
 
@@ -63,49 +64,67 @@ class ResultObj(object):
 
 
 def finalAnalyzer(userID, historyCount, testID, path, alpha, side="Client"):
-    replayInfodir = path + '/' + userID + '/replayInfo/'
-    regexOriginal = '*_' + str(historyCount) + '_' + str(0) + '.json'
-    regexTest = '*_' + str(historyCount) + '_' + str(testID) + '.json'
-    replayInfoOriginal = glob.glob(replayInfodir + regexOriginal)
-    replayInfoTest = glob.glob(replayInfodir + regexTest)
-    if replayInfoOriginal:
-        replayInfo = json.load(open(replayInfoOriginal[0], 'r'))
-    elif replayInfoTest:
-        replayInfo = json.load(open(replayInfoTest[0], 'r'))
-    else:
-        replayInfo = ["", "", "", "", "", ""]
-
-    realID = replayInfo[2]
-    replayName = replayInfo[4]
-    extraString = replayInfo[5]
-    incomingTime = replayInfo[0]
-
-    folder = path + '/' + userID + '/clientXputs/'
-    regexOriginal = '*_' + str(historyCount) + '_' + str(0) + '.json'
-    regexRandom = '*_' + str(historyCount) + '_' + str(testID) + '.json'
-    fileOriginal = glob.glob(folder + regexOriginal)
-    fileRandom = glob.glob(folder + regexRandom)
-    try:
-        (xputO, durO) = json.load(open(fileOriginal[0], 'r'))
-        (xputR, durR) = json.load(open(fileRandom[0], 'r'))
-    except Exception as e:
-        elogger.error('FAIL at loading the client xputs {} {} {}', userID, historyCount, testID)
-        return None
+    return finalAnalyzerBatch([(userID, historyCount, testID)], path, alpha, side)[0]
 
-    try:
-        resultFile = (path + '/' + userID + '/decisions/' + 'results_{}_{}_{}_{}.json').format(userID, side,
-                                                                                               historyCount, testID)
-        # xputO = [x for x in xputO if x > 0]
-        # xputR = [x for x in xputR if x > 0]
-        # Only use none-zero throughputs for test
-        forPlot, results = testIt(xputO, xputR, resultFile, alpha)
-    except Exception as e:
-        elogger.error('FAIL at testing the result for {} {} {}'.format(userID, historyCount, testID))
-        return None
 
-    resultObj = ResultObj(realID, historyCount, testID, replayName, extraString, incomingTime)
+def finalAnalyzerBatch(jobs, path, alpha, side="Client"):
+    '''
+    finalAnalyzer of every (userID, historyCount, testID) of jobs: the files are found at their
+    exact paths (result_files), the original xputs shared by several tests loaded once, and all
+    the tests run as one batch (TH.doTestsBatch). Returns the ResultObj (or None) of every job.
+    '''
+    manifests = {}
+    loaded = {}
+
+    def load(file):
+        if file not in loaded:
+            with open(file, 'r') as f:
+                loaded[file] = json.load(f)
+        return loaded[file]
+
+    toTest = []
+    results = [None] * len(jobs)
+    for (i, (userID, historyCount, testID)) in enumerate(jobs):
+        # the manifests are only read for files that are not at their fixed path
+        userManifests = manifests.setdefault(userID, {})
+
+        replayInfoFile = RF.find_file(path, userID, 'replayInfo', historyCount, 0, manifests=userManifests) or \
+                         RF.find_file(path, userID, 'replayInfo', historyCount, testID, manifests=userManifests)
+        try:
+            replayInfo = load(replayInfoFile)
+        except Exception:
+            replayInfo = ["", "", "", "", "", ""]
+
+        realID = replayInfo[2]
+        replayName = replayInfo[4]
+        extraString = replayInfo[5]
+        incomingTime = replayInfo[0]
+
+        try:
+            (xputO, durO) = load(RF.find_file(path, userID, 'clientXputs', historyCount, 0, manifests=userManifests))
+            (xputR, durR) = load(RF.find_file(path, userID, 'clientXputs', historyCount, testID,
+                                              manifests=userManifests))
+        except Exception:
+            elogger.error('FAIL at loading the client xputs {} {} {}'.format(userID, historyCount, testID))
+            continue
+
+        resultFile = RF.result_file(path, userID, 'decisions', historyCount, testID, side)
+        toTest.append((i, xputO, xputR, resultFile))
+        results[i] = ResultObj(realID, historyCount, testID, replayName, extraString, incomingTime)
 
-    return resultObj
+    try:
+        testIt([(xputO, xputR, resultFile) for (i, xputO, xputR, resultFile) in toTest], alpha)
+    except Exception:
+        # Find the failing tests one by one
+        for (i, xputO, xputR, resultFile) in toTest:
+            try:
+                testIt([(xputO, xputR, resultFile)], alpha)
+            except Exception:
+                userID, historyCount, testID = jobs[i]
+                elogger.error('FAIL at testing the result for {} {} {}'.format(userID, historyCount, testID))
+                results[i] = None
+
+    return results
 
 
 def plotCDFs(xLists, outfile):
@@ -130,24 +149,15 @@ def plotCDFs(xLists, outfile):
     plt.savefig(outfile)
 
 
-def testIt(xputO, xputR, resultFile, alpha):
-    forPlot = {}
-
-    results = TH.doTests(xputO, xputR, alpha)
-    with open(resultFile, "w") as writeFile:
-        json.dump(results, writeFile)
-
-    forPlot['Original'] = xputO
-    forPlot['Control'] = xputR
-
-    areaTest = results[0]
-    ks2ratio = results[1]
-    xputAvg1 = results[4][2]
-    xputAvg2 = results[5][2]
-    ks2dVal = results[9]
-    ks2pVal = results[10]
-    return forPlot, {'areaTest': areaTest, 'ks2ratio': ks2ratio, 'xputAvg1': xputAvg1,
-                     'xputAvg2': xputAvg2, 'ks2dVal': ks2dVal, 'ks2pVal': ks2pVal}
+def testIt(tests, alpha):
+    '''
+    Runs the tests of every (xputO, xputR, resultFile) of tests, and writes their results to resultFile
+    '''
+    allResults = TH.doTestsBatch([(xputO, xputR) for (xputO, xputR, resultFile) in tests], alpha)
+    for ((xputO, xputR, resultFile), results) in zip(tests, allResults):
+        with open(resultFile, "w") as writeFile:
+            json.dump(results, writeFile)
+    return allResults
 
 
 def parseTsharkTransferOutput(output):
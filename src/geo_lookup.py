@@ -0,0 +1,151 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: city, country and local time of the GPS location in the mobile stats
+
+GeoService is created once per process: it builds the reverse geocoder index and the
+TimezoneFinder up front (instead of on the first client, or on every client for TimezoneFinder),
+and keeps LRU caches keyed on rounded coordinates:
+    - places:    rounded to `precision` decimals (default 2, about 1 km)
+    - timezones: rounded to 1 decimal, the precision the locations are stored with
+
+update_locations() and places() look up many locations at once (one reverse geocoder search for
+all the cache misses), e.g. to reprocess stored mobile stats offline.
+
+Used by replay_server.py and wehe_metadata_server.py.
+
+Usage:
+    python geo_lookup.py 42.34,-71.09 [48.85,2.35 ...]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, collections
+import reverse_geocode
+from datetime import datetime
+from timezonefinder import TimezoneFinder
+from dateutil import tz
+
+
+class LRU(object):
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            self.items.move_to_end(key)
+        except KeyError:
+            return None
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class GeoService(object):
+
+    def __init__(self, cacheSize=100000, precision=2):
+        self.precision = precision
+        self.timezoneFinder = TimezoneFinder()
+        # The geocoder index is built on its first search
+        reverse_geocode.search([(0.0, 0.0)])
+        self.placeCache = LRU(cacheSize)
+        self.timezoneCache = LRU(cacheSize)
+        self.utc = tz.gettz('UTC')
+
+    def places(self, coordinates):
+        '''
+        Returns the reverse geocoder results (dicts with country, city, ...) of [(lat, lon), ...]
+        '''
+        keys = [(round(lat, self.precision), round(lon, self.precision)) for (lat, lon) in coordinates]
+        found = dict((key, self.placeCache.get(key)) for key in keys)
+        missing = [key for key in found if found[key] is None]
+        if missing:
+            for key, geoInfo in zip(missing, reverse_geocode.search(missing)):
+                self.placeCache.put(key, geoInfo)
+                found[key] = geoInfo
+        return [found[key] for key in keys]
+
+    def place(self, lat, lon):
+        return self.places([(lat, lon)])[0]
+
+    def timezone(self, lat, lon):
+        key = (round(lat, 1), round(lon, 1))
+        zone = self.timezoneCache.get(key)
+        if zone is None:
+            zone = tz.gettz(self.timezoneFinder.timezone_at(lng=key[1], lat=key[0]))
+            self.timezoneCache.put(key, zone)
+        return zone
+
+    def local_time(self, utcTime, lon, lat):
+        '''
+        utcTime ('%Y-%m-%d %H:%M:%S') converted to the time zone at (lat, lon)
+        '''
+        if (lat == lon == '0.0') or (lat == lon == 0.0) or lat == 'null':
+            return None
+
+        utc = datetime.strptime(utcTime, '%Y-%m-%d %H:%M:%S').replace(tzinfo=self.utc)
+        return str(utc.astimezone(self.timezone(lat, lon)))
+
+    def update_location(self, locationInfo, incomingTime):
+        self.update_locations([(locationInfo, incomingTime)])
+
+    def update_locations(self, locations):
+        '''
+        For every (locationInfo, incomingTime) with a GPS location: adds country, city and localTime
+        to locationInfo and truncates its latitude and longitude to one digit after the decimal point
+        '''
+        located = []
+        for (locationInfo, incomingTime) in locations:
+            lat = str(locationInfo['latitude'])
+            lon = str(locationInfo['longitude'])
+            if lat != '0.0' and lon != '0.0' and lat != 'nil':
+                located.append((locationInfo, incomingTime, float(lat), float(lon)))
+            else:
+                locationInfo['latitude'] = lat
+                locationInfo['longitude'] = lon
+
+        geoInfos = self.places([(lat, lon) for (locationInfo, incomingTime, lat, lon) in located])
+        for (locationInfo, incomingTime, lat, lon), geoInfo in zip(located, geoInfos):
+            lat = float("{0:.1f}".format(lat))
+            lon = float("{0:.1f}".format(lon))
+            locationInfo['country'] = geoInfo['country']
+            locationInfo['city'] = geoInfo['city']
+            locationInfo['localTime'] = self.local_time(incomingTime, lon, lat)
+            locationInfo['latitude'] = lat
+            locationInfo['longitude'] = lon
+
+
+def main():
+    geo = GeoService()
+    coordinates = [tuple(map(float, arg.split(','))) for arg in sys.argv[1:]]
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    for (lat, lon), geoInfo in zip(coordinates, geo.places(coordinates)):
+        print('\t'.join([str(lat), str(lon), geoInfo['country'], geoInfo['city'],
+                         str(geo.local_time(now, lon, lat))]))
+
+
+if __name__ == "__main__":
+    main()
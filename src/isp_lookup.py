@@ -0,0 +1,268 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: name the ISP of WiFi clients (whois lookups) without a whois per client
+
+whois answers with the whole range the IP belongs to (NetRange/inetnum) and its organization.
+WhoisCache keeps these ranges, as CIDR prefixes, so every later client from the same range
+resolves with a few dictionary lookups (longest prefix first). Entries expire after ttl seconds,
+and the cache is saved as JSON (snapshot_file) so it survives restarts.
+
+Misses run whois in a pool of at most `workers` greenlets, one lookup per IP at a time (misses
+while the pool is full are not looked up). Callers wait at most `wait` seconds: a slow whois
+server only costs the client that found it slow, and its answer is still cached for the next ones.
+
+Used by replay_server.py and wehe_metadata_server.py. parse_whois is the whois parsing that
+wehe_metadata_server.getRangeAndOrg used to do inline, moved here so both servers share it.
+
+Usage:
+    python isp_lookup.py 8.8.8.8 [1.1.1.1 ...]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, json, time
+import gevent, gevent.event, gevent.pool, gevent.subprocess
+import netaddr as neta
+
+
+def whois(ip, timeout):
+    '''
+    Returns the output of `whois ip`, or '' if whois fails or takes more than timeout seconds
+    '''
+    try:
+        proc = gevent.subprocess.Popen(['whois', ip], stdout=gevent.subprocess.PIPE,
+                                       stderr=gevent.subprocess.PIPE)
+    except OSError:
+        return ''
+    try:
+        out, stderr = proc.communicate(timeout=timeout)
+    except gevent.subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return ''
+    return out.decode('ascii', 'ignore')
+
+
+def parse_whois(out):
+    '''
+    Returns (IPRange or IPSet, orgName) from a whois output, or (None, None)
+    '''
+    IPRange = None
+    orgName = None
+    netRange = None
+
+    if 'NetRange:' in out:
+        netRange = out.split('NetRange:')[1].split('\n')[0]
+        netRange = netRange.split()
+        IPRange = neta.IPRange(netRange[0], netRange[2])
+
+    # LACNIC/RIPE format
+    elif 'inetnum:' in out:
+        netRange = out.split('inetnum:')[1].split('\n')[0]
+        if '/' in netRange:
+            netRange = netRange.split()[0]
+            IPRange = neta.IPSet(neta.IPNetwork(netRange))
+        else:
+            netRange = netRange.split()
+            IPRange = neta.IPRange(netRange[0], netRange[2])
+
+    # ways to extract ISP name out from the whois result
+    if 'OrgName:' in out:
+        orgName = out.split('OrgName:')[1].split('\n')[0]
+    elif 'Organization:' in out:
+        orgName = out.split('Organization:')[1].split('\n')[0]
+    elif 'owner:' in out:
+        orgName = out.split('owner:')[1].split('\n')[0]
+    elif 'org-name:' in out:
+        orgName = out.split('org-name:')[1].split('\n')[0]
+    elif 'abuse-mailbox:' in out:
+        orgName = out.split('abuse-mailbox:')[1].split('@')[1].split('.')[0]
+    elif 'netname:' in out:
+        orgName = out.split('netname:')[1].split('\n')[0]
+
+    if orgName and netRange:
+        return IPRange, orgName
+    else:
+        return None, None
+
+
+def getRangeAndOrg(ip, timeout=1):
+    return parse_whois(whois(ip, timeout))
+
+
+def range_cidrs(IPRange):
+    if isinstance(IPRange, neta.IPSet):
+        return list(IPRange.iter_cidrs())
+    return IPRange.cidrs()
+
+
+class WhoisCache(object):
+    '''
+    self.prefixes[(version, prefixlen)][network >> (bits - prefixlen)] = (orgName, expires)
+    self.prefixlens[version] = the prefix lengths in use, longest first
+    self.failed[ip] = expires, for IPs whois had no answer for (retried after failedTTL seconds)
+    self.inflight[ip] = AsyncResult of the running lookup
+    '''
+
+    def __init__(self, snapshot_file=None, ttl=7 * 24 * 3600, failedTTL=600, workers=16, timeout=10,
+                 lookup=getRangeAndOrg):
+        self.snapshot_file = snapshot_file
+        self.ttl = ttl
+        self.failedTTL = failedTTL
+        self.timeout = timeout
+        self.lookup_func = lookup
+        self.pool = gevent.pool.Pool(workers)
+        self.prefixes = {}
+        self.prefixlens = {4: [], 6: []}
+        self.failed = {}
+        self.inflight = {}
+        self.dirty = False
+        if snapshot_file and os.path.isfile(snapshot_file):
+            self.load()
+
+    def add(self, cidr, orgName, expires):
+        cidr = neta.IPNetwork(cidr)
+        bits = 32 if cidr.version == 4 else 128
+        key = (cidr.version, cidr.prefixlen)
+        if key not in self.prefixes:
+            self.prefixes[key] = {}
+            self.prefixlens[cidr.version] = sorted(self.prefixlens[cidr.version] + [cidr.prefixlen], reverse=True)
+        network = cidr.value >> (bits - cidr.prefixlen)
+        if self.prefixes[key].get(network, (None, 0))[1] < expires:
+            self.prefixes[key][network] = (orgName, expires)
+
+    def get(self, ip):
+        '''
+        Returns the cached orgName of ip (longest matching prefix), or None
+        '''
+        ip = neta.IPAddress(ip)
+        bits = 32 if ip.version == 4 else 128
+        now = time.time()
+        for prefixlen in self.prefixlens[ip.version]:
+            found = self.prefixes[(ip.version, prefixlen)].get(ip.value >> (bits - prefixlen))
+            if found is not None and found[1] > now:
+                return found[0]
+        return None
+
+    def lookup(self, ip, wait=1):
+        '''
+        Returns the orgName of ip, or None if whois has none or did not answer within wait seconds
+        (the lookup goes on in the background and is cached)
+        '''
+        orgName = self.get(ip)
+        if orgName is not None or self.failed.get(ip, 0) > time.time():
+            return orgName
+        result = self.inflight.get(ip)
+        if result is None:
+            if self.pool.full():
+                return None
+            result = self.inflight[ip] = gevent.event.AsyncResult()
+            self.pool.spawn(self.resolve, ip)
+        try:
+            return result.get(timeout=wait)
+        except gevent.Timeout:
+            return None
+
+    def resolve(self, ip):
+        result = self.inflight[ip]
+        orgName = None
+        try:
+            IPRange, orgName = self.lookup_func(ip, self.timeout)
+            if orgName:
+                expires = time.time() + self.ttl
+                for cidr in range_cidrs(IPRange):
+                    self.add(cidr, orgName, expires)
+                self.dirty = True
+            else:
+                self.failed[ip] = time.time() + self.failedTTL
+        except Exception:
+            self.failed[ip] = time.time() + self.failedTTL
+        finally:
+            del self.inflight[ip]
+            result.set(orgName)
+
+    def expire(self):
+        now = time.time()
+        for key, networks in list(self.prefixes.items()):
+            for network in [n for (n, (orgName, expires)) in networks.items() if expires <= now]:
+                del networks[network]
+                self.dirty = True
+            if not networks:
+                del self.prefixes[key]
+                self.prefixlens[key[0]].remove(key[1])
+        for ip in [ip for (ip, expires) in self.failed.items() if expires <= now]:
+            del self.failed[ip]
+
+    def entries(self):
+        for (version, prefixlen), networks in self.prefixes.items():
+            bits = 32 if version == 4 else 128
+            for network, (orgName, expires) in networks.items():
+                cidr = neta.IPNetwork((network << (bits - prefixlen), prefixlen), version=version)
+                yield str(cidr), orgName, expires
+
+    def load(self):
+        try:
+            with open(self.snapshot_file, 'r') as f:
+                entries = json.load(f)
+        except ValueError:
+            return
+        now = time.time()
+        for cidr, orgName, expires in entries:
+            if expires > now:
+                self.add(cidr, orgName, expires)
+
+    def save(self):
+        '''
+        Merges what other processes (e.g. replay_server workers) saved in the meantime before saving
+        '''
+        if not self.snapshot_file:
+            return
+        self.dirty = False
+        if os.path.isfile(self.snapshot_file):
+            self.load()
+        folder = os.path.dirname(self.snapshot_file)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmpPath = '{}.{}.tmp'.format(self.snapshot_file, os.getpid())
+        with open(tmpPath, 'w') as f:
+            json.dump(sorted(self.entries()), f)
+        os.replace(tmpPath, self.snapshot_file)
+
+    def run(self, interval=60):
+        '''
+        Drops expired entries and saves the snapshot (if anything changed) every interval seconds
+        '''
+        while True:
+            gevent.sleep(interval)
+            self.expire()
+            if self.dirty:
+                self.save()
+
+    def __len__(self):
+        return sum(len(networks) for networks in self.prefixes.values())
+
+
+def main():
+    cache = WhoisCache()
+    for ip in sys.argv[1:]:
+        print('{}\t{}'.format(ip, cache.lookup(ip, wait=cache.timeout)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: throughput of replay pcaps without tshark
+
+read_frames() reads a whole pcap (pcapng captures are converted first, see
+pcap_tools.pcapng_to_pcap) into numpy arrays, one value per frame: time since the first frame,
+length on the wire and the IP/TCP fields the analyses need. Only the record boundaries are found
+with a Python loop, every field is then gathered for all frames at once.
+
+Retransmissions are flagged like Wireshark's tcp.analysis.retransmission: a TCP segment with data
+(or SYN/FIN) starting below the highest sequence number seen so far in its direction, that is
+neither a keep-alive nor out of order (arriving within 3 ms of that highest sequence number).
+
+adjusted_xput() and xput_stats() bucket the bytes like `tshark -qz io,stat,<interval>`, and
+return what testHypothesis.adjustedXput / xputTshark parsed out of tshark. benchmark_pcap_analysis.py
+compares both, in time and in results.
+
+rtt_samples() gives the ACK RTTs (like tcp.analysis.ack_rtt): for every ACK acknowledging new data,
+the time since the oldest segment it acknowledges was sent, leaving out the ACKs covering
+retransmitted segments.
+
+Usage:
+    python pcap_analysis.py <pcap> [xputBuckets]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, io, struct, ipaddress
+import numpy
+from pcap_tools import PCAP_MAGIC_NS, PCAPNG_MAGIC, PcapReader, UnsupportedPcap, pcapng_to_pcap, \
+    LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL, LINKTYPE_LINUX_SLL2, LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6, \
+    LINKTYPE_NULL, LINKTYPE_LOOP
+
+TH_FIN = 0x01
+TH_SYN = 0x02
+TH_RST = 0x04
+OUT_OF_ORDER_THRESHOLD = 0.003
+
+# linktype: (offset of the ethertype or None, offset of the IP header)
+LINK_LAYERS = {LINKTYPE_ETHERNET: (12, 14), LINKTYPE_LINUX_SLL: (14, 16), LINKTYPE_LINUX_SLL2: (0, 20),
+               LINKTYPE_RAW: (None, 0), LINKTYPE_IPV4: (None, 0), LINKTYPE_IPV6: (None, 0),
+               LINKTYPE_NULL: (None, 4), LINKTYPE_LOOP: (None, 4)}
+
+
+def unwrap(values, base):
+    '''
+    TCP sequence (or ACK) numbers relative to base, in [-2**31, 2**31)
+    '''
+    relative = (numpy.asarray(values, dtype=numpy.int64) - int(base)) % (1 << 32)
+    return numpy.where(relative >= (1 << 31), relative - (1 << 32), relative)
+
+
+def gather(raw, positions, size, byteorder='big'):
+    '''
+    The size bytes unsigned integers at positions of raw (a uint8 array), as uint64
+    '''
+    value = numpy.zeros(len(positions), dtype=numpy.uint64)
+    for i in range(size):
+        shift = 8 * (size - 1 - i if byteorder == 'big' else i)
+        value |= raw[positions + i].astype(numpy.uint64) << numpy.uint64(shift)
+    return value
+
+
+class Frames(object):
+    '''
+    One numpy array per field, one value per frame:
+        time, length:            seconds since the first frame, bytes on the wire
+        version, protocol:       IP version (0 if not IP) and protocol
+        src, dst:                addresses as (high, low) uint64 pairs, src[0] is 0 for IPv4
+        sport, dport:            ports (TCP and UDP)
+        isTCP, seq, ack, flags:  TCP fields (0 for other frames)
+        payload:                 TCP payload length, from the headers (captures are truncated)
+    '''
+
+    def __init__(self, count):
+        self.count = count
+        self._flows = None
+        self._flowKeys = None
+
+    def __len__(self):
+        return self.count
+
+    def duration(self):
+        return float(self.time[-1]) if self.count else 0.0
+
+    def address(self, which, i):
+        '''
+        The source or destination ('src'/'dst') IP address of frame i, as a string
+        '''
+        high, low = getattr(self, which)
+        if self.version[i] == 4:
+            return '.'.join(str(b) for b in struct.pack('!I', int(low[i])))
+        packed = struct.pack('!QQ', int(high[i]), int(low[i]))
+        return str(ipaddress.ip_address(packed))
+
+    def flows(self):
+        '''
+        A flow number per frame, the same for all the TCP frames of one direction of one connection
+        (-1 for other frames)
+        '''
+        if self._flows is None:
+            keys = numpy.stack([self.src[0], self.src[1], self.dst[0], self.dst[1], self.sport.astype(numpy.uint64),
+                                self.dport.astype(numpy.uint64)], axis=1)
+            self._flows = numpy.full(self.count, -1, dtype=numpy.int64)
+            self._flowKeys = keys[:0]
+            if self.isTCP.any():
+                self._flowKeys, inverse = numpy.unique(keys[self.isTCP], axis=0, return_inverse=True)
+                self._flows[self.isTCP] = inverse.reshape(-1)
+        return self._flows
+
+    def reverse_flows(self):
+        '''
+        reverse[flow] = the flow number of the other direction of the connection (-1 if never seen)
+        '''
+        self.flows()
+        numbers = {tuple(key): flow for (flow, key) in enumerate(self._flowKeys.tolist())}
+        return numpy.array([numbers.get((key[2], key[3], key[0], key[1], key[5], key[4]), -1)
+                            for key in self._flowKeys.tolist()], dtype=numpy.int64)
+
+    def match(self, which, ip):
+        '''
+        Boolean array, True for the frames with ip as source or destination address ('src'/'dst')
+        '''
+        packed = ipaddress.ip_address(ip).packed
+        high, low = getattr(self, which)
+        if len(packed) == 4:
+            return (self.version == 4) & (low == struct.unpack('!I', packed)[0])
+        high_ip, low_ip = struct.unpack('!QQ', packed)
+        return (self.version == 6) & (high == high_ip) & (low == low_ip)
+
+    def retransmissions(self):
+        '''
+        Boolean array, True for the frames Wireshark flags as tcp.analysis.retransmission
+        '''
+        retransmission = numpy.zeros(self.count, dtype=bool)
+        flows = self.flows()
+        syn = (self.flags & TH_SYN) > 0
+        fin = (self.flags & TH_FIN) > 0
+        for flow in numpy.unique(flows[flows >= 0]):
+            index = numpy.nonzero(flows == flow)[0]
+            relative = unwrap(self.seq[index], self.seq[index[0]])
+            seglen = self.payload[index].astype(numpy.int64)
+            end = relative + seglen + syn[index] + fin[index]
+
+            # nextseq: the highest sequence number seen before each frame, and when it was reached
+            highest = numpy.maximum.accumulate(end)
+            nextseq = numpy.concatenate([[numpy.iinfo(numpy.int64).min], highest[:-1]])
+            advanced = numpy.concatenate([[True], end[1:] > highest[:-1]])
+            lastAdvance = numpy.maximum.accumulate(numpy.where(advanced, numpy.arange(len(index)), 0))
+            nextseqTime = numpy.concatenate([[self.time[index[0]]], self.time[index][lastAdvance[:-1]]])
+
+            hasData = (seglen > 0) | syn[index] | fin[index]
+            below = (relative < nextseq) & (len(index) > 1)
+            keepAlive = (seglen <= 1) & (relative == nextseq - 1) & \
+                        ((self.flags[index] & (TH_SYN | TH_FIN | TH_RST)) == 0)
+            outOfOrder = (self.time[index] - nextseqTime < OUT_OF_ORDER_THRESHOLD) & (nextseq != relative + seglen)
+            retransmission[index] = hasData & below & ~keepAlive & ~outOfOrder
+        return retransmission
+
+    def ack_rtts(self):
+        '''
+        (frames, rtts): the ACK frames acknowledging new data and, for each, the time since the oldest
+        segment it acknowledges was sent (like Wireshark's tcp.analysis.ack_rtt). Following Karn's
+        algorithm, ACKs covering a retransmitted segment give no sample.
+        '''
+        flows, reverse = self.flows(), self.reverse_flows()
+        syn = (self.flags & TH_SYN) > 0
+        fin = (self.flags & TH_FIN) > 0
+        retransmission = self.retransmissions()
+        ackFrames, rtts = [], []
+        for flow in numpy.unique(flows[flows >= 0]):
+            if reverse[flow] < 0:
+                continue
+            # Segments carrying data in this direction, in the order they were sent
+            sent = numpy.nonzero(flows == flow)[0]
+            sent = sent[(self.payload[sent] > 0) | syn[sent] | fin[sent]]
+            if not len(sent):
+                continue
+            base = self.seq[sent[0]]
+            end = unwrap(self.seq[sent], base) + self.payload[sent] + syn[sent] + fin[sent]
+            highest = numpy.maximum.accumulate(end)
+            retransmitted = numpy.concatenate([[0], numpy.cumsum(retransmission[sent])])
+
+            # ACKs of this data in the other direction and how far each one moves the cumulative ACK
+            acks = numpy.nonzero((flows == reverse[flow]) & ((self.flags & 0x10) > 0))[0]
+            acked = unwrap(self.ack[acks], base)
+            before = numpy.concatenate([[numpy.iinfo(numpy.int64).min], numpy.maximum.accumulate(acked)[:-1]])
+            new = acked > before
+            acks, acked, before = acks[new], acked[new], before[new]
+
+            # Oldest segment not acknowledged before, and last segment acknowledged by each ACK
+            first = numpy.searchsorted(highest, before, side='right')
+            last = numpy.searchsorted(highest, acked, side='right') - 1
+            valid = (first <= last) & (first < len(sent))
+            first, last, acks = first[valid], last[valid], acks[valid]
+            valid = (self.time[sent[first]] <= self.time[acks]) & (retransmitted[last + 1] == retransmitted[first])
+            ackFrames.append(acks[valid])
+            rtts.append(self.time[acks[valid]] - self.time[sent[first[valid]]])
+
+        if not ackFrames:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+        ackFrames, rtts = numpy.concatenate(ackFrames), numpy.concatenate(rtts)
+        order = numpy.argsort(ackFrames)
+        return ackFrames[order], rtts[order]
+
+
+def record_positions(buf, endian):
+    '''
+    Offsets of the 16 bytes record headers in buf (a whole pcap file)
+    '''
+    positions = []
+    unpack = struct.Struct(endian + 'I').unpack_from
+    pos, end = 24, len(buf)
+    while pos + 16 <= end:
+        caplen = unpack(buf, pos + 8)[0]
+        if pos + 16 + caplen > end:
+            break
+        positions.append(pos)
+        pos += 16 + caplen
+    return numpy.array(positions, dtype=numpy.int64)
+
+
+def read_frames(pcapPath):
+    with open(pcapPath, 'rb') as f:
+        buf = f.read()
+    if buf[:4] == PCAPNG_MAGIC:
+        buf = pcapng_to_pcap(buf)
+    reader = PcapReader(io.BytesIO(buf[:24]))
+    if reader.linktype not in LINK_LAYERS:
+        raise UnsupportedPcap('Unsupported link type {}'.format(reader.linktype))
+
+    raw = numpy.frombuffer(buf, dtype=numpy.uint8)
+    positions = record_positions(buf, reader.endian)
+    byteorder = 'little' if reader.endian == '<' else 'big'
+    frames = Frames(len(positions))
+
+    # Pad so that reading a few bytes beyond a truncated frame stays in the array
+    raw = numpy.concatenate([raw, numpy.zeros(64, dtype=numpy.uint8)])
+    seconds = gather(raw, positions, 4, byteorder).astype(numpy.float64)
+    fraction = gather(raw, positions + 4, 4, byteorder).astype(numpy.float64)
+    timestamps = seconds + fraction / (1e9 if struct.unpack(reader.endian + 'I', buf[:4])[0] == PCAP_MAGIC_NS
+                                       else 1e6)
+    caplen = gather(raw, positions + 8, 4, byteorder).astype(numpy.int64)
+    frames.time = timestamps - timestamps[0] if len(positions) else timestamps
+    frames.length = gather(raw, positions + 12, 4, byteorder).astype(numpy.int64)
+
+    data = positions + 16
+    typeOffset, ipOffset = LINK_LAYERS[reader.linktype]
+    ip = data + ipOffset
+    if typeOffset is not None:
+        etherType = gather(raw, data + typeOffset, 2)
+        version = numpy.where(etherType == 0x0800, 4, numpy.where(etherType == 0x86DD, 6, 0))
+    else:
+        version = (raw[ip] >> 4).astype(numpy.int64)
+        version = numpy.where((version == 4) | (version == 6), version, 0)
+    version = numpy.where(caplen >= ipOffset + numpy.where(version == 6, 40, 20), version, 0)
+    v4, v6 = version == 4, version == 6
+    frames.version = version
+
+    ihl = (raw[ip] & 0x0f).astype(numpy.int64) * 4
+    frames.protocol = numpy.where(v4, raw[ip + 9], numpy.where(v6, raw[ip + 6], 0)).astype(numpy.int64)
+    ipPayload = numpy.where(v4, gather(raw, ip + 2, 2).astype(numpy.int64) - ihl,
+                            gather(raw, ip + 4, 2).astype(numpy.int64))
+    zero = numpy.zeros(len(positions), dtype=numpy.uint64)
+    frames.src = (numpy.where(v6, gather(raw, ip + 8, 8), zero),
+                  numpy.where(v4, gather(raw, ip + 12, 4), numpy.where(v6, gather(raw, ip + 16, 8), zero)))
+    frames.dst = (numpy.where(v6, gather(raw, ip + 24, 8), zero),
+                  numpy.where(v4, gather(raw, ip + 16, 4), numpy.where(v6, gather(raw, ip + 32, 8), zero)))
+
+    l4 = numpy.where(v4, ip + ihl, ip + 40)
+    hasPorts = (version > 0) & ((frames.protocol == 6) | (frames.protocol == 17)) & (caplen >= l4 - data + 4)
+    frames.sport = numpy.where(hasPorts, gather(raw, l4, 2), 0).astype(numpy.int64)
+    frames.dport = numpy.where(hasPorts, gather(raw, l4 + 2, 2), 0).astype(numpy.int64)
+
+    frames.isTCP = hasPorts & (frames.protocol == 6) & (caplen >= l4 - data + 14)
+    frames.seq = numpy.where(frames.isTCP, gather(raw, l4 + 4, 4), 0).astype(numpy.int64)
+    frames.ack = numpy.where(frames.isTCP, gather(raw, l4 + 8, 4), 0).astype(numpy.int64)
+    tcpHeader = (raw[l4 + 12] >> 4).astype(numpy.int64) * 4
+    frames.flags = numpy.where(frames.isTCP, raw[l4 + 13], 0).astype(numpy.int64)
+    frames.payload = numpy.where(frames.isTCP, numpy.maximum(ipPayload - tcpHeader, 0), 0)
+    return frames
+
+
+def bucket_bytes(frames, interval, mask=None):
+    '''
+    Like tshark io,stat: returns (starts, ends, bytes) of the intervals between the first and the
+    last frame, the last interval ending with the last frame and counting it
+    '''
+    duration = frames.duration()
+    weights = frames.length if mask is None else numpy.where(mask, frames.length, 0)
+    if not len(frames) or interval <= 0:
+        return numpy.zeros(1), numpy.zeros(1), numpy.array([float(weights.sum())])
+    # The last frame is at `duration`, the end of the last interval, not the start of another one
+    count = max(int(numpy.ceil(duration / interval - 1e-9)), 1)
+    index = numpy.minimum(numpy.floor(frames.time / interval).astype(numpy.int64), count - 1)
+    counts = numpy.bincount(index, weights=weights, minlength=count)
+    starts = numpy.arange(count) * interval
+    ends = numpy.minimum(starts + interval, duration)
+    return starts, ends, counts
+
+
+def adjusted_xput(pcapPath, xputBuckets):
+    '''
+    (xput, ts): the throughput in Mbps of every interval (duration / xputBuckets) with traffic, and
+    the end time of these intervals. The last one is left out, as testHypothesis.adjustedXput did.
+    '''
+    frames = read_frames(pcapPath)
+    if not len(frames):
+        return [], []
+    starts, ends, counts = bucket_bytes(frames, frames.duration() / xputBuckets)
+    durations = ends - starts
+    keep = (durations > 0) & (counts > 0)
+    xput = counts[keep] / durations[keep] * 8 / 1000000.0
+    return xput[:-1].tolist(), ends[keep][:-1].tolist()
+
+
+def xput_stats(pcapPath, xputBuckets=100, excludeRetransmissions=True):
+    '''
+    (xputList, duration): the throughput in Mbps of every interval (duration / xputBuckets), not
+    counting retransmissions, and the duration of the capture
+    '''
+    frames = read_frames(pcapPath)
+    if not len(frames):
+        return [], '0.000'
+    mask = ~frames.retransmissions() if excludeRetransmissions else None
+    starts, ends, counts = bucket_bytes(frames, frames.duration() / xputBuckets, mask)
+    durations = ends - starts
+    keep = durations > 0
+    xput = numpy.round(counts[keep] / durations[keep], 2) * 8 / 1000000.0
+    return xput.tolist(), '{:.3f}'.format(frames.duration())
+
+
+def rtt_samples(pcapPath, serverIP=None, clientIP=None):
+    '''
+    ACK RTT samples (seconds) of the ACKs not sent by serverIP and sent by clientIP (when given).
+    On server side captures only the ACKs sent by the client give meaningful RTTs.
+    '''
+    frames = read_frames(pcapPath)
+    ackFrames, rtts = frames.ack_rtts()
+    keep = numpy.ones(len(ackFrames), dtype=bool)
+    if serverIP is not None:
+        keep &= ~frames.match('src', serverIP)[ackFrames]
+    if clientIP is not None:
+        keep &= frames.match('src', clientIP)[ackFrames]
+    return rtts[keep]
+
+
+def main():
+    frames = read_frames(sys.argv[1])
+    print('{} frames, {:.3f} seconds, {} retransmissions'.format(len(frames), frames.duration(),
+                                                                  int(frames.retransmissions().sum())))
+    ackFrames, rtts = frames.ack_rtts()
+    if len(rtts):
+        print('{} RTT samples, median {:.3f} ms'.format(len(rtts), numpy.median(rtts) * 1000))
+    xput, ts = adjusted_xput(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 100)
+    for (t, x) in zip(ts, xput):
+        print('{:.3f}\t{:.3f}'.format(t, x))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: clean the pcap of a replay in one streaming pass, without tcpdump/editcap/tcprewrite
+
+rewrite_pcap() reads a (classic, libpcap) capture and writes only:
+    - the TCP/UDP/SCTP packets from or to one of the given ports    (tcpdump -r in -w out port ...)
+    - their first snaplen bytes (and any beyond snaplen + chop)     (editcap -C 128:10000)
+    - with clientIP replaced by anonymizedIP, checksums fixed       (tcprewrite --pnat --fixcsum)
+The IPv4 header checksum is recomputed. The TCP/UDP checksum is recomputed when the whole segment
+is in the capture, and otherwise updated for the new addresses (RFC 1624), so truncated packets
+keep a checksum that is as right as the captured one was.
+
+Captures it cannot parse (e.g. pcapng, unknown link types) raise UnsupportedPcap, and
+rewrite_pcap_external() does the same with the external tools. pcapng_to_pcap() converts a
+whole pcapng capture in memory, for the readers that load whole captures anyway (pcap_analysis.py).
+
+Usage:
+    python pcap_tools.py --in_pcap=dump.pcap --out_pcap=out.pcap --ports=443,80 --clientIP=1.2.3.4 [--anonymizedIP=1.2.3.0]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, struct, socket, subprocess, ipaddress
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+
+# pcapng blocks
+BLOCK_SECTION_HEADER = 0x0a0d0d0a
+BLOCK_INTERFACE = 1
+BLOCK_PACKET = 2
+BLOCK_SIMPLE_PACKET = 3
+BLOCK_ENHANCED_PACKET = 6
+OPTION_TSRESOL = 9
+
+# Link types: where the IP header starts
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+# Protocols with ports in their first 4 bytes, that `tcpdump port` matches
+PORT_PROTOCOLS = (socket.IPPROTO_TCP, socket.IPPROTO_UDP, 132)
+CHECKSUM_OFFSET = {socket.IPPROTO_TCP: 16, socket.IPPROTO_UDP: 6}
+
+
+class UnsupportedPcap(ValueError):
+    pass
+
+
+class PcapReader(object):
+    '''
+    Iterates over the records of a classic pcap file: (header, data), header being the raw 16 bytes
+    record header. self.header is the raw global header.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.header = f.read(24)
+        if len(self.header) < 24:
+            raise UnsupportedPcap('Truncated pcap header')
+        for endian in ['<', '>']:
+            magic = struct.unpack(endian + 'I', self.header[:4])[0]
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+                break
+        else:
+            raise UnsupportedPcap('Not a classic pcap file (magic {})'.format(self.header[:4].hex()))
+        self.endian = endian
+        self.nanoseconds = magic == PCAP_MAGIC_NS
+        self.snaplen, linktype = struct.unpack(endian + 'II', self.header[16:24])
+        self.linktype = linktype & 0x0fffffff
+        self.record = struct.Struct(endian + 'IIII')
+
+    def __iter__(self):
+        read = self.f.read
+        unpack = self.record.unpack
+        while True:
+            header = read(16)
+            if len(header) < 16:
+                return
+            caplen = unpack(header)[2]
+            data = read(caplen)
+            if len(data) < caplen:
+                return
+            yield header, data
+
+
+def interface_resolution(buf, pos, end, endian):
+    '''
+    Timestamp units per second of a pcapng interface, from its options between pos and end
+    '''
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', buf, pos)
+        if code == 0:
+            break
+        if code == OPTION_TSRESOL and length >= 1:
+            value = buf[pos + 4]
+            return 2 ** (value & 0x7f) if value & 0x80 else 10 ** value
+        pos += 4 + (length + 3) // 4 * 4
+    return 10 ** 6
+
+
+def pcapng_to_pcap(buf):
+    '''
+    The classic pcap (nanosecond timestamps) holding the packets of buf, a whole pcapng capture.
+    All the interfaces the packets were captured on must have the same link type.
+    '''
+    if buf[:4] != PCAPNG_MAGIC:
+        raise UnsupportedPcap('Not a pcapng file (magic {})'.format(bytes(buf[:4]).hex()))
+    records = []
+    linktypes = set()
+    interfaces = []  # (linktype, snaplen, timestamp units per second) of the current section
+    endian = '<'
+    timestamp = (0, 0)
+    pos, end = 0, len(buf)
+    while pos + 12 <= end:
+        if buf[pos:pos + 4] == PCAPNG_MAGIC:
+            # Every section has its own byte order and interfaces
+            endian = '<' if buf[pos + 8:pos + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+            interfaces = []
+        blockType, blockLength = struct.unpack_from(endian + 'II', buf, pos)
+        if blockLength < 12 or pos + blockLength > end:
+            break
+        body = pos + 8
+
+        packet = None
+        if blockType == BLOCK_INTERFACE:
+            linktype, reserved, snaplen = struct.unpack_from(endian + 'HHI', buf, body)
+            interfaces.append((linktype, snaplen, interface_resolution(buf, body + 8, pos + blockLength - 4, endian)))
+        elif blockType in (BLOCK_ENHANCED_PACKET, BLOCK_PACKET):
+            if blockType == BLOCK_ENHANCED_PACKET:
+                interface, high, low, caplen, origlen = struct.unpack_from(endian + 'IIIII', buf, body)
+            else:
+                interface, drops, high, low, caplen, origlen = struct.unpack_from(endian + 'HHIIII', buf, body)
+            linktype, snaplen, resolution = interfaces[interface]
+            seconds, fraction = divmod((high << 32) | low, resolution)
+            timestamp = (seconds, fraction * 10 ** 9 // resolution)
+            packet = (linktype, origlen, buf[body + 20:body + 20 + caplen])
+        elif blockType == BLOCK_SIMPLE_PACKET:
+            # No timestamp, and always captured on the first interface
+            linktype, snaplen, resolution = interfaces[0]
+            origlen = struct.unpack_from(endian + 'I', buf, body)[0]
+            caplen = min(origlen, snaplen or origlen, blockLength - 16)
+            packet = (linktype, origlen, buf[body + 4:body + 4 + caplen])
+
+        if packet is not None:
+            linktype, origlen, data = packet
+            linktypes.add(linktype)
+            records.append(struct.pack('<IIII', timestamp[0], timestamp[1], len(data), origlen))
+            records.append(bytes(data))
+        pos += blockLength
+
+    if len(linktypes) > 1:
+        raise UnsupportedPcap('Packets of several link types {}'.format(sorted(linktypes)))
+    linktype = linktypes.pop() if linktypes else LINKTYPE_ETHERNET
+    header = struct.pack('<IHHiIII', PCAP_MAGIC_NS, 2, 4, 0, 0, 262144, linktype)
+    return header + b''.join(records)
+
+
+class PcapWriter(object):
+    '''
+    Writes records with the same format (byte order, time resolution) as header
+    '''
+
+    def __init__(self, f, header, endian):
+        self.f = f
+        self.record = struct.Struct(endian + 'IIII')
+        f.write(header)
+
+    def write(self, ts_sec, ts_frac, origlen, data):
+        self.f.write(self.record.pack(ts_sec, ts_frac, len(data), origlen))
+        self.f.write(data)
+
+
+def network_offset(linktype, data):
+    '''
+    Returns (offset of the IP header, IP version) or (None, None) for non IP packets
+    '''
+    if linktype == LINKTYPE_ETHERNET:
+        etherType = data[12:14]
+        offset = 14
+    elif linktype == LINKTYPE_LINUX_SLL:
+        etherType = data[14:16]
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        etherType = data[0:2]
+        offset = 20
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        etherType = None
+        offset = 0
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        etherType = None
+        offset = 4
+    else:
+        raise UnsupportedPcap('Unsupported link type {}'.format(linktype))
+
+    if etherType is not None:
+        if etherType == b'\x08\x00':
+            return offset, 4
+        if etherType == b'\x86\xdd':
+            return offset, 6
+        return None, None
+    if len(data) > offset:
+        version = data[offset] >> 4
+        if version in (4, 6):
+            return offset, version
+    return None, None
+
+
+def checksum_add(data, total=0):
+    '''
+    Adds the 16 bits words of data to the ones' complement sum total (not folded)
+    '''
+    if len(data) % 2:
+        data = bytes(data) + b'\x00'
+    return total + sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+
+
+def checksum_fold(total):
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def checksum_update(checksum, old, new):
+    '''
+    RFC 1624: the checksum after the bytes old (16 bits aligned) were replaced with new
+    '''
+    total = ~checksum & 0xffff
+    total = checksum_add(new, total)
+    total += sum(~word & 0xffff for word in struct.unpack('!{}H'.format(len(old) // 2), old))
+    return checksum_fold(total)
+
+
+class PacketRewriter(object):
+    '''
+    Filters, truncates, anonymizes and fixes the checksums of one packet at a time
+    '''
+
+    def __init__(self, linktype, ports, clientIP=None, anonymizedIP=None, snaplen=128, chop=10000):
+        self.linktype = linktype
+        self.ports = set(map(int, ports))
+        self.snaplen = snaplen
+        self.chop = chop
+        self.addresses = {}
+        if clientIP is not None and anonymizedIP is not None:
+            clientIP = ipaddress.ip_address(clientIP)
+            self.addresses[clientIP.version] = (clientIP.packed, ipaddress.ip_address(anonymizedIP).packed)
+
+    def rewrite(self, data):
+        '''
+        Returns the packet to write, or None if the packet does not go through the port filter
+        '''
+        offset, version = network_offset(self.linktype, data)
+        if offset is None:
+            return None
+
+        if version == 4:
+            if len(data) < offset + 20:
+                return None
+            headerLength = (data[offset] & 0x0f) * 4
+            protocol = data[offset + 9]
+            # `tcpdump port` only looks at first fragments
+            if struct.unpack('!H', data[offset + 6:offset + 8])[0] & 0x1fff:
+                return None
+            l4Length = struct.unpack('!H', data[offset + 2:offset + 4])[0] - headerLength
+            addressOffset, addressLength = offset + 12, 4
+        else:
+            headerLength = 40
+            protocol = data[offset + 6] if len(data) > offset + 6 else None
+            l4Length = struct.unpack('!H', data[offset + 4:offset + 6])[0] if len(data) >= offset + 6 else 0
+            addressOffset, addressLength = offset + 8, 16
+
+        l4 = offset + headerLength
+        if protocol not in PORT_PROTOCOLS or len(data) < l4 + 4:
+            return None
+        sport, dport = struct.unpack('!HH', data[l4:l4 + 4])
+        if sport not in self.ports and dport not in self.ports:
+            return None
+
+        packet = bytearray(data[:self.snaplen])
+        packet += data[self.snaplen + self.chop:]
+
+        addressesEnd = addressOffset + 2 * addressLength
+        if len(packet) < addressesEnd:
+            return packet
+        oldAddresses = bytes(packet[addressOffset:addressesEnd])
+        if version in self.addresses:
+            clientIP, anonymizedIP = self.addresses[version]
+            for start in (addressOffset, addressOffset + addressLength):
+                if packet[start:start + addressLength] == clientIP:
+                    packet[start:start + addressLength] = anonymizedIP
+
+        if version == 4 and len(packet) >= l4:
+            packet[offset + 10:offset + 12] = b'\x00\x00'
+            packet[offset + 10:offset + 12] = struct.pack('!H', checksum_fold(checksum_add(packet[offset:l4])))
+
+        self.fix_l4_checksum(packet, protocol, l4, l4Length, addressOffset, addressesEnd, oldAddresses)
+        return packet
+
+    def fix_l4_checksum(self, packet, protocol, l4, l4Length, addressOffset, addressesEnd, oldAddresses):
+        if protocol not in CHECKSUM_OFFSET or len(packet) < l4 + CHECKSUM_OFFSET[protocol] + 2:
+            return
+        at = l4 + CHECKSUM_OFFSET[protocol]
+        checksum = struct.unpack('!H', packet[at:at + 2])[0]
+        # No checksum (UDP over IPv4)
+        if protocol == socket.IPPROTO_UDP and checksum == 0:
+            return
+
+        newAddresses = bytes(packet[addressOffset:addressesEnd])
+        if len(packet) >= l4 + l4Length:
+            packet[at:at + 2] = b'\x00\x00'
+            pseudoHeader = newAddresses + struct.pack('!HH', protocol, l4Length)
+            checksum = checksum_fold(checksum_add(packet[l4:l4 + l4Length], checksum_add(pseudoHeader)))
+        elif newAddresses != oldAddresses:
+            checksum = checksum_update(checksum, oldAddresses, newAddresses)
+        else:
+            return
+        if protocol == socket.IPPROTO_UDP and checksum == 0:
+            checksum = 0xffff
+        packet[at:at + 2] = struct.pack('!H', checksum)
+
+
+def rewrite_pcap(in_pcap, out_pcap, ports, clientIP=None, anonymizedIP=None, snaplen=128, chop=10000):
+    '''
+    Writes the cleaned in_pcap to out_pcap (see the top of this file), returns (packets read, packets written).
+    out_pcap only appears once complete.
+    '''
+    read = written = 0
+    tmpPath = '{}.{}.tmp'.format(out_pcap, os.getpid())
+    try:
+        with open(in_pcap, 'rb') as fin, open(tmpPath, 'wb') as fout:
+            reader = PcapReader(fin)
+            writer = PcapWriter(fout, reader.header, reader.endian)
+            rewriter = PacketRewriter(reader.linktype, ports, clientIP, anonymizedIP, snaplen, chop)
+            unpack = reader.record.unpack
+            for header, data in reader:
+                read += 1
+                packet = rewriter.rewrite(data)
+                if packet is None:
+                    continue
+                ts_sec, ts_frac, caplen, origlen = unpack(header)
+                writer.write(ts_sec, ts_frac, origlen, packet)
+                written += 1
+        os.replace(tmpPath, out_pcap)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+    return read, written
+
+
+def rewrite_pcap_external(in_pcap, out_pcap, ports, clientIP, anonymizedIP, snaplen=128, chop=10000):
+    '''
+    rewrite_pcap() with tcpdump, editcap and tcprewrite (two intermediate files next to in_pcap)
+    '''
+    interm_pcap = in_pcap.replace('.pcap', '_interm.pcap')
+    interm2_pcap = in_pcap.replace('.pcap', '_interm2.pcap')
+
+    filter = 'port ' + ' or port '.join(map(str, map(int, ports)))
+    command = "tcpdump -r {} -w {} {}".format(in_pcap, interm_pcap, filter)
+    subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL)
+
+    # remove payload data from pcap file
+    command = "editcap -C {}:{} {} {}".format(snaplen, chop, interm_pcap, interm2_pcap)
+    subprocess.check_output(command, shell=True)
+
+    # anonymize the IP and update checksums
+    if ":" in anonymizedIP:
+        pnat = "--pnat=[{}]:[{}]".format(clientIP, anonymizedIP)
+    else:
+        pnat = "--pnat={}:{}".format(clientIP, anonymizedIP)
+    command = ["tcprewrite", "--fixcsum", pnat, "--infile={}".format(interm2_pcap), "--outfile={}".format(out_pcap)]
+    subprocess.check_output(command)
+
+    for interm_pcap in [interm_pcap, interm2_pcap]:
+        try:
+            os.remove(interm_pcap)
+        except OSError as error:
+            print("Removing error", error, interm_pcap.split("/")[-1])
+
+
+def main():
+    from python_lib import Configs, get_anonymizedIP
+    configs = Configs()
+    configs.set('snaplen', 128)
+    configs.read_args(sys.argv)
+
+    clientIP = configs.get('clientIP') if configs.is_given('clientIP') else None
+    anonymizedIP = None
+    if clientIP is not None:
+        anonymizedIP = configs.get('anonymizedIP') if configs.is_given('anonymizedIP') else get_anonymizedIP(clientIP)
+    read, written = rewrite_pcap(configs.get('in_pcap'), configs.get('out_pcap'), str(configs.get('ports')).split(','),
+                                 clientIP, anonymizedIP, configs.get('snaplen'))
+    print('{} packets read, {} written'.format(read, written))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: post-process finished replays (pcap cleaning, chown of the results) off the replay server loop
+
+A job is a dict, e.g.:
+    {'realID': ..., 'clean_pcap': [clean_pcap arguments] or None, 'chown': folder or None}
+
+PostProcessor (in the replay server, gevent side):
+    - journals every job as <folder>/<job id>.json until it is done, so pending jobs are run again
+      after a restart. Jobs failing 3 times are moved to <folder>/failed/
+    - takes over the journals of replay server workers that no longer exist (adopt), e.g. after
+      the server was restarted with fewer workers
+    - runs them in `workers` long lived worker processes (this file with --worker, see
+      worker_process.py), one job at a time each. A worker that does not answer within `timeout`
+      seconds is killed and restarted, and the job counts as failed. Every step of a job can run
+      again after a crash (clean_pcap only removes the raw pcap once everything else is done)
+    - backlogged() tells when more than maxBacklog jobs are pending, the admission controller then
+      turns new replays away until post-processing catches up
+    - exports the pending jobs, the time they wait and run, and the failures to Prometheus
+
+Usage (the replay server starts the workers):
+    python postprocess.py --worker
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, json, time
+import gevent, gevent.queue
+from prometheus_client import Summary, Counter, Gauge
+from python_lib import *
+from worker_process import WorkerProcess, serve
+
+MAX_ATTEMPTS = 3
+
+POSTPROCESS_PENDING = Gauge('postprocess_pending_jobs', 'Number of replays waiting for or in post-processing')
+POSTPROCESS_WAIT = Summary('postprocess_wait_seconds', 'Time post-processing jobs waited for a worker')
+POSTPROCESS_DURATION = Summary('postprocess_duration_seconds', 'Time post-processing jobs took in a worker')
+POSTPROCESS_FAILURES = Counter('postprocess_failures', 'Number of failed post-processing attempts')
+
+
+def orphaned_journals(parent, workers):
+    '''
+    The worker<N> journal folders under parent of the replay server workers beyond `workers`
+    '''
+    orphans = []
+    if not os.path.isdir(parent):
+        return orphans
+    for name in sorted(os.listdir(parent)):
+        index = name[len('worker'):]
+        if name.startswith('worker') and index.isdigit() and int(index) >= workers:
+            orphans.append(os.path.join(parent, name))
+    return orphans
+
+
+def chown_tree(folder):
+    '''
+    Recursively changes the ownership of folder from root to the user running sudo,
+    makes it easier to delete after data is backed up
+    '''
+    if not os.getenv("SUDO_UID"):
+        return
+    uid = int(os.getenv("SUDO_UID"))
+    for root, dirs, files in os.walk(folder):
+        for dir in dirs:
+            os.chown(os.path.join(root, dir), uid, uid)
+        for file in files:
+            os.chown(os.path.join(root, file), uid, uid)
+
+
+def run_job(job):
+    if job.get('clean_pcap'):
+        clean_pcap(*job['clean_pcap'])
+    if job.get('chown'):
+        chown_tree(job['chown'])
+    return {'ok': True}
+
+
+class PostProcessor(object):
+    '''
+    self.jobs[job id] = job, for every job not done yet (queued or running)
+    '''
+
+    def __init__(self, folder, workers=2, maxBacklog=1000, errorlog_q=None, timeout=600, adopt=()):
+        self.folder = folder
+        self.failedFolder = os.path.join(folder, 'failed')
+        self.workers = workers
+        self.maxBacklog = maxBacklog
+        self.errorlog_q = errorlog_q
+        self.timeout = timeout
+        self.adopt = adopt
+        self.queue = gevent.queue.Queue()
+        self.jobs = {}
+        self.counter = 0
+        for folder in [self.folder, self.failedFolder]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    def run(self):
+        self.recover()
+        for i in range(self.workers):
+            gevent.Greenlet.spawn(self.worker_loop)
+
+    def recover(self):
+        '''
+        Queues the jobs a previous run left in the journal, and in the adopted journals
+        '''
+        for orphan in self.adopt:
+            for subfolder in ['', 'failed']:
+                orphanFolder = os.path.join(orphan, subfolder)
+                if not os.path.isdir(orphanFolder):
+                    continue
+                for file in os.listdir(orphanFolder):
+                    if file.endswith('.json'):
+                        os.replace(os.path.join(orphanFolder, file),
+                                   os.path.join(self.failedFolder if subfolder else self.folder, file))
+        for file in sorted(os.listdir(self.folder)):
+            if not file.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, file), 'r') as f:
+                    job = json.load(f)
+            except ValueError:
+                continue
+            self.jobs[job['id']] = job
+            self.queue.put(job['id'])
+        if self.jobs:
+            LOG_ACTION(logger, 'Recovered {} post-processing jobs'.format(len(self.jobs)), indent=1, action=False)
+        POSTPROCESS_PENDING.set(len(self.jobs))
+
+    def submit(self, job):
+        self.counter += 1
+        job['id'] = '{:.6f}_{}_{}'.format(time.time(), os.getpid(), self.counter)
+        job['created'] = time.time()
+        job['attempts'] = 0
+        self.journal(job)
+        self.jobs[job['id']] = job
+        self.queue.put(job['id'])
+        POSTPROCESS_PENDING.set(len(self.jobs))
+
+    def journal(self, job, folder=None):
+        path = os.path.join(folder or self.folder, job['id'] + '.json')
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmpPath, path)
+
+    def backlog(self):
+        return len(self.jobs)
+
+    def backlogged(self):
+        return len(self.jobs) > self.maxBacklog
+
+    def worker_loop(self):
+        worker = WorkerProcess([sys.executable, os.path.abspath(__file__), '--worker'], 'Post-processing',
+                               self.timeout)
+        while True:
+            job = self.jobs[self.queue.get()]
+            start = time.time()
+            POSTPROCESS_WAIT.observe(start - job['created'])
+            result = worker.request(job)
+            self.finish(job, result, time.time() - start)
+
+    def finish(self, job, result, duration):
+        POSTPROCESS_DURATION.observe(duration)
+        if result['ok']:
+            os.remove(os.path.join(self.folder, job['id'] + '.json'))
+            del self.jobs[job['id']]
+            LOG_ACTION(logger, 'Post-processed replay of {} in {:.3f} seconds, {:.3f} seconds after it ended'.format(
+                job.get('realID'), duration, time.time() - job['created']), indent=2, action=False)
+        else:
+            POSTPROCESS_FAILURES.inc()
+            job['attempts'] += 1
+            error = 'Post-processing failed for {} (attempt {}): {}'.format(job.get('realID'), job['attempts'],
+                                                                            result.get('error'))
+            if self.errorlog_q is not None:
+                self.errorlog_q.put(error)
+            if job['attempts'] < MAX_ATTEMPTS:
+                self.journal(job)
+                self.queue.put(job['id'])
+            else:
+                self.journal(job, self.failedFolder)
+                os.remove(os.path.join(self.folder, job['id'] + '.json'))
+                del self.jobs[job['id']]
+        POSTPROCESS_PENDING.set(len(self.jobs))
+
+
+if __name__ == "__main__":
+    if '--worker' in sys.argv:
+        serve(run_job)
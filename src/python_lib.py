@@ -22,7 +22,7 @@ limitations under the License.
 import sys, os, configparser, math, json, time, subprocess, \
     random, string, logging.handlers, socket, psutil, hashlib, scapy.all, ipaddress
 
-import multiprocessing, threading, logging, sys, traceback
+import multiprocessing, threading, logging, sys, traceback, ctypes, struct
 
 
 try:
@@ -30,6 +30,8 @@ try:
 except:
     pass
 
+from pcap_tools import rewrite_pcap, rewrite_pcap_external, UnsupportedPcap
+
 logger = logging.getLogger('replay_server')
 
 
@@ -646,42 +648,70 @@ def getSystemStat():
     return cpuPercent, memPercent, diskPercent, upLoad
 
 
-def clean_pcap(in_pcap, clientIP, anonymizedIP, port_list, realID, permResultsFolder):
-    out_pcap = in_pcap.replace('.pcap', '_out.pcap')
-    # If there is no content modification, we store only packet headers (first 128 bytes)
-    interm_pcap = in_pcap.replace('.pcap', '_interm.pcap')
-    interm2_pcap = in_pcap.replace('.pcap', '_interm2.pcap')
+class SystemStatSampler(object):
+    '''
+    Same numbers as getSystemStat(), but sampled in the background so reading them costs nothing.
 
-    port_list = list(map(int, port_list))
+    run() takes a sample every interval seconds (run it in its own greenlet or thread). CPU is
+    measured since the previous sample and upload bandwidth is the rate between two samples,
+    so nothing sleeps inside a sample. Values are smoothed with an EWMA (weight alpha for the
+    new sample) and passed to callback(cpuPercent, memPercent, diskPercent, upLoad) if given.
+    '''
 
-    filter = 'port ' + ' or port '.join(map(str, port_list))
-    command = "tcpdump -r {} -w {} {}".format(in_pcap, interm_pcap, filter)
-    p = subprocess.check_output(command, shell=True)
+    def __init__(self, interval=1.0, alpha=0.3, callback=None, disk='/'):
+        self.interval = interval
+        self.alpha = alpha
+        self.callback = callback
+        self.disk = disk
+        self.stats = None
+        self.lastTime = time.time()
+        self.lastBytesSent = psutil.net_io_counters()[0]
+        psutil.cpu_percent(None)
+
+    def sample(self):
+        now = time.time()
+        bytesSent = psutil.net_io_counters()[0]
+        upLoad = (bytesSent - self.lastBytesSent) * 8 / 1000000.0 / max(now - self.lastTime, 1e-3)
+        self.lastTime = now
+        self.lastBytesSent = bytesSent
+
+        current = (psutil.cpu_percent(None), psutil.virtual_memory()[2], psutil.disk_usage(self.disk)[3], upLoad)
+        if self.stats is None:
+            self.stats = current
+        else:
+            self.stats = tuple(self.alpha * new + (1 - self.alpha) * old for (new, old) in zip(current, self.stats))
 
-    # remove payload data from pcap file
-    command = "editcap -C 128:10000 {} {}".format(interm_pcap, interm2_pcap)
-    p = subprocess.check_output(command, shell=True)
+        if self.callback is not None:
+            self.callback(*self.stats)
+        return self.stats
 
-    # anonymize the IP and update checksums
-    if ":" in anonymizedIP:
-        command = ["tcprewrite", "--fixcsum", "--pnat=[{}]:[{}]".format(clientIP, anonymizedIP),
-                   "--infile={}".format(interm2_pcap),
-                   "--outfile={}".format(out_pcap)]
-    else:
-        command = ["tcprewrite", "--fixcsum", "--pnat={}:{}".format(clientIP, anonymizedIP),
-                   "--infile={}".format(interm2_pcap),
-                   "--outfile={}".format(out_pcap)]
+    def latest(self):
+        '''
+        (cpuPercent, memPercent, diskPercent, upLoad) of the last sample
+        '''
+        stats = self.stats
+        if stats is None:
+            stats = self.sample()
+        return tuple(round(x, 1) for x in stats)
 
-    p = subprocess.check_output(command)
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print('System stat sampling failed', e)
+            time.sleep(self.interval)
 
-    # Remove the intermediate pcaps
-    interm_pcaps = [in_pcap, interm_pcap, interm2_pcap]
-    for interm_pcap in interm_pcaps:
-        try:
-            os.remove(interm_pcap)
-        except OSError as error:
-            print("Removing error", error, interm_pcap.split("/")[-1])
 
+def clean_pcap(in_pcap, clientIP, anonymizedIP, port_list, realID, permResultsFolder, apply=None):
+    '''
+    Moves in_pcap to permResultsFolder/realID/tcpdumpsResults/<name>_out.pcap, keeping only packet
+    headers (first 128 bytes) of the replay ports, with clientIP anonymized (see pcap_tools.py).
+    apply(func, args) runs the rewrite, e.g. a gevent threadpool's apply to keep the loop going.
+    in_pcap is removed last, so running it again after it was interrupted (postprocess.py retries)
+    finishes the job: the pcap is cleaned again as long as in_pcap exists, and out_pcap is only
+    written once complete.
+    '''
     if not os.path.exists(permResultsFolder):
         os.mkdir(permResultsFolder)
     clientFolder = "{}/{}/".format(permResultsFolder, realID)
@@ -691,7 +721,19 @@ def clean_pcap(in_pcap, clientIP, anonymizedIP, port_list, realID, permResultsFo
     if not os.path.exists(tcpdumpFolder):
         os.mkdir(tcpdumpFolder)
 
-    mv_command = "mv {} {}".format(out_pcap, tcpdumpFolder)
+    out_pcap = os.path.join(tcpdumpFolder, os.path.basename(in_pcap).replace('.pcap', '_out.pcap'))
+    # A previous run that got as far as removing in_pcap had written out_pcap
+    if os.path.exists(in_pcap) or not os.path.exists(out_pcap):
+        try:
+            args = (in_pcap, out_pcap, port_list, clientIP, anonymizedIP)
+            if apply is None:
+                rewrite_pcap(*args)
+            else:
+                apply(rewrite_pcap, args)
+        except UnsupportedPcap:
+            tmp_pcap = out_pcap + '.tmp'
+            rewrite_pcap_external(in_pcap, tmp_pcap, port_list, clientIP, anonymizedIP)
+            os.replace(tmp_pcap, out_pcap)
 
     if os.getenv("SUDO_UID"):
         uid = int(os.getenv("SUDO_UID"))
@@ -701,7 +743,10 @@ def clean_pcap(in_pcap, clientIP, anonymizedIP, port_list, realID, permResultsFo
             for file in files:
                 os.chown(os.path.join(root, file), uid, uid)
 
-    p = subprocess.check_output(mv_command, shell=True)
+    try:
+        os.remove(in_pcap)
+    except OSError as error:
+        print("Removing error", error, in_pcap.split("/")[-1])
 
 
 class tcpdump(object):
@@ -877,3 +922,47 @@ def get_anonymizedIP(ip):
         anonymizedIP = ip
 
     return anonymizedIP
+
+
+# Linux values, older Pythons do not export them
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, 'SO_ATTACH_REUSEPORT_CBPF', 51)
+SKF_NET_OFF = -0x100000
+
+
+def reuseport_socket(address, kind=socket.SOCK_STREAM, workers=1, backlog=1024):
+    '''
+    Creates a socket bound (and listening, for TCP) on address with SO_REUSEPORT, so several
+    processes can serve the same port.
+
+    A classic BPF program is attached to the port group: it returns the client's source
+    address (for IPv6 its last 32 bits) modulo workers, i.e. the index of the socket that gets
+    the packet. All connections of one client IP, side channel and replays alike, therefore land
+    in the same process, as long as every process creates its sockets in the same order
+    (socket i of every group belongs to worker i).
+    '''
+    host = address[0]
+    if ':' in host:
+        family = socket.AF_INET6
+        srcOffset = 8 + 12
+    else:
+        family = socket.AF_INET
+        srcOffset = 12
+
+    sock = socket.socket(family, kind)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    if kind == socket.SOCK_STREAM:
+        sock.listen(backlog)
+
+    # struct sock_filter {u16 code; u8 jt; u8 jf; u32 k}
+    program = [(0x20, 0, 0, (SKF_NET_OFF + srcOffset) & 0xFFFFFFFF),  # ld [net + src]
+               (0x94, 0, 0, workers),  # mod #workers
+               (0x16, 0, 0, 0)]  # ret a
+    filters = ctypes.create_string_buffer(b''.join(struct.pack('HBBI', *f) for f in program))
+    # struct sock_fprog {u16 len; struct sock_filter *filter}
+    fprog = struct.pack('HP', len(program), ctypes.addressof(filters))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+
+    return sock
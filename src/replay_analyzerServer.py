@@ -33,12 +33,10 @@ import ssl
 import gevent, gevent.pool, gevent.server, gevent.queue, gevent.select
 from gevent.lock import RLock
 from python_lib import *
+from analysis_pool import AnalysisPool
+import result_files as RF
 from prometheus_client import start_http_server, Counter
 
-import finalAnalysis as FA
-
-POSTq = gevent.queue.Queue()
-
 errorlog_q = gevent.queue.Queue()
 
 logger = logging.getLogger('replay_analyzer')
@@ -496,26 +494,6 @@ def processResult(results):
     return outres
 
 
-# 1. Analyze using the throughputs sent by client (server creates a client decision file for the GET handle to answer client request)
-# 2. Use the tcpdump trace to perform server side analysis (if tcpdump enabled)
-def analyzer(userID, historyCount, testID, alpha):
-    resultsFolder = Configs().get('tmpResultsFolder')
-    LOG_ACTION(logger, 'analyzer:{}, {}, {}'.format(userID, historyCount, testID))
-
-    # return value is None if there is no file to analyze
-
-    resObjClient = FA.finalAnalyzer(userID, historyCount, testID, resultsFolder,
-                                    alpha)
-
-
-def jobDispatcher(q):
-    alpha = Configs().get('alpha')
-    pool = gevent.pool.Pool()
-    while True:
-        userID, historyCount, testID = q.get()
-        pool.apply_async(analyzer, args=(userID, historyCount, testID, alpha,))
-
-
 class myJsonEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime.datetime):
@@ -527,38 +505,31 @@ class myJsonEncoder(json.JSONEncoder):
 
 def loadAndReturnResult(userID, historyCount, testID):
     resultsFolder = Configs().get('tmpResultsFolder')
+    manifests = {}
 
-    resultFile = (resultsFolder + userID + '/decisions/' + 'results_{}_{}_{}_{}.json').format(userID, 'Client',
-                                                                                              historyCount, testID)
-
-    replayInfoFile = (resultsFolder + userID + '/replayInfo/' + 'replayInfo_{}_{}_{}.json').format(userID,
-                                                                                                   historyCount,
-                                                                                                   testID)
-    originalReplayInfoFile = (resultsFolder + userID + '/replayInfo/' + 'replayInfo_{}_{}_{}.json').format(userID,
-                                                                                                           historyCount,
-                                                                                                           0)
-    clientXputFile = (resultsFolder + userID + '/clientXputs/' + 'Xput_{}_{}_{}.json').format(userID,
-                                                                                              historyCount,
-                                                                                              testID)
-    clientOriginalXputFile = (resultsFolder + userID + '/clientXputs/' + 'Xput_{}_{}_{}.json').format(userID,
-                                                                                                      historyCount,
-                                                                                                      0)
+    # Where the result is: still in tmpResultsFolder, or already moved to a permResultsFolder
+    resultFile = RF.find_file(resultsFolder, userID, 'decisions', historyCount, testID, manifests=manifests)
+    replayInfoFile = RF.find_file(resultsFolder, userID, 'replayInfo', historyCount, testID, manifests=manifests)
 
     # if result file is here, return result
-    if os.path.isfile(resultFile) and os.path.isfile(replayInfoFile):
+    if resultFile and replayInfoFile:
         try:
             with open(resultFile, 'r') as readFile:
                 results = json.load(readFile)
             with open(replayInfoFile, 'r') as readFile:
                 info = json.load(readFile)
         except: # failed at loading the result file, re-running analyzer
-            alpha = Configs().get('alpha')
-            resultsFolder = Configs().get('tmpResultsFolder')
-            FA.finalAnalyzer(userID, historyCount, testID, resultsFolder, alpha)
-            with open(resultFile, 'r') as readFile:
-                results = json.load(readFile)
-            with open(replayInfoFile, 'r') as readFile:
-                info = json.load(readFile)
+            # The analysis is queued rather than run here, it would block the server for every
+            # request. The client gets 'No result found' and asks again, like for a result not ready yet.
+            # Only a result still in tmpResultsFolder is redone, archived ones are never deleted
+            if os.path.commonpath([os.path.abspath(resultFile), os.path.abspath(resultsFolder)]) == \
+                    os.path.abspath(resultsFolder):
+                try:
+                    os.remove(resultFile)
+                except OSError:
+                    pass
+            analysisPool.submit((userID, historyCount, testID))
+            return json.dumps({'success': False, 'error': 'No result found'})
 
         replayName = info[4]
         extraString = info[5]
@@ -571,28 +542,8 @@ def loadAndReturnResult(userID, historyCount, testID):
         ks2dVal = str(results[9])
         ks2pVal = str(results[10])
 
-        # move related files from tmpResultsFolder to permResultsFolder
-        permResultsFolder = getCurrentResultsFolder() + "/{}/".format(userID)
-        permDecisionFolder = "{}/decisions/".format(permResultsFolder)
-        permClientXputFolder = "{}/clientXputs/".format(permResultsFolder)
-        permReplayInfoFolder = "{}/replayInfo/".format(permResultsFolder)
-        for folder in [permResultsFolder, permDecisionFolder, permClientXputFolder, permReplayInfoFolder]:
-            if not os.path.exists(folder):
-                os.mkdir(folder)
-        mv_decisions = "mv {} {}".format(resultFile, permDecisionFolder)
-        mv_replayInfos = "mv {} {} {}".format(replayInfoFile, originalReplayInfoFile, permReplayInfoFolder)
-        mv_clientXputs = "mv {} {} {}".format(clientXputFile, clientOriginalXputFile, permClientXputFolder)
-
-        for command in [mv_clientXputs, mv_decisions, mv_replayInfos]:
-            p = subprocess.check_output(command, shell=True)
-
-        if os.getenv("SUDO_UID"):
-            uid = int(os.getenv("SUDO_UID"))
-            for root, dirs, files in os.walk(permResultsFolder):
-                for dir in dirs:
-                    os.chown(os.path.join(root, dir), uid, uid)
-                for file in files:
-                    os.chown(os.path.join(root, file), uid, uid)
+        if resultFile == RF.result_file(resultsFolder, userID, 'decisions', historyCount, testID):
+            moveToPermResultsFolder(userID, historyCount, testID)
 
         return json.dumps({'success': True,
                             'response': {'replayName': replayName, 'date': incomingTime, 'userID': userID,
@@ -604,14 +555,45 @@ def loadAndReturnResult(userID, historyCount, testID):
     else:
         # else if the clientXputs and replayInfo files (but not the result file) exist
         # maybe the POST request is missing, try putting the test to the analyzer queue
-        if os.path.isfile(replayInfoFile) and os.path.isfile(clientXputFile) and os.path.isfile(
-                clientOriginalXputFile):
+        if replayInfoFile and RF.find_file(resultsFolder, userID, 'clientXputs', historyCount, testID,
+                                           manifests=manifests) and \
+                RF.find_file(resultsFolder, userID, 'clientXputs', historyCount, 0, manifests=manifests):
             LOG_ACTION(logger,
-                       'result not ready yet, putting into POSTq :{}, {}, {}'.format(userID, historyCount, testID))
-            POSTq.put((userID, historyCount, testID))
+                       'result not ready yet, queueing for analysis :{}, {}, {}'.format(userID, historyCount, testID))
+            analysisPool.submit((userID, historyCount, testID))
             return json.dumps({'success': False, 'error': 'No result found'})
 
 
+def moveToPermResultsFolder(userID, historyCount, testID):
+    '''
+    Moves the files of the test (and of its original replay) from tmpResultsFolder to
+    permResultsFolder, and records where they went in the manifest of historyCount.
+    Only the folders and files created here are given to the user running sudo.
+    '''
+    resultsFolder = Configs().get('tmpResultsFolder')
+    permResultsFolder = getCurrentResultsFolder() + "/{}/".format(userID)
+    created = []
+    kinds = ['decisions', 'clientXputs', 'replayInfo']
+    for folder in [permResultsFolder] + [permResultsFolder + kind for kind in kinds]:
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+            created.append(folder)
+
+    moved = []
+    for (kind, tID) in [('clientXputs', testID), ('clientXputs', 0), ('decisions', testID), ('replayInfo', testID),
+                        ('replayInfo', 0)]:
+        path = RF.result_file(resultsFolder, userID, kind, historyCount, tID)
+        # The original replay's files are already moved if another test of the same history was fetched
+        if os.path.isfile(path):
+            moved.append((kind, historyCount, tID, RF.move_file(path, permResultsFolder + kind)))
+    RF.record_files(resultsFolder, userID, moved)
+
+    if os.getenv("SUDO_UID"):
+        uid = int(os.getenv("SUDO_UID"))
+        for path in created + [file for (kind, hC, tID, file) in moved]:
+            os.chown(path, uid, uid)
+
+
 def getHandler(args):
     '''
     Handles GET requests.
@@ -675,6 +657,8 @@ def postHandler(args):
     Handles POST requests.
 
     Basically puts the job on the queue and return True.
+    The analyzeBatch command queues many tests at once, given as a JSON list of
+    [userID, historyCount, testID] in the tests argument.
 
     If something wrong with the job, returns False.
     '''
@@ -683,6 +667,9 @@ def postHandler(args):
     except:
         return json.dumps({'success': False, 'error': 'command not provided'})
 
+    if command == 'analyzeBatch':
+        return postBatchHandler(args)
+
     try:
         userID = args['userID'][0].decode('ascii', 'ignore')
         historyCount = int(args['historyCount'][0].decode('ascii', 'ignore'))
@@ -693,7 +680,8 @@ def postHandler(args):
         return json.dumps({'success': False, 'value error': str(e)})
 
     if command == 'analyze':
-        POSTq.put((userID, historyCount, testID))
+        if not analysisPool.submit((userID, historyCount, testID)):
+            return json.dumps({'success': False, 'error': 'analyzer busy'})
     else:
         errorlog_q.put(('unknown command', args))
         return json.dumps({'success': False, 'error': 'unknown command'})
@@ -704,6 +692,28 @@ def postHandler(args):
     return json.dumps({'success': True})
 
 
+def postBatchHandler(args):
+    try:
+        tests = json.loads(args['tests'][0].decode('ascii', 'ignore'))
+        jobs = [(str(userID), int(historyCount), int(testID)) for (userID, historyCount, testID) in tests]
+    except KeyError as e:
+        return json.dumps({'success': False, 'missing': str(e)})
+    except (ValueError, TypeError) as e:
+        return json.dumps({'success': False, 'value error': str(e)})
+
+    queued = 0
+    for job in jobs:
+        if not analysisPool.submit(job):
+            break
+        queued += 1
+
+    LOG_ACTION(logger, 'Returning for POST analyzeBatch of {} tests, {} queued ***'.format(len(jobs), queued))
+
+    if queued < len(jobs):
+        return json.dumps({'success': False, 'error': 'analyzer busy', 'queued': queued})
+    return json.dumps({'success': True, 'queued': queued})
+
+
 class Results(tornado.web.RequestHandler):
 
     @tornado.web.asynchronous
@@ -848,11 +858,15 @@ def getPacketMetaInfo():
 def main():
     # PRINT_ACTION('Checking tshark version', 0)
     # TH.checkTsharkVersion('1.8')
-    global db
+    global db, analysisPool
 
     configs = Configs()
     configs.set('xputInterval', 0.25)
     configs.set('alpha', 0.95)
+    configs.set('analyzerWorkers', 4)
+    configs.set('analyzerQueue', 5000)
+    configs.set('analyzerBatch', 50)
+    configs.set('analyzerTimeout', 300)
     configs.set('mainPath', '/var/spool/wehe/')
     configs.set('resultsFolder', 'replay/')
     configs.set('logsPath', '/tmp/')
@@ -880,9 +894,10 @@ def main():
 
     gevent.Greenlet.spawn(error_logger, Configs().get('errorsLog'))
 
-    g = gevent.Greenlet.spawn(jobDispatcher, POSTq)
-
-    g.start()
+    analysisPool = AnalysisPool(configs.get('tmpResultsFolder'), configs.get('alpha'), configs.get('analyzerWorkers'),
+                                configs.get('analyzerQueue'), configs.get('analyzerBatch'), errorlog_q,
+                                configs.get('analyzerTimeout'))
+    analysisPool.run()
 
     if configs.is_given('analyzer_tls_port') and configs.is_given('certs_folder'):
         certs_folder = configs.get('certs_folder')
@@ -0,0 +1,269 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: index of the parsed replays under replay_parent_folder
+
+Every folder of replay_parent_folder is one replay, e.g. Amazon_11252020/. The catalog keeps, per
+folder: its name, base name and date version (Amazon, 2020-11-25), the parsed files in it with
+their sizes, and once known the replayName inside the files, their number of packets and protocols.
+
+Replay names resolve with a dictionary lookup:
+    - the folder with exactly that name ('-' and '_' are the same, e.g. Amazon-11252020)
+    - otherwise, for a name without a date (e.g. Amazon), the latest version of exactly that
+      base name that has server files. AmazonRandom_* is never picked for Amazon.
+
+The catalog is built once at startup and refreshed by a stat based scan: only folders whose mtime
+or files changed are read again. It is saved as JSON (e.g. in replay_cache_folder), so packet counts
+learnt from pickles survive restarts.
+
+Usage:
+    python replay_catalog.py --replay_parent_folder=../replayTraces/ [--resolve=Amazon]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, json
+from python_lib import *
+from replay_trace import TraceFile
+
+CATALOG_VERSION = 1
+
+FILE_SUFFIXES = ['_server_all.wtrace', '_server_all.pickle',
+                 '_client_all.wtrace', '_client_all.pickle', '_client_all.json']
+
+
+def split_version(name):
+    '''
+    'Amazon_11252020' --> ('Amazon', '20201125'). The version is None if name does not end with a
+    MMDDYYYY date, and is sortable otherwise.
+    '''
+    base, sep, date = name.rpartition('_')
+    if sep and len(date) == 8 and date.isdigit():
+        return base, date[4:] + date[:4]
+    return name, None
+
+
+class CatalogEntry(object):
+    '''
+    One replay folder.
+        self.files[suffix] = (path, size, mtime), for every suffix of FILE_SUFFIXES found in the folder
+    '''
+
+    def __init__(self, name, folder, mtime):
+        self.name = name
+        self.base, self.version = split_version(name)
+        self.folder = folder
+        self.mtime = mtime
+        self.files = {}
+        self.replayName = None
+        self.packets = None
+        self.protocols = None
+
+    def server_file(self, serialize='pickle'):
+        '''
+        The server file to load, in the requested format if the folder has it, otherwise the pickle,
+        otherwise any other server file (e.g. folders that only ship .wtrace files)
+        '''
+        suffixes = ['_server_all.' + serialize, '_server_all.pickle'] + \
+                   [suffix for suffix in FILE_SUFFIXES if suffix.startswith('_server_all.')]
+        for suffix in suffixes:
+            if suffix in self.files:
+                return self.files[suffix][0]
+        return None
+
+    def set_stats(self, replayName, packets, protocols):
+        self.replayName = replayName
+        self.packets = packets
+        self.protocols = protocols
+
+    def to_json(self):
+        return {'name': self.name, 'folder': self.folder, 'mtime': self.mtime, 'files': self.files,
+                'replayName': self.replayName, 'packets': self.packets, 'protocols': self.protocols}
+
+    @staticmethod
+    def from_json(obj):
+        entry = CatalogEntry(obj['name'], obj['folder'], obj['mtime'])
+        entry.files = dict((suffix, tuple(f)) for (suffix, f) in obj['files'].items())
+        entry.set_stats(obj['replayName'], obj['packets'], obj['protocols'])
+        return entry
+
+
+class ReplayCatalog(object):
+    '''
+    self.index = (entries, latest), swapped in one assignment by scan(), so a scan can run in a
+    thread while resolve() is being called:
+        entries[folder name] = CatalogEntry
+        latest[base name]    = folder name of the latest version with server files
+    '''
+
+    def __init__(self, parent_folder, catalog_file=None):
+        self.parent_folder = os.path.abspath(parent_folder)
+        self.catalog_file = catalog_file
+        self.index = ({}, {})
+        self.dirty = False
+        if catalog_file and os.path.isfile(catalog_file):
+            self.load(catalog_file)
+
+    def load(self, catalog_file):
+        try:
+            with open(catalog_file, 'r') as f:
+                saved = json.load(f)
+        except ValueError:
+            return
+        if saved.get('version') != CATALOG_VERSION or saved.get('parent_folder') != self.parent_folder:
+            return
+        entries = dict((obj['name'], CatalogEntry.from_json(obj)) for obj in saved['entries'])
+        self.index = (entries, self.latest_versions(entries))
+
+    def save(self):
+        if not self.catalog_file:
+            return
+        folder = os.path.dirname(self.catalog_file)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        entries = self.index[0]
+        saved = {'version': CATALOG_VERSION, 'parent_folder': self.parent_folder,
+                 'entries': [entries[name].to_json() for name in sorted(entries)]}
+        tmpPath = '{}.{}.tmp'.format(self.catalog_file, os.getpid())
+        with open(tmpPath, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmpPath, self.catalog_file)
+
+    def scan(self):
+        '''
+        Brings the catalog up to date with replay_parent_folder. Returns the names of the folders
+        that were added, changed or removed.
+        '''
+        old = self.index[0]
+        entries = {}
+        changed = []
+
+        for dirEntry in os.scandir(self.parent_folder):
+            if not dirEntry.is_dir():
+                continue
+            mtime = dirEntry.stat().st_mtime
+            entry = old.get(dirEntry.name)
+            if entry is None or entry.mtime != mtime or not self.files_unchanged(entry):
+                entry = self.read_folder(dirEntry.name, dirEntry.path, mtime, entry)
+                changed.append(dirEntry.name)
+            entries[dirEntry.name] = entry
+
+        changed += [name for name in old if name not in entries]
+
+        if changed:
+            self.index = (entries, self.latest_versions(entries))
+        if changed or self.dirty:
+            self.dirty = False
+            self.save()
+        return changed
+
+    def files_unchanged(self, entry):
+        for (path, size, mtime) in entry.files.values():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if stat.st_size != size or stat.st_mtime != mtime:
+                return False
+        return True
+
+    def read_folder(self, name, folder, mtime, previous=None):
+        entry = CatalogEntry(name, folder, mtime)
+        for file in os.listdir(folder):
+            for suffix in FILE_SUFFIXES:
+                if file.endswith(suffix):
+                    path = os.path.join(folder, file)
+                    stat = os.stat(path)
+                    entry.files[suffix] = (path, stat.st_size, stat.st_mtime)
+
+        serverFiles = [entry.files.get(suffix) for suffix in FILE_SUFFIXES if '_server_' in suffix]
+        if previous is not None and serverFiles == [previous.files.get(suffix) for suffix in FILE_SUFFIXES
+                                                    if '_server_' in suffix]:
+            entry.set_stats(previous.replayName, previous.packets, previous.protocols)
+        elif '_server_all.wtrace' in entry.files:
+            # Cheap for trace files, the metadata has it all. Pickles only get it once loaded
+            # e.g. a trace of an older format version, it is refused when loaded
+            try:
+                trace = TraceFile(entry.files['_server_all.wtrace'][0])
+            except ValueError:
+                return entry
+            meta = trace.meta
+            trace.close()
+            entry.set_stats(meta['replayName'], meta['packets'], protocols_of(meta['tcp'], meta['udp']))
+        return entry
+
+    def latest_versions(self, entries):
+        latest = {}
+        for name, entry in entries.items():
+            if entry.version is None or entry.server_file() is None:
+                continue
+            if entry.base not in latest or entries[latest[entry.base]].version < entry.version:
+                latest[entry.base] = name
+        return latest
+
+    def resolve(self, replayName):
+        '''
+        Returns the CatalogEntry replayName refers to, or None
+        '''
+        name = replayName.replace('-', '_')
+        entries, latest = self.index
+        if name in entries:
+            return entries[name]
+        if name in latest:
+            return entries[latest[name]]
+        return None
+
+    def set_stats(self, entry, replayName, packets, protocols):
+        '''
+        Records what loading the files of entry told us, it is saved with the next scan
+        '''
+        if (entry.replayName, entry.packets, entry.protocols) != (replayName, packets, protocols):
+            entry.set_stats(replayName, packets, protocols)
+            self.dirty = True
+
+    def __len__(self):
+        return len(self.index[0])
+
+
+def protocols_of(tcp, udp):
+    return ','.join(protocol for (protocol, Q) in [('tcp', tcp), ('udp', udp)] if Q)
+
+
+def main():
+    configs = Configs()
+    configs.set('replay_parent_folder', '../replayTraces/')
+    configs.read_args(sys.argv)
+
+    catalog = ReplayCatalog(configs.get('replay_parent_folder'))
+    catalog.scan()
+    entries, latest = catalog.index
+
+    if configs.is_given('resolve'):
+        entry = catalog.resolve(configs.get('resolve'))
+        print(entry.folder if entry is not None else None)
+        return
+
+    for name in sorted(entries):
+        entry = entries[name]
+        print('\t'.join(map(str, [name, entry.base, entry.version, entry.replayName, entry.packets,
+                                  entry.protocols, sum(f[1] for f in entry.files.values()),
+                                  latest.get(entry.base) == name])))
+
+
+if __name__ == "__main__":
+    main()
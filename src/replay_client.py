@@ -48,7 +48,7 @@ Optional arguments:
     
     serialize: parser serialized client/server object using both pickle and JSON.
             This tells the client which one to use. Apparantly for the android app
-            we need to use JSON.
+            we need to use JSON. wtrace uses the binary trace files (see replay_trace.py).
     
     resultsFolder: the folder where all tcpdump and jitter files are stored in.
     
@@ -89,6 +89,7 @@ Exit codes:
 import sys, subprocess, socket, time, numpy, threading, select, pickle, queue, urllib.request, urllib.parse, \
     urllib.error, urllib.request, urllib.error, urllib.parse
 from python_lib import *
+from replay_trace import load_client_trace
 
 DEBUG = 4
 
@@ -178,19 +179,20 @@ class tcpClient(object):
 
         if addInfo and self.addHeader:
             if self.replayName.endswith('-random'):
-                info = 'X-rr;{};{};{};X-rr'.format(self.publicIP, name2code(self.replayName, 'name'), self.csp)
+                info = 'X-rr;{};{};{};X-rr'.format(self.publicIP, name2code(self.replayName, 'name'),
+                                                   self.csp).encode()
                 tcp.payload = info + tcp.payload[len(info):]
 
-            elif tcp.payload[:3] == 'GET':
-                tcp.payload = (tcp.payload.partition('\r\n')[0]
+            elif tcp.payload[:3] == b'GET':
+                tcp.payload = (tcp.payload.partition(b'\r\n')[0]
                                + '\r\nX-rr: {};{};{}\r\n'.format(self.publicIP, name2code(self.replayName, 'name'),
-                                                                 self.csp)
-                               + tcp.payload.partition('\r\n')[2])
+                                                                 self.csp).encode()
+                               + tcp.payload.partition(b'\r\n')[2])
 
         try:
             # replace your payload here:
             # tcp.payload = tcp.payload.replace('.us.aiv-cdn.net', 'not-a-real-domain.net')
-            self.sock.sendall(bytes.fromhex(tcp.payload))
+            self.sock.sendall(tcp.payload)
             activityQ.put(1)
         except:
             print("\n\nUnexpected error happened 1:", sys.exc_info()[1], tcp.c_s_pair)
@@ -277,7 +279,7 @@ class udpClient(object):
 
     def send_udp_packet(self, udp, dstAddress):
         # udp.payload = udp.payload.replace('googlevideo','gaoglevideo')
-        self.sock.sendto(bytes.fromhex(udp.payload), dstAddress)
+        self.sock.sendto(udp.payload, dstAddress)
         activityQ.put(1)
         if DEBUG == 2: print("sent:", udp.payload, 'to', dstAddress, 'from', self.sock.getsockname())
         if DEBUG == 3: print("sent:", len(udp.payload), 'to', dstAddress, 'from', self.sock.getsockname())
@@ -355,12 +357,16 @@ class Sender(object):
         return newpayload
 
     def cModify(self, clientQ):
+        # Payloads are bytes, the helpers above work on latin-1 strings
+        if self.action in ['Random', 'Invert', 'ReplaceW', 'ReplaceR', 'ReplaceI']:
+            payload = clientQ[self.mpacNum - 1].payload.decode('latin-1')
+
         if self.action == 'Random':
-            clientQ[self.mpacNum - 1].payload = self.randomize(clientQ[self.mpacNum - 1].payload)
+            clientQ[self.mpacNum - 1].payload = self.randomize(payload).encode('latin-1')
 
         elif self.action == 'Invert':
             # print('len pac', len(clientQ[self.mpacNum - 1].payload))
-            clientQ[self.mpacNum - 1].payload = self.bitInv(clientQ[self.mpacNum - 1])
+            clientQ[self.mpacNum - 1].payload = self.bitInv(payload).encode('latin-1')
             # clientQ[self.mpacNum - 1].payload = self.bitInv(clientQ[self.mpacNum - 1].payload[:260]) + clientQ[self.mpacNum - 1].payload[260:]
             # clientQ[self.mpacNum - 1].payload = clientQ[self.mpacNum - 1].payload[:260] + self.bitInv(clientQ[self.mpacNum - 1].payload[260:])
         elif self.action == 'Delete':
@@ -371,7 +377,7 @@ class Sender(object):
             else:
                 print('\r\n Can not delete the first packet, making it a single byte packet')
                 rstring = ''.join(random.choice(string.ascii_letters + string.digits) for x in range(1))
-                preQ = RequestSet(rstring, clientQ[0].c_s_pair, None, clientQ[0].timestamp)
+                preQ = RequestSet(rstring.encode(), clientQ[0].c_s_pair, None, clientQ[0].timestamp)
                 clientQ.insert(0, preQ)
 
         elif self.action == 'Prepend':
@@ -380,23 +386,23 @@ class Sender(object):
             random.seed(self.action)
             rstring = ''.join(random.choice(string.ascii_letters + string.digits) for x in range(preLen))
             for i in range(preNum):
-                preQ = RequestSet(rstring, clientQ[0].c_s_pair, None, clientQ[0].timestamp)
+                preQ = RequestSet(rstring.encode(), clientQ[0].c_s_pair, None, clientQ[0].timestamp)
                 clientQ.insert(0, preQ)
             # print '\n\t Client Q after prepending ::',TMPclientQ
 
         elif self.action == 'ReplaceW':
             regions = self.spec
-            clientQ[self.mpacNum - 1].payload = self.multiReplace(clientQ[self.mpacNum - 1].payload, regions, '')
+            clientQ[self.mpacNum - 1].payload = self.multiReplace(payload, regions, '').encode('latin-1')
 
         elif self.action == 'ReplaceR':
             regions = self.spec
-            rpayload = self.randomize(clientQ[self.mpacNum - 1].payload)
-            clientQ[self.mpacNum - 1].payload = self.multiReplace(clientQ[self.mpacNum - 1].payload, regions, rpayload)
+            rpayload = self.randomize(payload)
+            clientQ[self.mpacNum - 1].payload = self.multiReplace(payload, regions, rpayload).encode('latin-1')
 
         elif self.action == 'ReplaceI':
             regions = self.spec
-            rpayload = self.bitInv(clientQ[self.mpacNum - 1].payload)
-            clientQ[self.mpacNum - 1].payload = self.multiReplace(clientQ[self.mpacNum - 1].payload, regions, rpayload)
+            rpayload = self.bitInv(payload)
+            clientQ[self.mpacNum - 1].payload = self.multiReplace(payload, regions, rpayload).encode('latin-1')
 
         else:
             print('\n\t Unrecognized Action,', self.action, ' No ACTION taken HERE in CModify')
@@ -664,15 +670,24 @@ class SideChannel(object):
         self.historyCount = permaData.historyCount
         # Added default client realIP to be '127.0.0.1', the client needs to find out whether it is behind a proxy
         # and what is the proxy IP that used to communicate with server, and send it as the realIP attribute to server
+        # '+queue' opts in to the server's admission queue (see ask4Permision)
         self.send_object(';'.join(
             [self.id, Configs().get('testID'), replayName, str(extraString), str(self.historyCount), str(endOfTest),
-             realIP, '1.0']))
+             realIP, '1.0+queue']))
 
         if Configs().get('byExternal') is False:
             permaData.updateHistoryCount()
 
     def ask4Permision(self):
-        return self.receive_object().split(';')
+        '''
+        Waits while the server keeps the replay in its admission queue (0;4;<estimated seconds>)
+        '''
+        permission = self.receive_object().split(';')
+        while permission[:2] == ['0', '4']:
+            PRINT_ACTION('Server busy, waiting in queue. Estimated start in {} seconds'.format(permission[2]), 1,
+                         action=False)
+            permission = self.receive_object().split(';')
+        return permission
 
     def notifier(self, udpSenderCount):
         '''
@@ -831,7 +846,7 @@ def load_Q(serialize='pickle', skipTCP=False):
     
     NOTE: the parser encodes all packet payloads into hex before serializing them.
           So we need to decode them before starting the replay, hence the loop at
-          the end of this function.
+          the end of this function. Trace files (serialize=wtrace) already hold bytes.
     '''
     for file in os.listdir(Configs().get('pcap_folder')):
         if file.endswith('_client_all.' + serialize):
@@ -842,9 +857,12 @@ def load_Q(serialize='pickle', skipTCP=False):
         Q, udpClientPorts, tcpCSPs, replayName = pickle.load(open(pickle_file, 'rb'))
     elif serialize == 'json':
         Q, udpClientPorts, tcpCSPs, replayName = json.load(open(pickle_file, 'rb'), cls=TCPjsonDecoder_client)
+    elif serialize == 'wtrace':
+        Q, udpClientPorts, tcpCSPs, replayName = load_client_trace(pickle_file)
 
     for p in Q:
-        p.payload = p.payload
+        if isinstance(p.payload, str):
+            p.payload = bytes.fromhex(p.payload)
 
     # If skipTCP is True, clear things from tcp packets
     if skipTCP:
@@ -942,6 +960,9 @@ def run(configs=Configs(), pcapdir=None, cmpacNum=-1, caction=None, cspec=None,
             PRINT_ACTION('No permission: another client with same IP address is running. Wait for them to finish!', 1,
                          action=False, exit=False)
             os._exit(3)
+        elif permission[1] == '3':
+            PRINT_ACTION('Server overloaded or at capacity. Try again later!', 1, action=False, exit=False)
+            os._exit(3)
     else:
         sideChannel.publicIP = permission[1]
         bucketNum = permission[2]
@@ -58,6 +58,7 @@ import pickle, copy, re, random, string, hashlib
 import ipaddress
 import binascii
 from python_lib import *
+from replay_trace import dump_client_trace, dump_server_trace
 
 DEBUG = 2
 
@@ -944,6 +945,8 @@ def run(*args):
                 open((pcap_file + '_server_all.pickle'), "wb"), 2)
     json.dump((clientQ, udpClientPorts, list(tcpCSPs), replay_name), open((pcap_file + '_client_all.json'), "w"),
               cls=TCP_UDPjsonEncoder)
+    dump_client_trace(pcap_file + '_client_all.wtrace', clientQ, udpClientPorts, list(tcpCSPs), replay_name)
+    dump_server_trace(pcap_file + '_server_all.wtrace', serverQ, LUT, getLUT, udpServers, tcpServerPorts, replay_name)
 
     PRINT_ACTION('Stats:', 0, action=True)
     serverSideCount = {}
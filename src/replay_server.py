@@ -28,6 +28,71 @@ Optional arguments:
     original_ports: if true, uses same server ports as seen in the original pcap
                       default: False
 
+    serialize: pickle or wtrace (binary trace files, see replay_trace.py). Folders without
+               a trace file fall back to the pickle.
+                      default: pickle
+
+    coalesceResponses: if true and timing is off, the TCP responses of a response set are sent
+                       together with one sendmsg. The first response of every response set is always
+                       sent on its own. Paced replays always send one response per send, so the
+                       packet boundaries on the wire stay those of the trace.
+                      default: False
+
+    workers: number of replay server processes sharing the ports through SO_REUSEPORT. Clients
+             are pinned to a worker by their IP, so every worker is a complete, independent server
+             (requires original_ports=True). Worker i exports its metrics on port 9990 + i.
+                      default: 1
+
+    mmapReplays: if true, replay payloads are served from read-only mmaps of trace files (pickles
+                 are converted once into replay_cache_folder), so several server processes share
+                 a single copy of them.
+                      default: False
+
+    replayCacheMB: memory budget for replays loaded on demand (approximated by their file sizes).
+                   When over budget, the least recently used replays no client is replaying are
+                   evicted. Replays from pcap_folder are always kept. 0 means no limit.
+                      default: 4096
+
+    replay_parent_folder: folder with one sub folder per replay, to load replays from on demand.
+                          Replay names resolve through a catalog of it (see replay_catalog.py),
+                          rescanned every catalogScanInterval seconds (default: 60).
+
+    systemStatInterval, systemStatAlpha: the server load used to turn clients away (and exported
+                                         to Prometheus) is sampled in the background every
+                                         systemStatInterval seconds and smoothed with an EWMA
+                                         giving systemStatAlpha weight to the newest sample.
+                      default: 1, 0.3
+
+    admission: how replays are admitted once the server is not overloaded.
+                 static:   as many replays as clients ask for
+                 capacity: at most maxReplays replays and capacityMbps of committed bandwidth (each
+                           replay commits its bytes over its duration). Clients that support it
+                           wait in a queue of at most admissionQueue replays, for at most
+                           admissionMaxWait seconds, and are sent their estimated start time.
+                      default: static (capacity: 2000 Mbps, 200 replays, 50 queued, 120 seconds)
+
+    sharedCapture: one tcpdump for all replays, split per client IP and replay ports by capture.py,
+                   instead of one tcpdump per replay. Packets are captured up to captureSnaplen bytes
+                   (0: whole packets), and only those matching captureFilter (a tcpdump filter) if given.
+                   captureSnaplen=128 only copies what clean_pcap keeps out of the kernel, but the raw
+                   dumps kept for ContentModification replays then lose their payloads too.
+                   With several workers only worker 0 captures, the others reach it through the unix
+                   socket captureControl (default: mainPath/capture.sock).
+                   Off by default until it has been measured under production load.
+                      default: False, 0, ''
+
+    postprocessWorkers, postprocessBacklog, postprocessTimeout: pcap cleaning and chown of the results
+                     of finished replays run in postprocessWorkers worker processes (see postprocess.py).
+                     Pending jobs are kept in postprocessFolder (default: mainPath/postprocess/) and
+                     run again after a restart. While more than postprocessBacklog replays wait,
+                     new replays are turned away as overloaded. A job running longer than
+                     postprocessTimeout seconds is killed (and retried) with its worker process.
+                      default: 2, 1000, 600
+
+    whoisCacheHours: how long the ISP of a whois range is kept (see isp_lookup.py), the cache is
+                     saved in replay_cache_folder/whois.json
+                      default: 168
+
 Example:
     sudo python replay_server.py --VPNint=tun0 --NoVPNint=eth0 --pcap_folder=[] --resultsFolder=[]
 
@@ -44,15 +109,19 @@ import linecache
 
 gevent.monkey.patch_all()
 from multiprocessing_logging import install_mp_handler
-import pickle, atexit, re, urllib.request, urllib.error, urllib.parse, base64, reverse_geocode, hashlib
+import pickle, atexit, re, urllib.request, urllib.error, urllib.parse, base64, hashlib
 from python_lib import *
+from replay_trace import load_server_trace, dump_server_trace, TRACE_VERSION
+from replay_catalog import ReplayCatalog, protocols_of
+from isp_lookup import WhoisCache
+from geo_lookup import GeoService
+from postprocess import PostProcessor, orphaned_journals
+import result_files as RF
+from capture import CaptureEngine, CaptureRelay, CaptureClient, SharedDump
 from datetime import datetime
-from timezonefinder import TimezoneFinder
-from dateutil import tz
 import subprocess
-import gevent, gevent.pool, gevent.server, gevent.queue, gevent.select, gevent.ssl
-from gevent.lock import RLock
-import netaddr as neta
+import gevent, gevent.pool, gevent.server, gevent.queue, gevent.select, gevent.ssl, gevent.event
+import heapq, collections, itertools
 import signal
 from contextlib import contextmanager
 from threading import Timer
@@ -60,6 +129,12 @@ from prometheus_client import start_http_server, Summary, Counter, Gauge
 
 DEBUG = 5
 
+# Maximum number of buffers in one sendmsg call (UIO_MAXIOV on Linux)
+IOV_MAX = 1024
+
+# Capability of clients that can wait in the admission queue (0;4;<seconds> replies)
+QUEUE_CAPABILITY = 'queue'
+
 logger = logging.getLogger('replay_server')
 
 # Prometheus metrics
@@ -68,6 +143,15 @@ REPLAY_ERROR_COUNT = Counter("replay_erros_total", "Total Number of Errors on th
 ATTEMPTED_REPLAY_COUNT = Counter("attemped_replay_count_total", "Total Number of Connections made to the Sidechannel")
 CERT_EXPIRATION_DAYS = Gauge('days_until_cert_expiration', 'Days until the self-signed certificate expires')
 DISK_USAGE = Gauge('disk_usage', '% of disk used')
+CPU_USAGE = Gauge('cpu_usage', '% of CPU used (smoothed)')
+MEMORY_USAGE = Gauge('memory_usage', '% of memory used (smoothed)')
+UPLOAD_MBPS = Gauge('upload_mbps', 'Upload bandwidth in Mbps (smoothed)')
+ADMISSION_ACTIVE = Gauge('admission_active_replays', 'Number of replays admitted and running')
+ADMISSION_QUEUED = Gauge('admission_queued_replays', 'Number of replays waiting to be admitted')
+ADMISSION_WAIT = Summary('admission_wait_seconds', 'Time queued replays waited before starting')
+UDP_PACING_ERROR = Summary('udp_pacing_error_seconds', 'Mean absolute pacing error of the UDP flows')
+REPLAY_CACHE_BYTES = Gauge('replay_cache_bytes', 'Size of the files of the loaded replays')
+REPLAY_CACHE_EVICTIONS = Counter('replay_cache_evictions_total', 'Number of replays evicted from the replay cache')
 
 
 @contextmanager
@@ -205,9 +289,11 @@ class ClientObj(object):
             decisionsFolder = self.targetFolder + 'decisions/'
             os.makedirs(decisionsFolder)
 
-    def setDump(self, dumpName):
+    def setDump(self, dumpName, captureEngine=None, ports=None):
         self.dumpName = dumpName
-        if Configs().get('tcpdumpInt') == "default":
+        if captureEngine is not None:
+            self.dump = SharedDump(captureEngine, dump_name=dumpName, targetFolder=self.tcpdumpsFolder, ports=ports)
+        elif Configs().get('tcpdumpInt') == "default":
             self.dump = tcpdump(dump_name=dumpName, targetFolder=self.tcpdumpsFolder)
         else:
             self.dump = tcpdump(dump_name=dumpName, targetFolder=self.tcpdumpsFolder,
@@ -233,9 +319,399 @@ class ClientObj(object):
                               self.iperfRate, time.time() - self.startTime, self.clientTime, self.mobileStats]))
 
 
+class ReplayIndex(object):
+    '''
+    Everything the TCP and UDP servers need to identify a connection of one replay,
+    computed once in load_server_replay instead of on every accept:
+        self.prefixes : hash of the first hashSampleSize chars of a first packet --> (replayName, csp)
+        self.tcpCSP   : the only csp of the replay (one connection per replay) and its Q in self.tcpQ
+        self.udpQ     : the Q of the only (serverPort, clientPort) pair, once servers are merged
+        self.size     : size of the replay file, what ReplayCache counts against its budget
+        self.packets, self.bytes, self.duration : what the server sends and for how long (see replay_stats),
+                        self.rate is the resulting bandwidth in Mbps
+    '''
+
+    def __init__(self, replayName, tcpQ, udpQ, LUT, size=0, stats=(None, 0, 0.0)):
+        self.replayName = replayName
+        self.prefixes = LUT.get('tcp', {})
+        self.LUT = LUT
+        self.size = size
+        self.csps = list(tcpQ)
+        self.packets, self.bytes, self.duration = stats
+        self.rate = self.bytes * 8 / 1000000.0 / max(self.duration, 1.0)
+        self.protocols = protocols_of(tcpQ, udpQ)
+
+        self.tcpCSP = next(iter(tcpQ), None)
+        self.tcpQ = tcpQ[self.tcpCSP] if self.tcpCSP is not None else None
+
+        # udpQ is only keyed by serverPort/clientPort after merge_servers (original_ips off)
+        self.udpServerPort = None
+        self.udpClientPort = None
+        self.udpQ = None
+        serverPort = next(iter(udpQ), None)
+        if serverPort is not None and isinstance(udpQ[serverPort], dict):
+            self.udpServerPort = serverPort
+            self.udpClientPort = next(iter(udpQ[serverPort]))
+            self.udpQ = udpQ[serverPort][self.udpClientPort]
+
+
+class ReplayCache(object):
+    '''
+    Loads the replays clients ask for on demand and keeps them within a memory budget.
+
+    The replay files are read and decoded in the hub's thread pool, so a cold load does not stall
+    the other clients, and are only installed in the shared dicts back on the event loop.
+    Concurrent requests for a replay that is being loaded wait for the same load.
+
+    Replay names are resolved through the ReplayCatalog (see replay_catalog.py).
+
+    Every side channel holds a reference on its replay while it runs (see acquire), and when
+    over budget the least recently used replays without references are evicted. Replays
+    preloaded from pcap_folder are pinned, the servers for their ports were created at startup.
+    '''
+
+    def __init__(self, Qs, LUT, getLUT, replayIndex, allUDPservers, udpSenderCounts, budget, catalog=None):
+        self.catalog = catalog
+        self.Qs = Qs
+        self.LUT = LUT
+        self.getLUT = getLUT
+        self.replayIndex = replayIndex
+        self.allUDPservers = allUDPservers
+        self.udpSenderCounts = udpSenderCounts
+        self.budget = budget
+        self.refs = collections.Counter()  # self.refs[replayName] = number of side channels using it
+        self.lastUsed = collections.OrderedDict()  # self.lastUsed[replayName] = time, least recent first
+        self.loading = {}  # self.loading[folder] = AsyncResult of the load in progress
+        self.holders = {}  # self.holders[(protocol, hash)] = loaded replays with that hash, in load order
+        self.pinned = set(replayIndex)
+        for replayName in replayIndex:
+            self.touch(replayName)
+            self.add_holder(replayName)
+
+    def add_holder(self, replayName):
+        index = self.replayIndex[replayName]
+        for protocol in index.LUT:
+            for theHash in index.LUT[protocol]:
+                self.holders.setdefault((protocol, theHash), []).append(replayName)
+
+    def loaded(self, replayName):
+        return (replayName in self.Qs['tcp']) or (replayName in self.Qs['udp'])
+
+    def size(self):
+        return sum(index.size for index in self.replayIndex.values())
+
+    def touch(self, replayName):
+        self.lastUsed[replayName] = time.time()
+        self.lastUsed.move_to_end(replayName)
+
+    def acquire(self, replayName):
+        '''
+        Loads replayName if needed and takes a reference on it, to be released once the replay is over.
+        Returns the name the replay is loaded under (see ReplayCatalog.resolve), or None if it could
+        not be loaded.
+        '''
+        if not self.loaded(replayName):
+            entry = self.catalog.resolve(replayName) if self.catalog is not None else None
+            if entry is None:
+                return None
+            if entry.replayName is not None and self.loaded(entry.replayName):
+                replayName = entry.replayName
+            else:
+                replayName = self.load(entry)
+                if replayName is None:
+                    return None
+        self.refs[replayName] += 1
+        self.touch(replayName)
+        return replayName
+
+    def release(self, replayName):
+        self.refs[replayName] -= 1
+        if self.refs[replayName] <= 0:
+            del self.refs[replayName]
+        if replayName in self.lastUsed:
+            self.touch(replayName)
+
+    def load(self, entry):
+        if entry.folder in self.loading:
+            return self.loading[entry.folder].get()
+
+        result = gevent.event.AsyncResult()
+        self.loading[entry.folder] = result
+        replayName = None
+        try:
+            replay = gevent.get_hub().threadpool.apply(read_server_replay, (
+                entry.folder, Configs().get('serialize'), entry.server_file(Configs().get('serialize'))))
+            if replay is not None:
+                install_replay(replay, self.Qs, self.LUT, self.getLUT, self.replayIndex, self.allUDPservers,
+                               self.udpSenderCounts)
+                replayName = replay[4]
+                self.touch(replayName)
+                self.add_holder(replayName)
+                self.catalog.set_stats(entry, replayName, self.replayIndex[replayName].packets,
+                                       self.replayIndex[replayName].protocols)
+        except Exception as e:
+            LOG_ACTION(logger, 'Failed loading {}: {}'.format(entry.folder, e), level=logging.ERROR, doPrint=False)
+        finally:
+            del self.loading[entry.folder]
+            result.set(replayName)
+
+        REPLAY_CACHE_BYTES.set(self.size())
+        self.evict(keep=replayName)
+        return replayName
+
+    def evictable(self, replayName):
+        return (replayName in self.replayIndex) and (replayName not in self.pinned) and (self.refs[replayName] <= 0)
+
+    def evict(self, keep=None):
+        '''
+        Evicts least recently used replays until within budget
+        '''
+        if self.budget <= 0:
+            return []
+        total = self.size()
+        evicted = []
+        for replayName in list(self.lastUsed):
+            if total <= self.budget:
+                break
+            if replayName != keep and self.evictable(replayName):
+                total -= self.remove(replayName)
+                evicted.append(replayName)
+        return evicted
+
+    def evict_idle(self, idleTime):
+        '''
+        Evicts the replays nobody used in the last idleTime seconds
+        '''
+        evicted = []
+        for replayName in list(self.lastUsed):
+            if time.time() - self.lastUsed[replayName] < idleTime:
+                break
+            if self.evictable(replayName):
+                self.remove(replayName)
+                evicted.append(replayName)
+        return evicted
+
+    def remove(self, replayName):
+        index = self.replayIndex.pop(replayName)
+        self.lastUsed.pop(replayName, None)
+        self.Qs['tcp'].pop(replayName, None)
+        self.Qs['udp'].pop(replayName, None)
+        self.udpSenderCounts.pop(replayName, None)
+
+        # The first replay to claim a hash owns the LUT entry. When the owner goes, the entry is
+        # handed to the next loaded replay with the same hash, and only dropped with the last one.
+        for protocol in index.LUT:
+            for theHash in index.LUT[protocol]:
+                holders = self.holders.get((protocol, theHash), [])
+                if replayName in holders:
+                    holders.remove(replayName)
+                if self.LUT.get(protocol, {}).get(theHash) != index.LUT[protocol][theHash]:
+                    continue
+                if holders:
+                    self.LUT[protocol][theHash] = self.replayIndex[holders[0]].LUT[protocol][theHash]
+                else:
+                    del self.LUT[protocol][theHash]
+                    self.holders.pop((protocol, theHash), None)
+        for csp in index.csps:
+            if (replayName, csp) in self.getLUT:
+                del self.getLUT[(replayName, csp)]
+
+        REPLAY_CACHE_EVICTIONS.inc()
+        REPLAY_CACHE_BYTES.set(self.size())
+        LOG_ACTION(logger, 'Evicted replay {} ({} bytes)'.format(replayName, index.size), indent=1, action=False)
+        return index.size
+
+
+class AdmissionTicket(object):
+    '''
+    One replay asking to run: its estimated bandwidth (Mbps) and duration (seconds).
+    self.state is 'queued', 'granted' or 'rejected', and self.event is set when it leaves the queue.
+    '''
+
+    def __init__(self, replayName, rate, duration):
+        self.replayName = replayName
+        self.rate = rate
+        self.duration = duration
+        self.state = None
+        self.reason = ''
+        self.requested = time.time()
+        self.started = None
+        self.event = gevent.event.Event()
+
+    def set_state(self, state, reason=''):
+        self.state = state
+        self.reason = reason
+        if state == 'granted':
+            self.started = time.time()
+        if state != 'queued':
+            self.event.set()
+
+
+class AdmissionController(object):
+    '''
+    Decides whether a replay can start now (admission=static, the default).
+
+    Replays are turned away while the server is overloaded: memory or disk above 95% or
+    upload above 2000 Mbps, as measured by the SystemStatSampler, or too many finished replays
+    waiting for post-processing.
+    Every granted ticket has to be released once its replay is over.
+    '''
+
+    def __init__(self, systemStat, postprocessor=None, maxMemPercent=95, maxDiskPercent=95, maxUpload=2000):
+        self.systemStat = systemStat
+        self.postprocessor = postprocessor
+        self.maxMemPercent = maxMemPercent
+        self.maxDiskPercent = maxDiskPercent
+        self.maxUpload = maxUpload
+        self.active = {}  # self.active[ticket] = rate
+
+    def overloaded(self):
+        cpuPercent, memPercent, diskPercent, upLoad = self.systemStat.latest()
+        if memPercent > self.maxMemPercent or diskPercent > self.maxDiskPercent or upLoad > self.maxUpload:
+            return 'Server Overloaded with CPU Usage {}% Memory Usage {}% Upload Bandwidth Usage {}Mbps'.format(
+                cpuPercent, memPercent, upLoad)
+        if self.postprocessor is not None and self.postprocessor.backlogged():
+            return 'Server Overloaded with {} replays waiting for post-processing'.format(
+                self.postprocessor.backlog())
+        return ''
+
+    def request(self, ticket, canWait=False):
+        reason = self.overloaded()
+        if reason:
+            ticket.set_state('rejected', reason)
+        else:
+            self.grant(ticket)
+        return ticket
+
+    def grant(self, ticket):
+        self.active[ticket] = ticket.rate
+        ticket.set_state('granted')
+        ADMISSION_ACTIVE.set(len(self.active))
+
+    def release(self, ticket):
+        if self.active.pop(ticket, None) is not None:
+            ADMISSION_ACTIVE.set(len(self.active))
+
+    def dispatch(self):
+        pass
+
+    def eta(self, ticket):
+        return 0.0
+
+
+class CapacityAdmissionController(AdmissionController):
+    '''
+    admission=capacity: on top of the overload check, at most maxReplays replays run at once and
+    the bandwidth they commit (each replay's bytes over its duration, see ReplayIndex) stays under
+    capacityMbps. A replay that does not fit waits in a FIFO queue of at most maxQueue replays,
+    for at most maxWait seconds, instead of being turned away. A replay that fits on its own is
+    always let in when nothing else runs.
+    '''
+
+    def __init__(self, systemStat, postprocessor, capacityMbps, maxReplays, maxQueue, maxWait, **kwargs):
+        super(CapacityAdmissionController, self).__init__(systemStat, postprocessor, **kwargs)
+        self.capacityMbps = capacityMbps
+        self.maxReplays = maxReplays
+        self.maxQueue = maxQueue
+        self.maxWait = maxWait
+        self.committed = 0.0
+        self.queue = collections.deque()
+
+    def fits(self, ticket):
+        if not self.active:
+            return True
+        return len(self.active) < self.maxReplays and self.committed + ticket.rate <= self.capacityMbps
+
+    def request(self, ticket, canWait=False):
+        reason = self.overloaded()
+        if reason:
+            ticket.set_state('rejected', reason)
+        elif not self.queue and self.fits(ticket):
+            self.grant(ticket)
+        elif canWait and len(self.queue) < self.maxQueue:
+            ticket.set_state('queued')
+            self.queue.append(ticket)
+            ADMISSION_QUEUED.set(len(self.queue))
+        else:
+            ticket.set_state('rejected', 'Server at capacity with {} replays and {:.1f} Mbps committed'.format(
+                len(self.active), self.committed))
+        return ticket
+
+    def grant(self, ticket):
+        self.committed += ticket.rate
+        super(CapacityAdmissionController, self).grant(ticket)
+
+    def release(self, ticket):
+        if ticket in self.active:
+            self.committed = max(self.committed - self.active[ticket], 0.0)
+        elif ticket.state == 'queued':
+            self.queue.remove(ticket)
+            ticket.set_state('rejected', 'Left the queue')
+            ADMISSION_QUEUED.set(len(self.queue))
+        super(CapacityAdmissionController, self).release(ticket)
+        self.dispatch()
+
+    def dispatch(self):
+        '''
+        Starts the queued replays that fit now, in order, and drops the ones that waited too long
+        '''
+        while self.queue and time.time() - self.queue[0].requested > self.maxWait:
+            self.queue.popleft().set_state('rejected', 'Waited more than {} seconds'.format(self.maxWait))
+        if not self.overloaded():
+            while self.queue and self.fits(self.queue[0]):
+                ticket = self.queue.popleft()
+                ADMISSION_WAIT.observe(time.time() - ticket.requested)
+                self.grant(ticket)
+        ADMISSION_QUEUED.set(len(self.queue))
+
+    def eta(self, ticket):
+        '''
+        Estimated seconds before ticket starts: replays are assumed to end after their
+        duration, and each one ending to let the next queued one in
+        '''
+        now = time.time()
+        ends = [active.started + active.duration for active in self.active]
+        heapq.heapify(ends)
+        start = now
+        for queued in self.queue:
+            start = max(now, heapq.heappop(ends)) if ends else start
+            if queued is ticket:
+                return start - now
+            heapq.heappush(ends, start + queued.duration)
+        return 0.0
+
+
+def admission_controller(systemStat, postprocessor=None):
+    configs = Configs()
+    if configs.get('admission') == 'capacity':
+        return CapacityAdmissionController(systemStat, postprocessor, configs.get('capacityMbps'),
+                                           configs.get('maxReplays'), configs.get('admissionQueue'),
+                                           configs.get('admissionMaxWait'))
+    return AdmissionController(systemStat, postprocessor)
+
+
+def parse_capabilities(clientVersion, extra=None):
+    '''
+    Clients opt in to features explicitly, either after a '+' in the version field
+    (e.g. 1.0+queue, which servers without capabilities just store) or as a 9th identify field.
+    The version number alone never enables anything, other clients may use any numbering.
+    Returns the bare version and the list of capabilities.
+    '''
+    clientVersion, _, flags = clientVersion.partition('+')
+    capabilities = [c for c in flags.split(',') if c]
+    if extra:
+        capabilities += [c for c in extra.split(',') if c]
+    return clientVersion, capabilities
+
+
+def client_can_wait(capabilities):
+    return QUEUE_CAPABILITY in capabilities
+
+
 class TCPServer(object):
     def __init__(self, instance, Qs, greenlets_q, ports_q, errorlog_q, LUT, getLUT, sideChannel_all_clients,
-                 buff_size=4096, pool_size=10000, hashSampleSize=400, timing=True):
+                 sideChannel_bindings, buff_size=4096, pool_size=10000, hashSampleSize=400, timing=True,
+                 coalesce=False):
         self.instance = instance
         self.Qs = Qs
         self.greenlets_q = greenlets_q
@@ -247,7 +723,9 @@ class TCPServer(object):
         self.pool_size = pool_size
         self.hashSampleSize = hashSampleSize
         self.all_clients = sideChannel_all_clients
+        self.bindings = sideChannel_bindings
         self.timing = timing
+        self.coalesce = coalesce
 
     def run(self):
         '''
@@ -255,7 +733,7 @@ class TCPServer(object):
         Note if original_ports is False, instance port is zero, so the OS picks a random free port
         '''
         pool = gevent.pool.Pool(self.pool_size)
-        server = gevent.server.StreamServer(self.instance, self.handle, spawn=pool)
+        server = gevent.server.StreamServer(listener(self.instance), self.handle, spawn=pool)
         server.init_socket()
         # This option is important to make sure packets are not merged.
         # This can happen in NOVPN tests where MTU is bigger than packets
@@ -289,11 +767,10 @@ class TCPServer(object):
         Handles an incoming connection.
         
         Steps:
-            0- Determine csp from hash LUT
-                -if a sideChannel with the same id exists:
-                    -if hash in LUT, done
-                    -elif it's a GET request, consult getLUT (find closest get request)
-                    -else, error!
+            0- Determine csp
+                -if a sideChannel with the same id exists, it has bound id to the replay index:
+                    -the replay's only csp and Q are in the index, done
+                    -if hash not in the replay's prefixes, mark ContentModification
                 -else:
                     -if not a GET request, error
                     -elif "X-rr" exists, done.
@@ -340,10 +817,9 @@ class TCPServer(object):
         else:
             itsGET = False
 
-        if id in self.all_clients:
-            idExists = True
-        else:
-            idExists = False
+        # The side channel binds id to its client object and replay index when granting permission
+        binding = self.bindings.get(id)
+        tcpQ = None
 
         # This is for random replays where we add the info to the beginning of the first packet
         if new_data_string.strip().startswith('X-rr;'):
@@ -353,21 +829,20 @@ class TCPServer(object):
             exceptionsReport = ''
 
         # If we know who the client is:
-        elif idExists:
-            try:
-                # (replayName, csp) = self.LUT['tcp'][hash(new_data_4hash)]
-                # all_clients[id]'s only key is the replayName for this client
-                replayName = list(self.all_clients[id].keys())[0]
-                # Since only one connection for each replay, the first (only) csp in the Q is the one
-                csp = list(self.Qs[replayName].keys())[0]
-                exceptionsReport = ''
-            # The following exception handler is for checking header manipulations
-            except KeyError:
+        elif binding is not None:
+            dClient, index = binding
+            replayName = index.replayName
+            # Since only one connection for each replay, the first (only) csp in the Q is the one
+            csp = index.tcpCSP
+            tcpQ = index.tcpQ
+            exceptionsReport = ''
+            # The following check is for header manipulations
+            if tcpQ is None:
                 self.errorlog_q.put(
                     (get_anonymizedIP(id), 'Unknown packet from existing client', 'TCP', str(self.instance)))
                 exceptionsReport = 'Unknown packet from existing client'
 
-            if hashlib.sha1(new_data_4hash).hexdigest() not in self.LUT['tcp']:
+            if hashlib.sha1(new_data_4hash).hexdigest() not in index.prefixes:
                 exceptionsReport = 'ContentModification'
 
         # If we DON'T know who the client is: (possibly because of IP flipping)
@@ -394,12 +869,15 @@ class TCPServer(object):
                 return
 
         try:
-            dClient = self.all_clients[id][replayName]
+            if tcpQ is None:
+                dClient = self.all_clients[id][replayName]
             if exceptionsReport != '':
                 dClient.exceptions = exceptionsReport
                 # We can continue replay when contentModification happens (this happens when doing DPI reverse-engineering)
                 if 'ContentModification' != exceptionsReport:
                     return
+            if tcpQ is None:
+                tcpQ = self.Qs[replayName][csp]
         except KeyError:
             self.errorlog_q.put((get_anonymizedIP(id), 'Unknown client', 'TCP', str(self.instance)))
             return
@@ -421,16 +899,15 @@ class TCPServer(object):
 
         buffer_len = len(new_data) - extraBytes
 
-        # Make Server side changes on the fly, based on all_clients[id].values().[0], the clientObj
-        clientO = list(self.all_clients[id].values())[0]
+        # Make Server side changes on the fly, based on the clientObj
         # Get the packet number, and make changes on that packet
-        smpacNum = clientO.smpacNum
-        saction = clientO.saction
-        sspec = clientO.sspec
+        smpacNum = dClient.smpacNum
+        saction = dClient.saction
+        sspec = dClient.sspec
 
         pCount = 1
 
-        for response_set in self.Qs[replayName][csp]:
+        for response_set in tcpQ:
             if itsGET is True:
                 '''
                  Some ISPs add/remove/modify headers (e.g. Verizon adding perma-cookies).
@@ -463,20 +940,36 @@ class TCPServer(object):
             # Once the request is fully received, send the response
 
             time_origin = time.time()
+            paced = (self.timing is True) and ("port" not in replayName)
+            responses = response_set.response_list
+            i = 0
+
+            while i < len(responses):
+                if paced:
+                    gevent.sleep(seconds=((time_origin + responses[i].timestamp) - time.time()))
+
+                # The first response of a set always goes out on its own. When not pacing, the
+                # rest of the set is coalesced into the same sendmsg, instead of one sendall and
+                # one wakeup per packet. Paced responses keep their own sends (see TCP_NODELAY in run).
+                end = i + 1
+                if self.coalesce and i > 0 and not paced:
+                    end = len(responses)
+
+                buffers = []
+                for response in responses[i:end]:
+                    payload = response.payload
+                    if pCount == smpacNum:
+                        # Modify a copy, the response objects are shared by all clients of this replay
+                        payload = sModify(bytes(payload).decode('latin-1'), saction, sspec).encode('latin-1')
+                    buffers.append(payload)
+                    pCount += 1
 
-            for response in response_set.response_list:
-                if pCount == smpacNum:
-                    response.payload = sModify(str(response.payload), saction, sspec)
-
-                if (self.timing is True) and ("port" not in replayName):
-                    gevent.sleep(seconds=((time_origin + response.timestamp) - time.time()))
                 try:
-                    # response.payload.replace('video', 'walio')
-                    connection.sendall(bytes.fromhex(response.payload))
+                    send_buffers(connection, buffers)
                 except Exception as e:
                     print("Error when sending data", e)
                     return False
-                pCount += 1
+                i = end
 
             buffer_len = 0
 
@@ -485,6 +978,24 @@ class TCPServer(object):
         connection.close()
 
 
+def send_buffers(connection, buffers):
+    '''
+    sendall() for a list of buffers: a single scatter-gather sendmsg() call per
+    IOV_MAX buffers, so the payloads are never joined in user space.
+    '''
+    if len(buffers) == 1:
+        connection.sendall(buffers[0])
+        return
+
+    while buffers:
+        sent = connection.sendmsg(buffers[:IOV_MAX])
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
 class UDPServer(object):
     '''
     self.mapping: this is the client mapping that server keeps to keep track what portion of the trace is
@@ -493,7 +1004,7 @@ class UDPServer(object):
     '''
 
     def __init__(self, instance, Qs, notify_q, greenlets_q, ports_q, errorlog_q, LUT, sideChannel_all_clients,
-                 buff_size=4096, pool_size=10000, timing=True):
+                 sideChannel_bindings, buff_size=4096, pool_size=10000, timing=True):
         self.instance = instance
         self.Qs = Qs
         self.notify_q = notify_q
@@ -502,22 +1013,44 @@ class UDPServer(object):
         self.errorlog_q = errorlog_q
         self.LUT = LUT
         self.all_clients = sideChannel_all_clients
+        self.bindings = sideChannel_bindings
         self.buff_size = buff_size
         self.pool_size = pool_size
         self.original_port = self.instance[1]
         self.mapping = {}  # self.mapping[id][clientPort] = (id, serverPort, replayName)
-        self.send_lock = RLock()
+        self.outbound = collections.deque()
         self.timing = timing
 
     def run(self):
 
         pool = gevent.pool.Pool(self.pool_size)
 
-        self.server = gevent.server.DatagramServer(self.instance, self.handle, spawn=pool)
+        self.server = gevent.server.DatagramServer(listener(self.instance, socket.SOCK_DGRAM), self.handle, spawn=pool)
         self.server.start()
 
+        self.scheduler = UDPScheduler(self.outbound, self.drain)
+        gevent.Greenlet.spawn(self.scheduler.run)
+
         self.instance = (self.instance[0], self.server.address[1])
 
+    def drain(self):
+        '''
+        Sends everything on the outbound queue (payload, client address, flow, due time) in one
+        burst, and records the pacing error of every datagram when it actually left. Only the
+        scheduler greenlet writes to the socket, so no lock is needed; the greenlet only yields
+        when the socket buffer is full.
+        '''
+        sock = self.server.socket
+        outbound = self.outbound
+        while outbound:
+            payload, client_address, flow, due = outbound.popleft()
+            try:
+                sock.sendto(payload, client_address)
+            except Exception as e:
+                LOG_ACTION(logger, 'UDP send error to {}: {}'.format(client_address, e),
+                           level=logging.DEBUG, doPrint=False)
+            flow.record(time.time() - due)
+
     def handle(self, data, client_address):
         '''
         Data is received from client_address:
@@ -548,35 +1081,26 @@ class UDPServer(object):
         try:
             self.mapping[id][clientPort]
         except KeyError:
-            try:
-                if id in self.all_clients:
-                    idExists = True
-                    replayName = list(self.all_clients[id].keys())[0]
-                else:
-                    idExists = False
-
-                if not idExists:
-                    self.errorlog_q.put((get_anonymizedIP(id), 'Unknown packet', 'UDP', str(self.instance)))
-                    return
-
-                else:
-                    original_serverPort = list(self.Qs[replayName].keys())[0]
-                    original_clientPort = list(self.Qs[replayName][original_serverPort].keys())[0]
-            except:
+            # The side channel binds id to its replay index when granting permission
+            binding = self.bindings.get(id)
+            if binding is None or binding[1].udpQ is None:
                 self.errorlog_q.put((get_anonymizedIP(id), 'Unknown packet', 'UDP', str(self.instance)))
                 return
+            index = binding[1]
+            replayName = index.replayName
 
             if id not in self.mapping:
                 self.mapping[id] = {}
             self.mapping[id][clientPort] = 1
             self.ports_q.put(('port', id, replayName, clientPort))
 
-            gevent.Greenlet.spawn(self.send_Q, self.Qs[replayName][original_serverPort][original_clientPort],
-                                  time.time(), client_address, id, replayName)
+            gevent.Greenlet.spawn(self.send_Q, index.udpQ, time.time(), client_address, id, replayName)
 
     def send_Q(self, Q, time_origin, client_address, id, replayName):
         '''
-        Sends a queue of UDP packets to client socket
+        Sends a queue of UDP packets to client socket.
+        The packets themselves are sent by self.scheduler, this greenlet only waits for the
+        flow to finish, so killing it (see SideChannel.greenlet_cleaner) stops the flow.
         '''
         udp_test_timeout = 45
         # 1-Register greenlet
@@ -587,24 +1111,137 @@ class UDPServer(object):
         self.notify_q.put((id, replayName, clientPort, 'STARTED'))
 
         # 3- Start sending
-        for udp_set in Q:
-            if self.timing is True:
-                gevent.sleep((time_origin + udp_set.timestamp) - time.time())
-
-            with self.send_lock:
-                self.server.socket.sendto(bytes.fromhex(udp_set.payload), client_address)
-
-            time_progress = time.time() - time_origin
-            if time_progress > udp_test_timeout:
-                break
+        flow = UDPFlow(Q, time_origin, client_address, self.timing, udp_test_timeout)
+        self.scheduler.add(flow)
+        try:
+            flow.done.wait()
+        finally:
+            flow.cancelled = True
 
-            if DEBUG == 2: print('\tsent:', udp_set.payload, 'to', client_address)
-            if DEBUG == 3: print('\tsent:', len(udp_set.payload), 'to', client_address)
+        if flow.sent:
+            UDP_PACING_ERROR.observe(flow.errorSum / flow.sent)
+            LOG_ACTION(logger, 'UDP pacing error for {} {} {}: mean {:.3f} ms, max {:.3f} ms, {} packets'.format(
+                replayName, get_anonymizedIP(id), clientPort, 1000 * flow.errorSum / flow.sent,
+                1000 * flow.errorMax, flow.sent), level=logging.DEBUG, doPrint=False)
 
         # 4-Let client know the end of send_Q
         self.notify_q.put((id, replayName, clientPort, 'DONE'))
 
 
+class UDPFlow(object):
+    '''
+    One UDP queue being replayed to one client port, see UDPScheduler
+    '''
+
+    def __init__(self, Q, time_origin, client_address, timing, timeout):
+        self.Q = Q
+        self.time_origin = time_origin
+        self.client_address = client_address
+        self.timing = timing
+        self.timeout = timeout
+        self.index = 0
+        self.cancelled = False
+        self.done = gevent.event.Event()
+        self.sent = 0
+        self.errorSum = 0.0
+        self.errorMax = 0.0
+
+    def next_due(self):
+        if self.timing is True:
+            return self.time_origin + self.Q[self.index].timestamp
+        return self.time_origin
+
+    def record(self, error):
+        self.sent += 1
+        self.errorSum += abs(error)
+        self.errorMax = max(self.errorMax, error)
+
+
+class UDPScheduler(object):
+    '''
+    Paces every UDP flow of one UDPServer from a single greenlet.
+
+    Instead of one greenlet sleeping before each datagram, flows sit in a heap keyed by the
+    due time of their next datagram. The scheduler wakes up for the earliest one, puts what is
+    due by then on the outbound queue, drains it, then re-queues the flows. Nothing is sent
+    ahead of its time, and a burst holds at most max_batch datagrams before the scheduler
+    yields, so a large backlog cannot delay the datagrams that fall due meanwhile.
+    Pacing error (send time - due time) is accumulated per flow, see UDPServer.drain.
+    '''
+
+    def __init__(self, outbound, drain, max_batch=64):
+        self.outbound = outbound
+        self.drain = drain
+        self.max_batch = max_batch
+        self.heap = []
+        self.counter = 0
+        self.wakeup = gevent.event.Event()
+
+    def add(self, flow):
+        if not flow.Q:
+            flow.done.set()
+            return
+        self.push(flow)
+        self.wakeup.set()
+
+    def push(self, flow):
+        # the counter keeps flows with the same due time in FIFO order (flows are not comparable)
+        self.counter += 1
+        heapq.heappush(self.heap, (flow.next_due(), self.counter, flow))
+
+    def run(self):
+        while True:
+            if not self.heap:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                # A new flow may be due earlier, so wait on the event rather than sleep
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+                continue
+
+            batch = []
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now and len(batch) < self.max_batch:
+                due, count, flow = heapq.heappop(self.heap)
+                if not flow.cancelled:
+                    batch.append((due, flow))
+
+            self.send_batch(batch, now)
+            # Let other greenlets run between batches, e.g. when timing is off
+            gevent.sleep(0)
+
+    def send_batch(self, batch, now):
+        budget = self.max_batch
+        finished = []
+        for due, flow in batch:
+            # send everything this flow has due by now, not just one datagram
+            while True:
+                udp_set = flow.Q[flow.index]
+                self.outbound.append((udp_set.payload, flow.client_address, flow, due))
+                flow.index += 1
+                budget -= 1
+
+                if DEBUG == 2: print('\tsent:', udp_set.payload, 'to', flow.client_address)
+                if DEBUG == 3: print('\tsent:', len(udp_set.payload), 'to', flow.client_address)
+
+                if flow.index >= len(flow.Q) or now - flow.time_origin > flow.timeout:
+                    finished.append(flow)
+                    break
+
+                due = flow.next_due()
+                if due > now or budget <= 0:
+                    self.push(flow)
+                    break
+
+        self.drain()
+        for flow in finished:
+            flow.done.set()
+
+
 class SideChannel(object):
     '''
     Responsible for all side communications between client and server
@@ -627,12 +1264,14 @@ class SideChannel(object):
                        SideChannel puts start and stop on this queue to tell when to start/stop tcpdump process
     '''
 
-    def __init__(self, instance, Qs, LUT, getLUT, allUDPservers, udpSenderCounts, notify_q, greenlets_q, ports_q,
-                 logger_q, errorlog_q, buff_size=4096):
+    def __init__(self, instance, Qs, LUT, getLUT, replayIndex, allUDPservers, udpSenderCounts, notify_q, greenlets_q,
+                 ports_q, logger_q, errorlog_q, catalog=None, buff_size=4096):
         self.instance = instance
+        self.catalog = catalog
         self.Qs = Qs
         self.LUT = LUT
         self.getLUT = getLUT
+        self.replayIndex = replayIndex
         self.allUDPservers = allUDPservers
         self.udpSenderCounts = udpSenderCounts
         self.notify_q = notify_q
@@ -642,6 +1281,7 @@ class SideChannel(object):
         self.errorlog_q = errorlog_q
         self.buff_size = buff_size
         self.all_clients = {}  # self.all_clients[id][replayName] = ClientObj
+        self.bindings = {}  # self.bindings[id] = (ClientObj, ReplayIndex), read by TCP/UDP servers
         self.all_side_conns = {}  # self.all_side_conns[g] = (id, replayName)
         self.id2g = {}  # self.id2g[realID]      = g
         self.greenlets = {}
@@ -649,7 +1289,35 @@ class SideChannel(object):
         self.max_time = 5 * 60
         self.admissionCtrl = {}  # self.admissionCtrl[id][replayName] = testObj
         self.inProgress = {}  # self.inProgress[realID] = (id, replayName)
-        self.replays_since_last_cleaning = []  # replays used since last cleaning
+        self.replayCache = ReplayCache(Qs, LUT, getLUT, replayIndex, allUDPservers, udpSenderCounts,
+                                       Configs().get('replayCacheMB') * 1024 * 1024, catalog)
+        self.systemStat = SystemStatSampler(Configs().get('systemStatInterval'), Configs().get('systemStatAlpha'),
+                                            callback=report_system_stat)
+        # Worker 0 takes over the journals of the workers a previous run had beyond Configs().get('workers')
+        adopt = []
+        if Configs().get('workerIndex') == 0:
+            adopt = orphaned_journals(Configs().get('postprocessFolder'), Configs().get('workers'))
+        self.postprocessor = PostProcessor(
+            os.path.join(Configs().get('postprocessFolder'), 'worker{}'.format(Configs().get('workerIndex'))),
+            Configs().get('postprocessWorkers'), Configs().get('postprocessBacklog'), errorlog_q,
+            Configs().get('postprocessTimeout'), adopt)
+        self.admission = admission_controller(self.systemStat, self.postprocessor)
+        # One capture for all the workers: worker 0 runs it and relays the other workers' requests
+        self.captureEngine = None
+        self.captureRelay = None
+        self.replayPorts = None
+        if Configs().get('sharedCapture'):
+            interface = Configs().get('tcpdumpInt')
+            if Configs().get('workerIndex') > 0:
+                self.captureEngine = CaptureClient(Configs().get('captureControl'))
+            else:
+                self.captureEngine = CaptureEngine(None if interface == 'default' else interface,
+                                                   Configs().get('captureSnaplen'), Configs().get('captureFilter'))
+                if Configs().get('workers') > 1:
+                    self.captureRelay = CaptureRelay(self.captureEngine, Configs().get('captureControl'))
+        self.geo = GeoService()
+        self.whoisCache = WhoisCache(os.path.join(Configs().get('replay_cache_folder'), 'whois.json'),
+                                     ttl=Configs().get('whoisCacheHours') * 3600)
         if Configs().get('EC2'):
             self.instanceID = self.getEC2instanceID()
         else:
@@ -667,10 +1335,27 @@ class SideChannel(object):
         '''
 
         self.server_mapping_json = json.dumps(server_mapping)
+        # The ports the replay servers listen on (and 55557, see run()), what the shared capture keeps
+        self.replayPorts = sorted(set(instance[1] for protocol in server_mapping for ip in server_mapping[protocol]
+                                      for instance in server_mapping[protocol][ip].values()) | {55557})
         self.mappings = mappings  # [mapping, ...] where each mapping belongs to one UDPServer
 
         gevent.Greenlet.spawn(self.notify_clients)
-        # gevent.Greenlet.spawn(self.replay_cleaner)
+        gevent.Greenlet.spawn(self.replay_cleaner)
+        gevent.Greenlet.spawn(self.systemStat.run)
+        gevent.Greenlet.spawn(self.whoisCache.run)
+        self.postprocessor.run()
+        if self.captureRelay is not None:
+            # started even if the capture fails here, CaptureEngine.request tries again for the other workers
+            self.captureRelay.start()
+        if self.captureEngine is not None:
+            try:
+                self.captureEngine.start()
+            except RuntimeError as e:
+                LOG_ACTION(logger, '{}, running one tcpdump per replay instead'.format(e), level=logging.ERROR)
+                self.captureEngine = None
+        if self.catalog is not None:
+            gevent.Greenlet.spawn(self.catalog_scanner, Configs().get('catalogScanInterval'))
         gevent.Greenlet.spawn(self.add_greenlets)
         gevent.Greenlet.spawn(self.greenlet_cleaner)
         gevent.Greenlet.spawn(self.replay_logger, Configs().get('replayLog'))
@@ -694,13 +1379,15 @@ class SideChannel(object):
         else:
             print("Missing https configuration, skipping https sidechannel server")
 
-        self.http_server = gevent.server.StreamServer(self.instance, self.handle, spawn=self.pool)
-        self.https_server = gevent.server.StreamServer((configs.get('publicIP'), configs.get('sidechannel_tls_port')),
-                                                       self.handle, spawn=self.pool, ssl_context=ssl_options)
+        self.http_server = gevent.server.StreamServer(listener(self.instance), self.handle, spawn=self.pool)
+        self.https_server = gevent.server.StreamServer(
+            listener((configs.get('publicIP'), configs.get('sidechannel_tls_port'))),
+            self.handle, spawn=self.pool, ssl_context=ssl_options)
+        worker_ready()
         gevent.Greenlet.spawn(self.run_http)
 
-        # start the prometheus client here
-        start_http_server(9990)
+        # start the prometheus client here, every worker exports on its own port
+        start_http_server(9990 + configs.get('workerIndex'))
         # not making a separate thread since this loop keeps the main python process running
         LOG_ACTION(logger, 'https sidechannel server running')
         self.https_server.serve_forever()
@@ -717,9 +1404,6 @@ class SideChannel(object):
         delta_to_today = expiration_date - datetime.now()
         CERT_EXPIRATION_DAYS.set(delta_to_today.days)
         timer = Timer(60 * 60, self.update_cert_expiration_metric)
-        # update the prometheus disk usage metric
-        cpuPercent, memPercent, diskPercent, upLoad = getSystemStat()
-        DISK_USAGE.set(diskPercent)
         timer.start()
 
     def handle(self, connection, address):
@@ -759,6 +1443,9 @@ class SideChannel(object):
         if data is None: return
 
         data = data.split(';')
+        # Clients may append what they support as a 9th field, e.g. 'queue' (see parse_capabilities)
+        extraCapabilities = data[8] if len(data) > 8 else None
+        data = data[:8]
         # realIP, is what the client get by sending 'WhatsmyIP' to the replay server
         # We use this instead of the IP address of the sidechannel,
         # since the replay might be behind a proxy that changes the IP address
@@ -772,6 +1459,7 @@ class SideChannel(object):
             [realID, testID, replayName, extraString, historyCount, endOfTest] = data
             realIP = clientIP
             clientVersion = '1.0'
+        clientVersion, capabilities = parse_capabilities(clientVersion, extraCapabilities)
 
         if extraString == '':
             extraString = 'extraString'
@@ -803,31 +1491,43 @@ class SideChannel(object):
         # No two clients with the same IP can replay at the same time, the first replay has to be killed
         self.killIfNeeded(realID)
 
-        # 2b- if unknown replayName
-        if (replayName not in self.Qs["tcp"]) and (replayName not in self.Qs["udp"]):
-            if not load_replay(replayName, self.Qs, self.LUT, self.getLUT, self.allUDPservers, self.udpSenderCounts):
-                LOG_ACTION(logger, '*** Unknown replay name: {} ({}) ***'.format(replayName, realID))
-                send_result = self.send_object(connection, '0;1')
-                dClient.exceptions = 'UnknownRelplayName'
-                # self.logger_q.put('\t'.join(dClient.get_info()))
-                REPLAY_ERROR_COUNT.labels('unknown_name').inc()
-                return
-        # 2c- if server is overloaded
-        cpuPercent, memPercent, diskPercent, upLoad = getSystemStat()
+        # 2b- if unknown replayName (loads it if needed, and keeps it loaded until this side channel is done)
+        loadedName = self.replayCache.acquire(replayName)
+        if loadedName is None:
+            LOG_ACTION(logger, '*** Unknown replay name: {} ({}) ***'.format(replayName, realID))
+            send_result = self.send_object(connection, '0;1')
+            dClient.exceptions = 'UnknownRelplayName'
+            # self.logger_q.put('\t'.join(dClient.get_info()))
+            REPLAY_ERROR_COUNT.labels('unknown_name').inc()
+            return
+        g.link(lambda g, loadedName=loadedName: self.replayCache.release(loadedName))
+        # e.g. a name without date resolves to the latest version of the replay
+        replayName = loadedName
+        dClient.replayName = replayName
+        # 2c- ask the admission controller whether the replay can start now
+        cpuPercent, memPercent, diskPercent, upLoad = self.systemStat.latest()
 
         LOG_ACTION(logger,
                    'Server Load right now: CPU Usage {}% Memory Usage {}% Disk Usage {}% Upload Bandwidth Usage {}Mbps with {} active connections now ***'.format(
                        cpuPercent, memPercent, diskPercent, upLoad, len(self.inProgress)))
 
-        # Check cpu, memory and bandwidth usage
-        # If any of these happens: memory > 95%, disk > 95%, bandwidth > 2000 Mbps, return 0;3
-        if memPercent > 95 or diskPercent > 95 or upLoad > 2000:
-            # LOG_ACTION(logger, '*** Server Overloaded : CPU Usage {}% Memory Usage {}% Upload Bandwidth Usage {}Mbps with {} active connections now ***'.format(cpuPercent, memPercent, upLoad, len(self.all_clients)))
+        # Rejected (0;3) if the server is overloaded, or with admission=capacity, if it is at capacity and
+        # the client cannot wait. Clients waiting in the queue get 0;4;<estimated seconds before start>
+        index = self.replayIndex[replayName]
+        ticket = self.admission.request(AdmissionTicket(replayName, index.rate, index.duration),
+                                        canWait=client_can_wait(capabilities))
+        g.link(lambda g, ticket=ticket: self.admission.release(ticket))
+        while ticket.state == 'queued':
+            if not self.send_object(connection, '0;4;{:.0f}'.format(self.admission.eta(ticket))):
+                return
+            ticket.event.wait(timeout=2)
+            self.admission.dispatch()
+        if ticket.state == 'rejected':
             send_result = self.send_object(connection, '0;3')
-            dClient.exceptions = 'Server Overloaded with CPU Usage {}% Memory Usage {}% Upload Bandwidth Usage {}Mbps with {} active connections now *** '.format(
-                cpuPercent, memPercent, upLoad, len(self.inProgress))
+            dClient.exceptions = '{} with {} active connections now *** '.format(ticket.reason, len(self.inProgress))
             self.errorlog_q.put(dClient.exceptions)
-            REPLAY_ERROR_COUNT.labels('server_overloaded').inc()
+            REPLAY_ERROR_COUNT.labels('server_overloaded' if ticket.reason.startswith('Server Overloaded')
+                                      else 'server_at_capacity').inc()
             return
         # Each client can only run one replay at any time
         # self.admissionCtrl[id] has to be unique
@@ -889,12 +1589,15 @@ class SideChannel(object):
             LOG_ACTION(logger,
                        'Yay! Permission granted: {} - {} - {}'.format(realID, historyCount, testID),
                        indent=2, action=False)
-            dClient.setDump('_'.join(['server', realID, replayName, extraString, historyCount, testID]))
+            dClient.setDump('_'.join(['server', realID, replayName, extraString, historyCount, testID]),
+                            self.captureEngine, self.replayPorts)
             try:
                 self.all_clients[id][replayName] = dClient
             except KeyError:
                 self.all_clients[id] = {}
                 self.all_clients[id][replayName] = dClient
+            if replayName in self.replayIndex:
+                self.bindings[id] = (dClient, self.replayIndex[replayName])
 
             self.all_side_conns[g] = (id, replayName)
             self.id2g[realID] = g
@@ -954,22 +1657,11 @@ class SideChannel(object):
             # 1. reverse geolocate the GPS location, store it as another item in the locationInfo dictionary, the key is 'geoinfo'
             # 2. Truncate GPS locations to only two digits after decimal point
             mobileStats = json.loads(mobileStats)
-            lat = str(mobileStats['locationInfo']['latitude'])
-            lon = str(mobileStats['locationInfo']['longitude'])
-            if lat != '0.0' and lon != '0.0' and lat != 'nil':
-                coordinates = (float(lat), float(lon)), (float(lat), float(lon))
-                geoInfo = reverse_geocode.search(coordinates)[0]
-                lat = float("{0:.1f}".format(float(lat)))
-                lon = float("{0:.1f}".format(float(lon)))
-                mobileStats['locationInfo']['country'] = geoInfo['country']
-                mobileStats['locationInfo']['city'] = geoInfo['city']
-                mobileStats['locationInfo']['localTime'] = getLocalTime(incomingTime, lon, lat)
+            self.geo.update_location(mobileStats['locationInfo'], incomingTime)
             # 1. update the carrierName with network type info
             # 2. get ISP for WiFi connections via whois lookup
             mobileStats['updatedCarrierName'] = self.getCarrierName(mobileStats['carrierName'],
                                                                     mobileStats['networkType'], clientIP)
-            mobileStats['locationInfo']['latitude'] = lat
-            mobileStats['locationInfo']['longitude'] = lon
             dClient.mobileStats = json.dumps(mobileStats)
             LOG_ACTION(logger, 'Mobile stats for {}: {}'.format(realID, mobileStats), indent=2, action=False)
         elif data[0] == 'NoMobileStats':
@@ -980,10 +1672,15 @@ class SideChannel(object):
                    'Starting tcpdump for: id: {}, historyCount: {}'.format(dClient.realID, dClient.historyCount),
                    indent=2, action=False)
         # resultsFolder = getCurrentResultsFolder()
-        resultsFolder = Configs().get('tmpResultsFolder') + '/' + realID + '/'
+        resultsFolder = Configs().get('tmpResultsFolder')
 
         # print '\r\n STARTING TCPDUMP FOR THIS CLIENT'
         command = dClient.dump.start(host=dClient.ip)
+        if not dClient.dump.status() and isinstance(dClient.dump, SharedDump):
+            LOG_ACTION(logger, '{}, running tcpdump for this replay instead'.format(command), level=logging.ERROR,
+                       doPrint=False)
+            dClient.setDump(dClient.dumpName)
+            command = dClient.dump.start(host=dClient.ip)
 
         # 5a- Send server mapping to client
         send_result = self.send_object(connection, self.server_mapping_json)
@@ -1024,8 +1721,7 @@ class SideChannel(object):
             xput = xput[:-1]
             ts = ts[:-1]
 
-            folder = resultsFolder + '/clientXputs/'
-            xputFile = folder + 'Xput_{}_{}_{}.json'.format(realID, historyCount, testID)
+            xputFile = RF.result_file(resultsFolder, realID, 'clientXputs', historyCount, testID)
 
             try:
                 with open(xputFile, 'w') as writeFile:
@@ -1064,13 +1760,12 @@ class SideChannel(object):
 
         REPLAY_COUNT.labels(replayName).inc()
 
-        # 9- Set secondarySuccess to True, add this replay to recent list, and close connection
+        # 9- Set secondarySuccess to True, mark this replay as recently used, and close connection
         dClient.secondarySuccess = True
-        if replayName not in self.replays_since_last_cleaning:
-            self.replays_since_last_cleaning.append(replayName)
+        if self.replayCache.loaded(replayName):
+            self.replayCache.touch(replayName)
 
-        folder = resultsFolder + '/replayInfo/'
-        replayInfoFile = folder + 'replayInfo_{}_{}_{}.json'.format(realID, historyCount, testID)
+        replayInfoFile = RF.result_file(resultsFolder, realID, 'replayInfo', historyCount, testID)
 
         try:
             dClient.create_info_json(replayInfoFile)
@@ -1085,7 +1780,7 @@ class SideChannel(object):
         # get WiFi network carrierName
         if networkType == 'WIFI':
             try:
-                IPrange, org = getRangeAndOrg(clientIP)
+                org = self.whoisCache.lookup(clientIP, wait=1)
                 if not org:
                     carrierName = ' (WiFi)'
                 else:
@@ -1223,6 +1918,8 @@ class SideChannel(object):
 
         # Clean dicts
         del self.all_clients[id][replayName]
+        if self.bindings.get(id, (None,))[0] is dClient:
+            del self.bindings[id]
         del self.all_side_conns[g]
         del self.id2g[dClient.realID]
 
@@ -1233,29 +1930,14 @@ class SideChannel(object):
         tcpdumpResult = dClient.dump.stop()
         LOG_ACTION(logger, 'tcpdumpResult: {}'.format(tcpdumpResult), indent=3, action=False)
 
-        # Create _out.pcap (only if the replay was successful and no content modification)
+        # Create _out.pcap (only if the replay was successful and no content modification), and
+        # recursively change the dClient results' ownership from root to user, in the post-processing workers
         if dClient.secondarySuccess:
-            tcpdumpstarts = time.time()
+            job = {'realID': dClient.realID, 'clean_pcap': None, 'chown': dClient.targetFolder}
             if dClient.exceptions != 'ContentModification':
-                permResultsFolder = getCurrentResultsFolder()
-                clean_pcap(dClient.dump.dump_name, dClient.id, get_anonymizedIP(dClient.id), dClient.ports,
-                           dClient.realID, permResultsFolder)
-                tcpdumpends = time.time()
-                cpuPercent, memPercent, diskPercent, upLoad = getSystemStat()
-                LOG_ACTION(logger,
-                           'Cleaned pcap for id: {}, historyCount: {}; CPU Usage {}% Memory Usage {}% Disk Usage {}% Upload Bandwidth Usage {}Mbps with {} active connections and {} clients now, spent {} seconds ***'.format(
-                               dClient.realID, dClient.historyCount, cpuPercent, memPercent, diskPercent, upLoad,
-                               len(self.inProgress), len(self.all_clients), tcpdumpends - tcpdumpstarts), indent=2,
-                           action=False)
-            # recursively change the dClient results' ownership from root to user
-            # makes it easier to delete after data is backed up
-            if os.getenv("SUDO_UID"):
-                uid = int(os.getenv("SUDO_UID"))
-                for root, dirs, files in os.walk(dClient.targetFolder):
-                    for dir in dirs:
-                        os.chown(os.path.join(root, dir), uid, uid)
-                    for file in files:
-                        os.chown(os.path.join(root, file), uid, uid)
+                job['clean_pcap'] = [dClient.dump.dump_name, dClient.id, get_anonymizedIP(dClient.id),
+                                     list(dClient.ports), dClient.realID, getCurrentResultsFolder()]
+            self.postprocessor.submit(job)
 
         return True
 
@@ -1324,37 +2006,30 @@ class SideChannel(object):
                     self.errorlog_q.put(
                         (get_anonymizedIP(clientIP), replayName, 'Unknown connection', who.upper(), instance))
 
+    def catalog_scanner(self, interval):
+        '''
+        Keeps the replay catalog up to date, the scan (stat calls) runs in the thread pool
+        '''
+        while True:
+            gevent.sleep(interval)
+            try:
+                changed = gevent.get_hub().threadpool.apply(self.catalog.scan)
+            except Exception as e:
+                LOG_ACTION(logger, 'Replay catalog scan failed: {}'.format(e), level=logging.ERROR, doPrint=False)
+                continue
+            if changed:
+                LOG_ACTION(logger, 'Replay catalog updated: {}'.format(changed), indent=1, action=False)
+
     def replay_cleaner(self):
         '''
-        This goes through self.Qs and delete replays that are not used since last cleaning
+        This evicts the replays that were not used since last cleaning (see ReplayCache)
         '''
         while True:
-            udp_replays_to_delete = []
-            tcp_replays_to_delete = []
-
-            for replayName in self.Qs["udp"]:
-                if replayName not in self.replays_since_last_cleaning:
-                    udp_replays_to_delete.append(replayName)
-
-            for replayName in self.Qs["tcp"]:
-                if replayName not in self.replays_since_last_cleaning:
-                    tcp_replays_to_delete.append(replayName)
-
-            LOG_ACTION(logger, "Cleaning not used replays, current total {}, to delete {}".format(
-                len(self.Qs["tcp"]), udp_replays_to_delete + tcp_replays_to_delete))
-
-            # clean TCP
-            for key in tcp_replays_to_delete:
-                del self.Qs["tcp"][key]
-            # clean UDP
-            for key in udp_replays_to_delete:
-                del self.Qs["udp"][key]
-
-            self.replays_since_last_cleaning = []
-            LOG_ACTION(logger, 'Done cleaning: remaining total {}, remaining replays {}, Qs size {}'.format(len(self.Qs["tcp"]), self.Qs["tcp"].keys(), get_size(self.Qs)), indent=1, action=False)
-            snapshot = tracemalloc.take_snapshot()
-            display_top(snapshot)
             gevent.sleep(self.sleep_time)
+            LOG_ACTION(logger, "Cleaning not used replays, current total {}".format(len(self.replayIndex)))
+            evicted = self.replayCache.evict_idle(self.sleep_time)
+            LOG_ACTION(logger, 'Done cleaning: evicted {}, remaining total {}, replays size {}'.format(
+                evicted, len(self.replayIndex), self.replayCache.size()), indent=1, action=False)
 
     def greenlet_cleaner(self):
         '''
@@ -1408,82 +2083,11 @@ class SideChannel(object):
                 dClient.hosts.add(port_or_host)
 
 
-def timedRun(cmd, timeout_sec):
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    timer = Timer(timeout_sec, proc.kill)
-    out = ''
-    try:
-        timer.start()
-        out, stderr = proc.communicate()
-    finally:
-        timer.cancel()
-    return out
-
-
-def getRangeAndOrg(ip):
-    out = timedRun(['whois', ip], 1)
-    out = out.decode('ascii', 'ignore')
-
-    IPRange = None
-    orgName = None
-    netRange = None
-
-    if 'NetRange:' in out:
-        netRange = out.split('NetRange:')[1].split('\n')[0]
-        netRange = netRange.split()
-        IPRange = neta.IPRange(netRange[0], netRange[2])
-
-
-    # LACNIC/RIPE format
-    elif 'inetnum:' in out:
-        netRange = out.split('inetnum:')[1].split('\n')[0]
-        if '/' in netRange:
-            netRange = netRange.split()[0]
-            IPRange = neta.IPSet(neta.IPNetwork(netRange))
-        else:
-            netRange = netRange.split()
-            IPRange = neta.IPRange(netRange[0], netRange[2])
-
-    # ways to extract ISP name out from the whois result
-    if 'OrgName:' in out:
-        orgName = out.split('OrgName:')[1].split('\n')[0]
-    elif 'Organization:' in out:
-        orgName = out.split('Organization:')[1].split('\n')[0]
-    elif 'owner:' in out:
-        orgName = out.split('owner:')[1].split('\n')[0]
-    elif 'org-name:' in out:
-        orgName = out.split('org-name:')[1].split('\n')[0]
-    elif 'abuse-mailbox:' in out:
-        orgName = out.split('abuse-mailbox:')[1].split('@')[1].split('.')[0]
-    elif 'netname:' in out:
-        orgName = out.split('netname:')[1].split('\n')[0]
-
-    if orgName and netRange:
-        return IPRange, orgName
-    else:
-        return None, None
-
-
-def getLocalTime(utcTime, lon, lat):
-    if (lat == lon == '0.0') or (lat == lon == 0.0) or lat == 'null':
-        return None
-
-    utcTime = datetime.strptime(utcTime, '%Y-%m-%d %H:%M:%S')
-
-    tf = TimezoneFinder()
-    # METHOD 1: from UTC
-    from_zone = tz.gettz('UTC')
-
-    to_zone = tf.timezone_at(lng=lon, lat=lat)
-
-    to_zone = tz.gettz(to_zone)
-
-    utc = utcTime.replace(tzinfo=from_zone)
-
-    # Convert time zone
-    convertedTime = str(utc.astimezone(to_zone))
-
-    return convertedTime
+def report_system_stat(cpuPercent, memPercent, diskPercent, upLoad):
+    CPU_USAGE.set(cpuPercent)
+    MEMORY_USAGE.set(memPercent)
+    DISK_USAGE.set(diskPercent)
+    UPLOAD_MBPS.set(upLoad)
 
 
 def multiReplace(payload, regions, rpayload):
@@ -1587,7 +2191,118 @@ def getDictDistance(headersDic1, headersDic2):
     return distance
 
 
+class GetLUT(dict):
+    '''
+    getLUT[(replayName, csp)] = headersDict of the first GET request, which also keeps
+    an inverted index up to date on every insert:
+        self.byGET[GET line]             = set of keys
+        self.byHeader[(name, value)]     = set of keys (GET line excluded)
+        self.order[key]                  = insertion number, to break ties like a linear scan would
+
+    getDictDistance is (headers in common) - 2 * (headers with the same value), and every
+    entry has a GET line in common with the request. So an entry matching at most r of the
+    request's other (name, value) pairs is at distance >= 1 - r (or -1 - r when it has the
+    same GET line). closest() visits the request's pairs rarest first, scoring entries as
+    they show up, and stops as soon as the entries not seen yet cannot be closer. Only when
+    that never happens (headers mostly rewritten) does it score every entry.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(GetLUT, self).__init__()
+        self.byGET = {}
+        self.byHeader = {}
+        self.order = {}
+        self.counter = 0
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, headersDict):
+        if key in self:
+            self.unindex(key)
+        else:
+            self.counter += 1
+            self.order[key] = self.counter
+        super(GetLUT, self).__setitem__(key, headersDict)
+
+        self.byGET.setdefault(headersDict['GET'], set()).add(key)
+        for item in headersDict.items():
+            if item[0] != 'GET':
+                self.byHeader.setdefault(item, set()).add(key)
+
+    def __delitem__(self, key):
+        self.unindex(key)
+        del self.order[key]
+        super(GetLUT, self).__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, headersDict in dict(*args, **kwargs).items():
+            self[key] = headersDict
+
+    def unindex(self, key):
+        headersDict = self[key]
+        self.byGET[headersDict['GET']].discard(key)
+        if not self.byGET[headersDict['GET']]:
+            del self.byGET[headersDict['GET']]
+        for item in headersDict.items():
+            if item[0] != 'GET':
+                self.byHeader[item].discard(key)
+                if not self.byHeader[item]:
+                    del self.byHeader[item]
+
+    def rank(self, headersDict, keys, k):
+        return heapq.nsmallest(k, ((getDictDistance(headersDict, self[key]), self.order[key], key) for key in keys))
+
+    def closest(self, headersDict, k=1):
+        '''
+        Returns the (up to) k keys closest to headersDict, closest first, same as getClosestCSP
+        would pick them with a linear scan.
+        '''
+        sameGET = self.byGET.get(headersDict['GET'], ())
+
+        # If there is only one with the same GET request, return that
+        if len(sameGET) == 1:
+            return list(sameGET)
+
+        # If more than one, only consider those. The GET line adds -1 (same) or +1 (different)
+        # to the distance of every entry considered
+        universe = sameGET or self
+        getDistance = -1 if sameGET else 1
+        k = min(k, len(universe))
+        if k == 0:
+            return []
+
+        pairs = sorted((item for item in headersDict.items() if item[0] != 'GET'),
+                       key=lambda item: len(self.byHeader.get(item, ())))
+        if not pairs:
+            # Only a GET line: every entry is at getDistance, the first ones win
+            if not sameGET:
+                return list(itertools.islice(self, k))
+            return heapq.nsmallest(k, sameGET, key=self.order.__getitem__)
+
+        remaining = len(pairs)
+        seen = set()
+        ranked = []
+        for item in pairs:
+            new = self.byHeader.get(item, set()) - seen
+            if sameGET:
+                new &= sameGET
+            remaining -= 1
+            if new:
+                seen |= new
+                ranked = heapq.nsmallest(k, ranked + self.rank(headersDict, new, k))
+            # Strictly closer, an unseen entry at the same distance may come first in a linear scan
+            if len(ranked) == k and ranked[-1][0] < getDistance - remaining:
+                break
+        else:
+            ranked = self.rank(headersDict, universe, k)
+
+        return [key for (distance, order, key) in ranked]
+
+
 def getClosestCSP(getLUT, headersDict):
+    if isinstance(getLUT, GetLUT):
+        closest = getLUT.closest(headersDict)
+        return closest[0] if closest else None
+
     minDistance = 10000
     # If there is only one with the same GET request, return that
     closestCSPs = []
@@ -1640,61 +2355,102 @@ def merge_servers(Q):
     return newQ, senderCount
 
 
-def load_replay(replayName, Qs, LUT, getLUT, allUDPservers, udpSenderCounts):
-    replayName = replayName.replace("-", "_")
-    replay_file_dirs = replayName_to_replay_file_folders(replayName)
+def install_replay(replay, Qs, LUT, getLUT, replayIndex, allUDPservers, udpSenderCounts):
+    '''
+    Installs one replay returned by read_server_replay and merges its LUTs into the final LUT and getLUT
+    '''
     new_replay_LUT = {}
     new_replay_getLUT = {}
-    allIPs = set()
-    tcpIPs = {}
+    install_server_replay(replay, Qs, new_replay_LUT, new_replay_getLUT, replayIndex, allUDPservers, udpSenderCounts)
+    update_Qs(LUT, getLUT, set(), {}, Qs, new_replay_LUT, new_replay_getLUT)
 
-    try:
-        for replay_file_dir in replay_file_dirs:
-            load_server_replay(replay_file_dir, Qs, new_replay_LUT, new_replay_getLUT, allUDPservers, udpSenderCounts,
-                               serialize='pickle')
-            update_Qs(LUT, getLUT, allIPs, tcpIPs, Qs, new_replay_LUT, new_replay_getLUT)
-        return True
 
-    except Exception as e:
-        return False
+def load_server_replay(folder, Qs, LUT, getLUT, replayIndex, allUDPservers, udpSenderCounts, serialize='pickle'):
+    replay = read_server_replay(folder, serialize=serialize)
+    if replay is not None:
+        install_server_replay(replay, Qs, LUT, getLUT, replayIndex, allUDPservers, udpSenderCounts)
 
 
-def replayName_to_replay_file_folders(replayName):
-    replay_file_parent_folder = Configs().get("replay_parent_folder")
-    replay_file_dirs = []
-    for dir in os.listdir(replay_file_parent_folder):
-        if replayName in dir:
-            replay_file_dirs.append("{}/{}/".format(replay_file_parent_folder, dir))
+def read_server_replay(folder, serialize='pickle', pickle_file=None):
+    '''
+    Reads and decodes the server side of the replay in folder (from pickle_file if the
+    catalog already knows it), or returns None if there is none.
+    It only builds new objects (no logging either), so ReplayCache runs it in a thread.
+    '''
+    if folder == '':
+        return None
 
-    return replay_file_dirs
+    # Use the requested format if the folder has it, otherwise the pickle the parser always writes
+    if pickle_file is None:
+        files = os.listdir(folder)
+        pickle_file = ""
+        for extension in [serialize, 'pickle']:
+            matches = [file for file in files if file.endswith('_server_all.' + extension)]
+            if matches:
+                pickle_file = os.path.abspath(folder) + '/' + matches[0]
+                break
 
+    if not pickle_file:
+        return None
 
-def load_server_replay(folder, Qs, LUT, getLUT, allUDPservers, udpSenderCounts, serialize='pickle'):
-    if folder == '':
-        return
+    if Configs().get('mmapReplays'):
+        pickle_file = shared_trace_file(pickle_file)
+        Q, tmpLUT, tmpgetLUT, udpServers, tcpServerPorts, replayName = load_server_trace(pickle_file, copy=False)
+    elif pickle_file.endswith('.wtrace'):
+        Q, tmpLUT, tmpgetLUT, udpServers, tcpServerPorts, replayName = load_server_trace(pickle_file)
+    else:
+        with open(pickle_file, 'br') as server_pickle:
+            Q, tmpLUT, tmpgetLUT, udpServers, tcpServerPorts, replayName = pickle.load(server_pickle)
 
-    pickle_file = ""
-    for file in os.listdir(folder):
-        if file.endswith(('_server_all.' + serialize)):
-            pickle_file = os.path.abspath(folder) + '/' + file
-            break
+    decode_payloads(Q)
+    stats = replay_stats(Q)
+
+    # Calculating udpSenderCounts, merging Q if original_ips is off
+    udpQ = Q['udp']
+    udpSenderCount = len(Q['udp'])
+    if not Configs().get('original_ips'):
+        udpQ, udpSenderCount = merge_servers(Q['udp'])
+
+    return (folder, pickle_file, os.path.getsize(pickle_file), stats, replayName, Q['tcp'], udpQ, udpSenderCount,
+            tmpLUT, tmpgetLUT, udpServers)
 
-    if not pickle_file:
-        return
 
-    with open(pickle_file, 'br') as server_pickle:
-        Q, tmpLUT, tmpgetLUT, udpServers, tcpServerPorts, replayName = pickle.load(server_pickle)
+def replay_stats(Q):
+    '''
+    (packets, bytes, duration) the server sends for Q, before merge_servers. Response timestamps
+    are relative to their request, so a TCP connection lasts the sum of its response sets.
+    '''
+    packets = 0
+    total = 0
+    duration = 0.0
+    for csp in Q['tcp']:
+        connection_duration = 0.0
+        for response_set in Q['tcp'][csp]:
+            packets += len(response_set.response_list)
+            total += sum(len(response.payload) for response in response_set.response_list)
+            if response_set.response_list:
+                connection_duration += response_set.response_list[-1].timestamp
+        duration = max(duration, connection_duration)
+    for csp in Q['udp']:
+        packets += len(Q['udp'][csp])
+        total += sum(len(udp_set.payload) for udp_set in Q['udp'][csp])
+        if Q['udp'][csp]:
+            duration = max(duration, max(udp_set.timestamp for udp_set in Q['udp'][csp]))
+    return packets, total, duration
+
+
+def install_server_replay(replay, Qs, LUT, getLUT, replayIndex, allUDPservers, udpSenderCounts):
+    (folder, pickle_file, size, stats, replayName, tcpQ, udpQ, udpSenderCount, tmpLUT, tmpgetLUT, udpServers) = replay
 
     LOG_ACTION(logger, 'Loading for: ' + folder, pickle_file, indent=1, action=False)
 
-    Qs['tcp'][replayName] = Q['tcp']
-    Qs['udp'][replayName] = Q['udp']
+    Qs['tcp'][replayName] = tcpQ
+    Qs['udp'][replayName] = udpQ
 
     LUT[replayName] = tmpLUT
     getLUT[replayName] = tmpgetLUT
 
-    # Calculating udpSenderCounts
-    udpSenderCounts[replayName] = len(Q['udp'])
+    udpSenderCounts[replayName] = udpSenderCount
 
     # Adding to server list
     for serverIP in udpServers:
@@ -1703,12 +2459,53 @@ def load_server_replay(folder, Qs, LUT, getLUT, allUDPservers, udpSenderCounts,
         for serverPort in udpServers[serverIP]:
             allUDPservers[serverIP].add(serverPort)
 
-    # Merging Q if original_ips is off
-    if not Configs().get('original_ips'):
-        Qs['udp'][replayName], udpSenderCounts[replayName] = merge_servers(Q['udp'])
+    replayIndex[replayName] = ReplayIndex(replayName, tcpQ, udpQ, tmpLUT, size, stats)
+
+
+def shared_trace_file(replay_file):
+    '''
+    With mmapReplays the payloads are slices of a read-only mapping of a trace file, so every
+    server process on the machine shares one page cache copy of them instead of each keeping
+    its own in the Python heap. Pickled replays are converted once into replay_cache_folder.
+    '''
+    if replay_file.endswith('.wtrace'):
+        return replay_file
+
+    cache_folder = Configs().get('replay_cache_folder')
+    os.makedirs(cache_folder, exist_ok=True)
+
+    name = os.path.basename(replay_file).rpartition('.')[0]
+    trace_file = '{}/{}.{}.v{}.wtrace'.format(cache_folder, name, int(os.path.getmtime(replay_file)), TRACE_VERSION)
+    if not os.path.isfile(trace_file):
+        with open(replay_file, 'br') as server_pickle:
+            Q, tmpLUT, tmpgetLUT, udpServers, tcpServerPorts, replayName = pickle.load(server_pickle)
+        dump_server_trace(trace_file, Q, tmpLUT, tmpgetLUT, udpServers, tcpServerPorts, replayName)
+
+    return trace_file
+
+
+def decode_payloads(Q):
+    '''
+    The parser stores payloads as hex strings. Decode them once here so the
+    TCP and UDP servers can hand the bytes straight to the socket.
+    '''
+    for csp in Q['tcp']:
+        for response_set in Q['tcp'][csp]:
+            for response in response_set.response_list:
+                if isinstance(response.payload, str):
+                    response.payload = bytes.fromhex(response.payload)
+
+    for csp in Q['udp']:
+        for udp_set in Q['udp'][csp]:
+            if isinstance(udp_set.payload, str):
+                udp_set.payload = bytes.fromhex(udp_set.payload)
 
 
 def update_Qs(finalLUT, finalgetLUT, allIPs, tcpIPs, Qs, LUT, getLUT):
+    '''
+    Merges the per-replay LUTs into the final ones. finalgetLUT is a GetLUT, so the
+    GET request index used by getClosestCSP is built here as entries are added.
+    '''
     for replayName in Qs['tcp']:
         for csp in Qs['tcp'][replayName]:
             sss = csp.partition('-')[2]
@@ -1748,15 +2545,17 @@ def load_Qs():
     This loads and de-serializes all necessary objects.
     
     NOTE: the parser encodes all packet payloads into hex before serializing them.
-          So we need to decode them before starting the replay.
+          They are decoded once in load_server_replay (see decode_payloads), so the
+          queues only hold raw bytes by the time the servers start.
     '''
     Qs = {'tcp': {}, 'udp': {}}
     LUT = {}
     getLUT = {}
+    replayIndex = {}
     allUDPservers = {}
     udpSenderCounts = {}
     finalLUT = {}
-    finalgetLUT = {}
+    finalgetLUT = GetLUT()
     allIPs = set()
     tcpIPs = {}
 
@@ -1771,10 +2570,93 @@ def load_Qs():
         folders.append(pcap_folder)
 
     for folder in folders:
-        load_server_replay(folder, Qs, LUT, getLUT, allUDPservers, udpSenderCounts, serialize='pickle')
+        load_server_replay(folder, Qs, LUT, getLUT, replayIndex, allUDPservers, udpSenderCounts,
+                           serialize=Configs().get('serialize'))
         update_Qs(finalLUT, finalgetLUT, allIPs, tcpIPs, Qs, LUT, getLUT)
 
-    return Qs, finalLUT, finalgetLUT, allUDPservers, udpSenderCounts, tcpIPs, allIPs
+    return Qs, finalLUT, finalgetLUT, replayIndex, allUDPservers, udpSenderCounts, tcpIPs, allIPs
+
+
+def listener(address, kind=socket.SOCK_STREAM):
+    '''
+    What to hand to the gevent servers: the address itself, or when running several workers,
+    a socket already bound to it that joins the SO_REUSEPORT group (see reuseport_socket).
+    '''
+    workers = Configs().get('workers')
+    if workers > 1:
+        return reuseport_socket(address, kind, workers)
+    return address
+
+
+def worker_ready():
+    '''
+    Tells the supervisor this worker has bound all its sockets, so the next one can start
+    '''
+    ready_fd = Configs().get('workerReadyFd')
+    if ready_fd is not None:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+        Configs().set('workerReadyFd', None)
+
+
+def run_workers(workers):
+    '''
+    Forks the replay server workers and supervises them. This only returns in the children,
+    with the index of the worker.
+
+    All workers bind the same ports with SO_REUSEPORT and the kernel picks the worker from
+    the client IP (see reuseport_socket), so each client and all of its state lives in exactly
+    one worker. That requires socket i of every port group to belong to worker i, hence:
+        - workers are forked one at a time, each only after the previous one bound all its sockets
+        - if any worker dies the order can not be restored, so all of them are restarted
+    '''
+    children = []
+
+    def stop_children():
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        del children[:]
+
+    def on_signal(signum, frame):
+        stop_children()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, on_signal)
+
+    while True:
+        for index in range(workers):
+            ready_r, ready_w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(ready_r)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                Configs().set('workerReadyFd', ready_w)
+                return index
+
+            os.close(ready_w)
+            children.append(pid)
+            ready = os.read(ready_r, 1)
+            os.close(ready_r)
+            if not ready:
+                LOG_ACTION(logger, 'Worker {} died while starting'.format(index), level=logging.ERROR)
+                break
+            LOG_ACTION(logger, 'Worker {} running (pid {})'.format(index, pid), indent=1, action=False)
+
+        if len(children) == workers:
+            pid, status = os.waitpid(-1, 0)
+            LOG_ACTION(logger, 'Worker pid {} exited with status {}, restarting all workers'.format(pid, status),
+                       level=logging.ERROR)
+
+        stop_children()
+        time.sleep(1)
 
 
 def atExit(aliases, iperf):
@@ -1785,7 +2667,8 @@ def atExit(aliases, iperf):
     for alias in aliases:
         alias.down()
 
-    iperf.terminate()
+    if iperf is not None:
+        iperf.terminate()
 
 
 def run(*args):
@@ -1816,11 +2699,37 @@ def run(*args):
     configs.set('iperf', False)
     configs.set('iperf_port', 5555)
     configs.set('publicIP', '')
+    configs.set('mmapReplays', False)
+    configs.set('replay_cache_folder', '/tmp/wehe_replay_cache/')
+    configs.set('replayCacheMB', 4096)
+    configs.set('catalogScanInterval', 60)
+    configs.set('systemStatInterval', 1)
+    configs.set('systemStatAlpha', 0.3)
+    configs.set('whoisCacheHours', 7 * 24)
+    configs.set('sharedCapture', False)
+    configs.set('captureSnaplen', 0)
+    configs.set('captureFilter', '')
+    configs.set('postprocessWorkers', 2)
+    configs.set('postprocessBacklog', 1000)
+    configs.set('postprocessTimeout', 600)
+    configs.set('admission', 'static')
+    configs.set('capacityMbps', 2000)
+    configs.set('maxReplays', 200)
+    configs.set('admissionQueue', 50)
+    configs.set('admissionMaxWait', 120)
+    configs.set('workers', 1)
+    configs.set('coalesceResponses', False)
+    configs.set('workerIndex', 0)
+    configs.set('workerReadyFd', None)
     configs.read_args(sys.argv)
     configs.check_for(['pcap_folder'])
 
     PRINT_ACTION('Configuring paths', 0)
     configs.set('resultsFolder', configs.get('mainPath') + configs.get('resultsFolder'))
+    if not configs.is_given('postprocessFolder'):
+        configs.set('postprocessFolder', configs.get('mainPath') + 'postprocess/')
+    if not configs.is_given('captureControl'):
+        configs.set('captureControl', configs.get('mainPath') + 'capture.sock')
     configs.set('replayLog', configs.get('logsPath') + configs.get('replayLog'))
     configs.set('errorsLog', configs.get('logsPath') + configs.get('errorsLog'))
     configs.set('serverLog', configs.get('logsPath') + configs.get('serverLog'))
@@ -1863,7 +2772,7 @@ def run(*args):
         iperf = None
 
     LOG_ACTION(logger, 'Loading server queues')
-    Qs, LUT, getLUT, udpServers, udpSenderCounts, tcpIPs, allIPs = load_Qs()
+    Qs, LUT, getLUT, replayIndex, udpServers, udpSenderCounts, tcpIPs, allIPs = load_Qs()
 
     LOG_ACTION(logger, 'IP aliasing')
     alias_c = 1
@@ -1876,10 +2785,27 @@ def run(*args):
     LOG_ACTION(logger, 'Passing aliases to atExit', indent=1, action=False)
     atexit.register(atExit, aliases=aliases, iperf=iperf)
 
+    if configs.get('workers') > 1:
+        if not configs.get('original_ports'):
+            PRINT_ACTION('Running several workers requires original_ports=True', 0, action=False, exit=True)
+        LOG_ACTION(logger, 'Starting {} workers'.format(configs.get('workers')))
+        configs.set('workerIndex', run_workers(configs.get('workers')))
+        # Aliases and iperf belong to the supervisor
+        atexit.unregister(atExit)
+
+    catalog = None
+    if configs.is_given('replay_parent_folder'):
+        LOG_ACTION(logger, 'Building the replay catalog')
+        catalog = ReplayCatalog(configs.get('replay_parent_folder'),
+                                os.path.join(configs.get('replay_cache_folder'), 'catalog.json'))
+        catalog.scan()
+        LOG_ACTION(logger, '{} replays in {}'.format(len(catalog), configs.get('replay_parent_folder')), indent=1,
+                   action=False)
+
     LOG_ACTION(logger, 'Creating and running the side channel')
-    side_channel = SideChannel((configs.get('publicIP'), configs.get('sidechannel_port')), Qs, LUT, getLUT, udpServers,
-                               udpSenderCounts, notify_q,
-                               greenlets_q, ports_q, logger_q, errorlog_q)
+    side_channel = SideChannel((configs.get('publicIP'), configs.get('sidechannel_port')), Qs, LUT, getLUT,
+                               replayIndex, udpServers, udpSenderCounts, notify_q,
+                               greenlets_q, ports_q, logger_q, errorlog_q, catalog)
 
     LOG_ACTION(logger, 'Creating and running UDP servers')
     ports_done = {}
@@ -1896,7 +2822,7 @@ def run(*args):
 
             if configs.get('original_ips'):
                 server = UDPServer((ip, serverPort), Qs['udp'], notify_q, greenlets_q, ports_q, errorlog_q, LUT,
-                                   side_channel.all_clients, timing=configs.get('timing'))
+                                   side_channel.all_clients, side_channel.bindings, timing=configs.get('timing'))
                 server.run()
                 LOG_ACTION(logger, ' '.join(
                     [str(count), 'Created socket server for', str((ip, port)), '@', str(server.instance)]),
@@ -1905,7 +2831,8 @@ def run(*args):
                 count += 1
             elif port not in ports_done:
                 server = UDPServer((configs.get('publicIP'), serverPort), Qs['udp'], notify_q, greenlets_q, ports_q,
-                                   errorlog_q, LUT, side_channel.all_clients, timing=configs.get('timing'))
+                                   errorlog_q, LUT, side_channel.all_clients, side_channel.bindings,
+                                   timing=configs.get('timing'))
                 server.run()
                 ports_done[port] = server
                 LOG_ACTION(logger, ' '.join(
@@ -1942,7 +2869,8 @@ def run(*args):
             if 55557 not in ports_done:
                 server = TCPServer((configs.get('publicIP'), 55557), Qs['tcp'], greenlets_q, ports_q, errorlog_q, LUT,
                                    getLUT,
-                                   side_channel.all_clients, timing=configs.get('timing'))
+                                   side_channel.all_clients, side_channel.bindings, timing=configs.get('timing'),
+                                   coalesce=configs.get('coalesceResponses'))
                 server.run()
                 LOG_ACTION(logger, ' '.join(
                     [str(count), 'Created socket server for', str((ip, 55557)), '@', str(server.instance)]),
@@ -1952,7 +2880,8 @@ def run(*args):
 
             if configs.get('original_ips'):
                 server = TCPServer((ip, serverPort), Qs['tcp'], greenlets_q, ports_q, errorlog_q, LUT, getLUT,
-                                   side_channel.all_clients, timing=configs.get('timing'))
+                                   side_channel.all_clients, side_channel.bindings, timing=configs.get('timing'),
+                                   coalesce=configs.get('coalesceResponses'))
                 server.run()
                 LOG_ACTION(logger, ' '.join(
                     [str(count), 'Created socket server for', str((ip, port)), '@', str(server.instance)]),
@@ -1960,7 +2889,9 @@ def run(*args):
                 count += 1
             elif port not in ports_done:
                 server = TCPServer((configs.get('publicIP'), serverPort), Qs['tcp'], greenlets_q, ports_q, errorlog_q,
-                                   LUT, getLUT, side_channel.all_clients, timing=configs.get('timing'))
+                                   LUT, getLUT, side_channel.all_clients, side_channel.bindings,
+                                   timing=configs.get('timing'),
+                                   coalesce=configs.get('coalesceResponses'))
                 server.run()
                 ports_done[port] = server
                 LOG_ACTION(logger, ' '.join(
@@ -0,0 +1,430 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: compact binary format for parsed replay traces (*_server_all.wtrace, *_client_all.wtrace)
+
+The pickles written by the parser hold every packet as a Python object with a hex encoded
+payload. A trace file stores the same content in four sections:
+
+    header   : TRACE_HEADER, i.e. magic, format version, kind (server/client), metadata length
+    metadata : JSON with everything that is not per packet (replayName, LUTs, ports, csp table)
+               and the (offset, length) of every section below
+    columns  : one array per field, one entry per packet (proto, flags, csp id, aux, timestamp,
+               payload offset, payload length), plus the request/response hashes
+    payloads : all packet payloads back to back, as raw bytes
+
+All numbers are little-endian and every section starts on an 8 byte boundary.
+The files are read through mmap, so loading a replay is a handful of array copies and
+payload slices instead of unpickling.
+
+Usage:
+    python replay_trace.py --replay_parent_folder=../replayTraces/
+
+    Converts every *_server_all.pickle and *_client_all.pickle (or *_client_all.json) under
+    replay_parent_folder into .wtrace files next to them. Use serialize=wtrace to load them.
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, json, mmap, struct, pickle
+from array import array
+from python_lib import *
+
+TRACE_MAGIC = b'WEHETRC\x00'
+TRACE_VERSION = 2
+TRACE_HEADER = struct.Struct('<8sHHI')
+
+KIND_SERVER = 1
+KIND_CLIENT = 2
+
+PROTO_TCP = 0
+PROTO_UDP = 1
+
+FLAG_END = 1
+FLAG_HASH = 2
+
+NO_HASH = bytes(20)
+
+# (name, array typecode) of the per-packet columns, in file order
+PACKET_COLUMNS = [('proto', 'B'), ('flags', 'B'), ('csp', 'I'), ('aux', 'I'),
+                  ('timestamp', 'd'), ('offset', 'Q'), ('length', 'I')]
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _payload_bytes(payload):
+    '''
+    Payloads coming from the parser are hex strings, the ones already loaded by the
+    servers are bytes. An odd-length hex string means a corrupt trace, so it is refused
+    rather than replayed with its last nibble dropped.
+    '''
+    if isinstance(payload, str):
+        if len(payload) % 2:
+            raise ValueError('Odd-length hex payload ({} digits)'.format(len(payload)))
+        return bytes.fromhex(payload)
+    return bytes(payload)
+
+
+def _hash_bytes(theHash):
+    if theHash is None:
+        return NO_HASH
+    return bytes.fromhex(theHash)
+
+
+class TraceBuilder(object):
+    '''
+    Collects packets column by column and writes them out as a trace file
+    '''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.columns = dict((name, array(code)) for (name, code) in PACKET_COLUMNS)
+        self.extra = {}
+        self.csps = []
+        self.cspIDs = {}
+        self.blob = bytearray()
+
+    def csp_id(self, csp):
+        if csp not in self.cspIDs:
+            self.cspIDs[csp] = len(self.csps)
+            self.csps.append(csp)
+        return self.cspIDs[csp]
+
+    def add_packet(self, proto, flags, csp, aux, timestamp, payload):
+        payload = _payload_bytes(payload)
+        self.columns['proto'].append(proto)
+        self.columns['flags'].append(flags)
+        self.columns['csp'].append(self.csp_id(csp))
+        self.columns['aux'].append(aux)
+        self.columns['timestamp'].append(timestamp)
+        self.columns['offset'].append(len(self.blob))
+        self.columns['length'].append(len(payload))
+        self.blob += payload
+
+    def write(self, path, meta):
+        sections = []
+        position = 0
+        data = []
+        for (name, code) in PACKET_COLUMNS:
+            data.append((name, self.columns[name]))
+        for name in sorted(self.extra):
+            data.append((name, self.extra[name]))
+
+        chunks = []
+        for (name, column) in data:
+            if isinstance(column, array):
+                if sys.byteorder != 'little':
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                raw = column.tobytes()
+            else:
+                raw = bytes(column)
+            sections.append([name, position, len(raw)])
+            chunks.append((position, raw))
+            position = _align(position + len(raw))
+        sections.append(['payloads', position, len(self.blob)])
+        chunks.append((position, bytes(self.blob)))
+
+        meta = dict(meta)
+        meta['csps'] = self.csps
+        meta['packets'] = len(self.columns['proto'])
+        meta['sections'] = sections
+        meta = json.dumps(meta).encode()
+
+        dataStart = _align(TRACE_HEADER.size + len(meta))
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmpPath, 'wb') as f:
+            f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, self.kind, len(meta)))
+            f.write(meta)
+            for (offset, raw) in chunks:
+                f.seek(dataStart + offset)
+                f.write(raw)
+        os.replace(tmpPath, path)
+
+
+class TraceFile(object):
+    '''
+    Read-only, memory-mapped view of a trace file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.kind, metaLen = TRACE_HEADER.unpack_from(self.mm, 0)
+        if magic != TRACE_MAGIC:
+            raise ValueError('Not a replay trace file: {}'.format(path))
+        if version != TRACE_VERSION:
+            raise ValueError('Unsupported replay trace version {} in {}'.format(version, path))
+
+        self.meta = json.loads(self.mm[TRACE_HEADER.size:TRACE_HEADER.size + metaLen].decode())
+        self.dataStart = _align(TRACE_HEADER.size + metaLen)
+        self.sections = dict((name, (self.dataStart + offset, length))
+                             for (name, offset, length) in self.meta['sections'])
+        self.payloadStart = self.sections['payloads'][0]
+
+    def column(self, name, code):
+        start, length = self.sections[name]
+        column = array(code)
+        column.frombytes(self.mm[start:start + length])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        return column
+
+    def raw(self, name):
+        start, length = self.sections[name]
+        return self.mm[start:start + length]
+
+    def packets(self):
+        return [self.column(name, code) for (name, code) in PACKET_COLUMNS]
+
+    def payload(self, offset, length):
+        start = self.payloadStart + offset
+        return self.mm[start:start + length]
+
+    def close(self):
+        self.mm.close()
+
+
+def dump_server_trace(path, Q, LUT, getLUT, udpServers, tcpServerPorts, replayName):
+    '''
+    Writes the same objects the parser pickles into *_server_all.pickle
+    '''
+    trace = TraceBuilder(KIND_SERVER)
+    setCSP = array('I')
+    setLen = array('I')
+    setFlags = array('B')
+    setHash = bytearray()
+
+    for csp in Q['tcp']:
+        trace.csp_id(csp)
+        for response_set in Q['tcp'][csp]:
+            setIndex = len(setLen)
+            setCSP.append(trace.csp_id(csp))
+            setLen.append(response_set.request_len)
+            setFlags.append(0 if response_set.request_hash is None else FLAG_HASH)
+            setHash += _hash_bytes(response_set.request_hash)
+            for response in response_set.response_list:
+                trace.add_packet(PROTO_TCP, 0, csp, setIndex, response.timestamp, response.payload)
+
+    for csp in Q['udp']:
+        trace.csp_id(csp)
+        for udp_set in Q['udp'][csp]:
+            trace.add_packet(PROTO_UDP, FLAG_END if udp_set.end else 0, csp, 0, udp_set.timestamp, udp_set.payload)
+
+    trace.extra['set_csp'] = setCSP
+    trace.extra['set_len'] = setLen
+    trace.extra['set_flags'] = setFlags
+    trace.extra['set_hash'] = setHash
+
+    meta = {'replayName': replayName,
+            'tcp': list(Q['tcp'].keys()),
+            'udp': list(Q['udp'].keys()),
+            'LUT': LUT,
+            'getLUT': [[key[0], key[1], getLUT[key]] for key in getLUT],
+            'udpServers': dict((ip, list(udpServers[ip])) for ip in udpServers),
+            'tcpServerPorts': list(tcpServerPorts)}
+
+    trace.write(path, meta)
+
+
+def load_server_trace(path, copy=True):
+    '''
+    Returns (Q, LUT, getLUT, udpServers, tcpServerPorts, replayName), exactly like
+    unpickling *_server_all.pickle, except payloads are already bytes.
+
+    With copy=False payloads are memoryview slices of the mapped file instead of bytes,
+    so every process mapping the same trace shares one copy of them (the mapping stays
+    open for as long as any payload is referenced).
+    '''
+    trace = TraceFile(path)
+    meta = trace.meta
+    csps = meta['csps']
+    proto, flags, cspIDs, aux, timestamps, offsets, lengths = trace.packets()
+
+    if copy:
+        payload = trace.payload
+    else:
+        view = memoryview(trace.mm)
+        start = trace.payloadStart
+        payload = lambda offset, length: view[start + offset:start + offset + length]
+
+    Q = {'tcp': {}, 'udp': {}}
+    for csp in meta['tcp']:
+        Q['tcp'][csp] = []
+    for csp in meta['udp']:
+        Q['udp'][csp] = []
+
+    sets = []
+    setCSP = trace.column('set_csp', 'I')
+    setLen = trace.column('set_len', 'I')
+    setHash = trace.raw('set_hash')
+    setFlags = trace.column('set_flags', 'B')
+    for i in range(len(setLen)):
+        response_set = ResponseSet('', [])
+        response_set.request_len = setLen[i]
+        if setFlags[i] & FLAG_HASH:
+            response_set.request_hash = setHash[i * 20:(i + 1) * 20].hex()
+        else:
+            response_set.request_hash = None
+        Q['tcp'][csps[setCSP[i]]].append(response_set)
+        sets.append(response_set)
+
+    for i in range(len(proto)):
+        data = payload(offsets[i], lengths[i])
+        if proto[i] == PROTO_TCP:
+            sets[aux[i]].response_list.append(OneResponse(data, timestamps[i]))
+        else:
+            csp = csps[cspIDs[i]]
+            Q['udp'][csp].append(UDPset(data, timestamps[i], csp, bool(flags[i] & FLAG_END)))
+
+    LUT = {}
+    for protocol in meta['LUT']:
+        LUT[protocol] = dict((x, tuple(value)) for (x, value) in meta['LUT'][protocol].items())
+
+    getLUT = {}
+    for (name, csp, headers) in meta['getLUT']:
+        getLUT[(name, csp)] = headers
+
+    if copy:
+        trace.close()
+
+    return Q, LUT, getLUT, meta['udpServers'], meta['tcpServerPorts'], meta['replayName']
+
+
+def dump_client_trace(path, Q, udpClientPorts, tcpCSPs, replayName):
+    '''
+    Writes the same objects the parser pickles into *_client_all.pickle
+    '''
+    trace = TraceBuilder(KIND_CLIENT)
+    responseHash = bytearray()
+
+    for p in Q:
+        if isinstance(p, RequestSet):
+            flags = 0 if p.response_hash is None else FLAG_HASH
+            trace.add_packet(PROTO_TCP, flags, p.c_s_pair, p.response_len, p.timestamp, p.payload)
+            responseHash += _hash_bytes(p.response_hash)
+        else:
+            trace.add_packet(PROTO_UDP, FLAG_END if p.end else 0, p.c_s_pair, 0, p.timestamp, p.payload)
+            responseHash += NO_HASH
+
+    trace.extra['response_hash'] = responseHash
+
+    meta = {'replayName': replayName,
+            'udpClientPorts': list(udpClientPorts),
+            'tcpCSPs': list(tcpCSPs)}
+
+    trace.write(path, meta)
+
+
+def load_client_trace(path):
+    '''
+    Returns (Q, udpClientPorts, tcpCSPs, replayName) like unpickling *_client_all.pickle,
+    with payloads as bytes.
+    '''
+    trace = TraceFile(path)
+    meta = trace.meta
+    csps = meta['csps']
+    proto, flags, cspIDs, aux, timestamps, offsets, lengths = trace.packets()
+    responseHash = trace.raw('response_hash')
+
+    Q = []
+    for i in range(len(proto)):
+        data = trace.payload(offsets[i], lengths[i])
+        csp = csps[cspIDs[i]]
+        if proto[i] == PROTO_TCP:
+            p = RequestSet(data, csp, None, timestamps[i])
+            if flags[i] & FLAG_HASH:
+                p.setHash_len(responseHash[i * 20:(i + 1) * 20].hex(), aux[i])
+            Q.append(p)
+        else:
+            Q.append(UDPset(data, timestamps[i], csp, bool(flags[i] & FLAG_END)))
+
+    trace.close()
+
+    return Q, meta['udpClientPorts'], meta['tcpCSPs'], meta['replayName']
+
+
+def load_client_json(json_file):
+    '''
+    TCPjsonDecoder_client only knows about TCP packets, this one also keeps the UDP ones
+    '''
+    with open(json_file, 'r') as f:
+        Q, udpClientPorts, tcpCSPs, replayName = json.load(f)
+
+    clientQ = []
+    for p in Q:
+        if 'response_len' in p:
+            req = RequestSet(p['payload'], p['c_s_pair'], None, p['timestamp'])
+            req.setHash_len(p['response_hash'], p['response_len'])
+            clientQ.append(req)
+        else:
+            clientQ.append(UDPset(p['payload'], p['timestamp'], p['c_s_pair'], p['end']))
+
+    return clientQ, udpClientPorts, tcpCSPs, replayName
+
+
+def convert_folder(folder):
+    '''
+    Creates the .wtrace counterparts of the server/client files of one replay folder
+    '''
+    converted = []
+    files = os.listdir(folder)
+    for file in files:
+        path = os.path.join(folder, file)
+        if file.endswith('_server_all.pickle'):
+            with open(path, 'rb') as f:
+                Q, LUT, getLUT, udpServers, tcpServerPorts, replayName = pickle.load(f)
+            target = path[:-len('pickle')] + 'wtrace'
+            dump_server_trace(target, Q, LUT, getLUT, udpServers, tcpServerPorts, replayName)
+            converted.append(target)
+
+        elif file.endswith('_client_all.pickle') or (file.endswith('_client_all.json')
+                                                     and file[:-len('json')] + 'pickle' not in files):
+            if file.endswith('.pickle'):
+                with open(path, 'rb') as f:
+                    Q, udpClientPorts, tcpCSPs, replayName = pickle.load(f)
+                target = path[:-len('pickle')] + 'wtrace'
+            else:
+                Q, udpClientPorts, tcpCSPs, replayName = load_client_json(path)
+                target = path[:-len('json')] + 'wtrace'
+            dump_client_trace(target, Q, udpClientPorts, tcpCSPs, replayName)
+            converted.append(target)
+
+    return converted
+
+
+def main():
+    configs = Configs()
+    configs.set('replay_parent_folder', '../replayTraces/')
+    configs.read_args(sys.argv)
+
+    parent = configs.get('replay_parent_folder')
+    for folder in sorted(os.listdir(parent)):
+        folder = os.path.join(parent, folder)
+        if not os.path.isdir(folder):
+            continue
+        for target in convert_folder(folder):
+            PRINT_ACTION('Created {} ({} bytes)'.format(target, os.path.getsize(target)), 1, action=False)
+
+
+if __name__ == "__main__":
+    main()
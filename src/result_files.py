@@ -0,0 +1,176 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: find the result files of a test without listing (or globbing) the user's folders
+
+The files of a test are at fixed paths under <folder>/<userID>/ (result_file):
+    replayInfo/replayInfo_<userID>_<historyCount>_<testID>.json
+    clientXputs/Xput_<userID>_<historyCount>_<testID>.json
+    decisions/results_<userID>_<side>_<historyCount>_<testID>.json
+
+Files that are not at their fixed path are recorded in the manifest of their history count,
+<folder>/<userID>/manifest/<historyCount>.json:
+    {kind: {"<testID>": file name}}
+updated under an exclusive lock (<historyCount>.json.lock) and replaced atomically, as the replay
+server and the analyzer workers write to the same folders. find_file looks at the fixed path, and
+only if there is nothing there reads the manifest, so files named otherwise (e.g. older results)
+are found once recorded, and so are the files moved to the permanent results folder (recorded with
+their absolute path). Writers of files at their fixed path do not record anything.
+A manifest only holds the tests of one history count, so looking a file up does not get slower
+as the user runs more tests.
+
+Usage, to record the files already in the folders of some (or all) users:
+    python result_files.py <folder> [userID ...]
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, json, fcntl, errno, shutil
+
+FILE_NAMES = {'replayInfo': 'replayInfo_{userID}_{historyCount}_{testID}.json',
+              'clientXputs': 'Xput_{userID}_{historyCount}_{testID}.json',
+              'decisions': 'results_{userID}_{side}_{historyCount}_{testID}.json'}
+
+SIDES = ['Client', 'Server']
+
+
+def result_file(folder, userID, kind, historyCount, testID, side='Client'):
+    return os.path.join(folder, userID, kind, FILE_NAMES[kind].format(userID=userID, historyCount=historyCount,
+                                                                       testID=testID, side=side))
+
+
+def is_result_file(folder, userID, kind, historyCount, testID, path):
+    '''
+    Whether path is the fixed path of the file (of either side, for decisions)
+    '''
+    return any(os.path.abspath(path) == os.path.abspath(result_file(folder, userID, kind, historyCount, testID, side))
+               for side in SIDES)
+
+
+def manifest_file(folder, userID, historyCount):
+    return os.path.join(folder, userID, 'manifest', '{}.json'.format(historyCount))
+
+
+def load_manifest(folder, userID, historyCount):
+    try:
+        with open(manifest_file(folder, userID, historyCount), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def record_files(folder, userID, files):
+    '''
+    Records every (kind, historyCount, testID, path) of files in the manifest, or removes the entry
+    if path is None. Paths out of the kind folder (e.g. moved to the permanent results folder) are
+    recorded as absolute paths. Files at their fixed path are skipped, find_file finds them anyway.
+    '''
+    files = [(kind, historyCount, testID, path) for (kind, historyCount, testID, path) in files
+             if path is None or not is_result_file(folder, userID, kind, historyCount, testID, path)]
+    byHistoryCount = {}
+    for (kind, historyCount, testID, path) in files:
+        byHistoryCount.setdefault(str(historyCount), []).append((kind, str(testID), path))
+
+    for (historyCount, entries) in byHistoryCount.items():
+        manifestFile = manifest_file(folder, userID, historyCount)
+        os.makedirs(os.path.dirname(manifestFile), exist_ok=True)
+        with open(manifestFile + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = load_manifest(folder, userID, historyCount)
+            for (kind, testID, path) in entries:
+                if path is None:
+                    manifest.get(kind, {}).pop(testID, None)
+                elif os.path.dirname(os.path.abspath(path)) == os.path.abspath(os.path.join(folder, userID, kind)):
+                    manifest.setdefault(kind, {})[testID] = os.path.basename(path)
+                else:
+                    manifest.setdefault(kind, {})[testID] = os.path.abspath(path)
+            tmpFile = manifestFile + '.tmp'
+            with open(tmpFile, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmpFile, manifestFile)
+
+
+def record_file(folder, userID, kind, historyCount, testID, path):
+    record_files(folder, userID, [(kind, historyCount, testID, path)])
+
+
+def find_file(folder, userID, kind, historyCount, testID, side='Client', manifests=None):
+    '''
+    Path of the kind file of the test, None if there is none. The manifest is only read if the file
+    is not at its fixed path. Pass a dict as manifests when looking for many files of the same user,
+    the manifests read are kept in it by history count.
+    '''
+    path = result_file(folder, userID, kind, historyCount, testID, side)
+    if os.path.isfile(path):
+        return path
+    if manifests is None:
+        manifests = {}
+    if str(historyCount) not in manifests:
+        manifests[str(historyCount)] = load_manifest(folder, userID, historyCount)
+    name = manifests[str(historyCount)].get(kind, {}).get(str(testID))
+    # os.path.join keeps absolute names as they are
+    if name and os.path.isfile(os.path.join(folder, userID, kind, name)):
+        return os.path.join(folder, userID, kind, name)
+    return None
+
+
+def move_file(path, targetFolder):
+    '''
+    Moves path into targetFolder and returns the new path. Atomic (os.replace) on the same file
+    system, copied to a temporary file first otherwise.
+    '''
+    target = os.path.join(targetFolder, os.path.basename(path))
+    try:
+        os.replace(path, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(path, target + '.tmp')
+        os.replace(target + '.tmp', target)
+        os.remove(path)
+    return target
+
+
+def rebuild_manifest(folder, userID):
+    '''
+    Records the <anything>_<historyCount>_<testID>.json files in the user's folders that are not at
+    their fixed path
+    '''
+    files = []
+    for kind in FILE_NAMES:
+        kindFolder = os.path.join(folder, userID, kind)
+        if not os.path.isdir(kindFolder):
+            continue
+        for file in sorted(os.listdir(kindFolder)):
+            name, _, ext = file.rpartition('.')
+            parts = name.rsplit('_', 2)
+            if ext == 'json' and len(parts) == 3:
+                files.append((kind, parts[1], parts[2], os.path.join(kindFolder, file)))
+    record_files(folder, userID, files)
+    return len(files)
+
+
+def main():
+    folder = sys.argv[1]
+    userIDs = sys.argv[2:] or [userID for userID in os.listdir(folder) if os.path.isdir(os.path.join(folder, userID))]
+    for userID in userIDs:
+        print('{}\t{}'.format(userID, rebuild_manifest(folder, userID)))
+
+
+if __name__ == "__main__":
+    main()
@@ -24,13 +24,19 @@ matplotlib.use('Agg')
 import sys
 
 sys.path.append('..')
-import subprocess, random, numpy
+import subprocess, math, functools, numpy
 from python_lib import *
+from pcap_analysis import adjusted_xput, xput_stats, rtt_samples
 import matplotlib.pyplot as plt
 import scipy.stats
-from scipy.stats import ks_2samp
 from scipy import interpolate, integrate
 
+# Largest (resamples x ranks) histogram sampleKS2Batch builds at once
+KS2_BATCH_CELLS = 4000000
+
+# Largest sample size with exact K-S p-values, as ks_2samp(method='auto')
+KS2_EXACT_MAX_N = 10000
+
 DEBUG = 0
 
 
@@ -81,59 +87,12 @@ def checkTsharkVersion(targetVersion, exit=True):
     return False
 
 
-def parseTsharkXputOutput(output):
-    '''
-    ************ WORKS WITH tshark 1.12.1 ONLY ************
-    
-    Takes the output of tshark xput command, i.e. tshark -qz io,stat,interval 
-    and parses the results into an ordered list 
-    '''
-    data_points = []
-    lines = output.splitlines()
-    end = lines[4].partition('Duration:')[2].partition('secs')[0].replace(' ', '')
-    lines[-2] = lines[-2].replace('Dur', end)
-
-    for l in lines:
-        if '<>' not in l:
-            continue
-
-        l = l.replace('|', '')
-        l = l.replace('<>', '')
-        parsed = list(map(float, l.split()))
-        dur = float(parsed[1]) - float(parsed[0])
-        try:
-            xput = round(float(parsed[-1]) / dur, 2)
-        except ZeroDivisionError:
-            continue
-        data_points.append(xput)
-
-    # converting to Mbits/sec
-    data_points = [x * 8 / 1000000.0 for x in data_points]
-
-    return data_points, end
-
-
 def xputTshark(pcapFile, xputBuckets):
     '''
-    Given a pcap the calculates total xput stats.
+    Given a pcap the calculates total xput stats (100 intervals, retransmissions excluded),
+    read directly from the pcap, see pcap_analysis.xput_stats.
     '''
-
-    dcmd = ['tshark', '-r', pcapFile, '-T', 'fields', '-e', 'frame.time_relative']
-    dp = subprocess.Popen(dcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    doutput, derr = dp.communicate()
-    # tshark -r <filename> -R "tcp.stream eq <index>" -T fields -e frame.time_epoch
-    duration = doutput.splitlines()[-1]
-    # Dynamic xputInterval = (replay duration / # buckets)
-    xputInterval = float(duration) / 100
-
-    p = subprocess.Popen(
-        ['tshark', '-r', pcapFile, '-qz', 'io,stat,' + str(xputInterval) + ',not tcp.analysis.retransmission'],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, err = p.communicate()
-    output = output.decode('ascii', 'ignore')
-    # output = output.decode()
-    xputList, end = parseTsharkXputOutput(output)
-    return xputList, end
+    return xput_stats(pcapFile, 100)
 
 
 def addOverhead(x, ethOnly=False):
@@ -148,51 +107,11 @@ def addOverhead(x, ethOnly=False):
 
 
 def adjustedXput(pcapPath, xputBuckets, ethOnly=True):
-    # ADJUST xputInterval according to the time bucket value
-    dcmd = ['tshark', '-r', pcapPath, '-T', 'fields', '-e', 'frame.time_relative']
-    dp = subprocess.Popen(dcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    doutput, derr = dp.communicate()
-    # tshark -r <filename> -R "tcp.stream eq <index>" -T fields -e frame.time_epoch
-    duration = doutput.splitlines()[-1]
-    # Dynamic xputInterval = (replay duration / # buckets)
-    xputInterval = float(duration) / xputBuckets
-
-    cmd = ['tshark', '-r', pcapPath, '-qz', 'io,stat,' + str(xputInterval)]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, err = p.communicate()
-    output = output.decode('ascii', 'ignore')
-
-    # Parse tshark output
-    lines = output.splitlines()
-    end = lines[4].partition('Duration:')[2].partition('secs')[0].replace(' ', '')
-    lines[-2] = lines[-2].replace('Dur', end)
-
-    ts = []
-    xput = []
-
-    for l in lines:
-        if '<>' not in l:
-            continue
-
-        l = l.replace('|', '')
-        l = l.replace('<>', '')
-        parsed = list(map(float, l.split()))
-
-        start = float(parsed[0])
-        end = float(parsed[1])
-        dur = end - start
-
-        # if dur == 0:
-        if dur == 0 or ((float(parsed[-1]) / dur) * 8 / 1000000.0 == 0):
-            continue
-
-        ts.append(end)
-        xput.append(float(parsed[-1]) / dur)
-
-    xput = [x * 8 / 1000000.0 for x in xput]
-
-    # Ignore the last data point, where the interval is less than sampling interval
-    return xput[:-1], ts[:-1]
+    '''
+    Xput of every (duration / xputBuckets) interval, read directly from the pcap,
+    see pcap_analysis.adjusted_xput. The last interval, shorter than the others, is ignored.
+    '''
+    return adjusted_xput(pcapPath, xputBuckets)
 
 
 def rttTshark_TCP(pcapFile, serverIP=None, clientIP=None):
@@ -209,35 +128,7 @@ def rttTshark_TCP(pcapFile, serverIP=None, clientIP=None):
         print('Please provide either client or server IP')
         sys.exit()
 
-    cmd = ['tshark', '-r', pcapFile, '-T', 'fields', '-E', 'separator=/t', '-e', 'ip.src', '-e', 'tcp.analysis.ack_rtt']
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    #     p           = subprocess.Popen(cmd)
-    output, err = p.communicate()
-    #     print output
-    #     print 'err:', err
-
-    rttList = []
-
-    for l in output.splitlines():
-        l = l.split('\t')
-        srcIP = l[0]
-
-        if serverIP is not None:
-            if srcIP == serverIP:
-                continue
-
-        if clientIP is not None:
-            if srcIP != clientIP:
-                continue
-
-        try:
-            rtt = float(l[1])
-        except:
-            continue
-
-        rttList.append(rtt)
-
-    return rttList
+    return rtt_samples(pcapFile, serverIP, clientIP).tolist()
 
 
 def list2CDF(xput):
@@ -265,66 +156,193 @@ def sampleKS2(list1, list2, greater=True, alpha=0.95, sub=0.5, r=100):
     conclude that the original K-S test statistic is valid.
     '''
 
-    results = []
-    accept = 0.0
-
-    for i in range(r):
-        sub1 = random.sample(list1, int(len(list1) * sub))
-        sub2 = random.sample(list2, int(len(list2) * sub))
-        res = ks_2samp(sub1, sub2)
-        results.append(res)
-
-        pVal = res[1]
-        if greater:
-            if pVal > (1 - alpha):
-                accept += 1
-        else:
-            if pVal < (1 - alpha):
-                accept += 1
+    return sampleKS2Batch([(list1, list2)], [greater], alpha, sub, r)[0]
 
-    dVal_avg = numpy.average([x[0] for x in results])
-    pVal_avg = numpy.average([x[1] for x in results])
 
-    return dVal_avg, pVal_avg, accept / r
+def sampleKS2Batch(pairs, greaters, alpha=0.95, sub=0.5, r=100):
+    '''
+    sampleKS2 of every (list1, list2) of pairs, with greaters[i] for pairs[i]. The resamples of
+    all the pairs with the same sizes are tested together, one row each.
+    '''
+    results = [(numpy.nan, numpy.nan, 0.0)] * len(pairs)
+    groups = {}
+    for (i, (list1, list2)) in enumerate(pairs):
+        if int(len(list1) * sub) and int(len(list2) * sub):
+            groups.setdefault((len(list1), len(list2)), []).append(i)
+
+    for ((len1, len2), group) in groups.items():
+        n1, n2 = int(len1 * sub), int(len2 * sub)
+        # Chunks of pairs small enough for the (rows x ranks) histograms of ks2_statistics
+        size = max(1, KS2_BATCH_CELLS // (r * (len1 + len2)))
+        for start in range(0, len(group), size):
+            indexes = group[start:start + size]
+            # The K-S statistic only depends on the order of the values, so the samples are drawn
+            # from their ranks
+            ranks, levels = zip(*[ranks_of(*pairs[i]) for i in indexes])
+            ranks = numpy.array(ranks)
+            # One jackknife subsample per row, drawn without replacement, r rows per pair
+            sub1 = subsamples(ranks[:, :len1], n1, r)
+            sub2 = subsamples(ranks[:, len1:], n2, r)
+            dVals = ks2_statistics(sub1, sub2, max(levels)).reshape(len(indexes), r)
+            pVals = ks2_pvalues(dVals.ravel(), n1, n2).reshape(len(indexes), r)
+
+            for (row, i) in enumerate(indexes):
+                if greaters[i]:
+                    accept = numpy.count_nonzero(pVals[row] > (1 - alpha))
+                else:
+                    accept = numpy.count_nonzero(pVals[row] < (1 - alpha))
+                results[i] = (numpy.average(dVals[row]), numpy.average(pVals[row]), float(accept) / r)
+
+    return results
+
+
+def ranks_of(list1, list2):
+    '''
+    (ranks, levels): the rank of every value of list1 + list2 among the levels distinct values
+    '''
+    unique, ranks = numpy.unique(numpy.concatenate([list1, list2]), return_inverse=True)
+    return ranks.reshape(-1), len(unique)
+
+
+def subsamples(values, size, r):
+    '''
+    r rows per row of values (or r rows if values is a list), each a random sample without
+    replacement of size of its values
+    '''
+    values = numpy.repeat(numpy.atleast_2d(values), r, axis=0)
+    if size >= values.shape[1]:
+        return values
+    indexes = numpy.argpartition(numpy.random.random(values.shape), size, axis=1)[:, :size]
+    return numpy.take_along_axis(values, indexes, axis=1)
+
+
+def ks2_test(list1, list2):
+    '''
+    (statistic, p-value) of ks_2samp(list1, list2), nan if one of them is empty
+    '''
+    if not len(list1) or not len(list2):
+        return numpy.nan, numpy.nan
+    ranks, levels = ranks_of(list1, list2)
+    d = ks2_statistics(ranks[None, :len(list1)], ranks[None, len(list1):], levels)[0]
+    return d, ks2_pvalue(float(d), len(list1), len(list2))
+
+
+def ks2_statistics(ranks1, ranks2, levels):
+    '''
+    Two sided K-S statistic (as ks_2samp) of every row of ranks1 against the same row of ranks2,
+    the samples being given as the ranks (integers in [0, levels)) of their values
+    '''
+    r, n1 = ranks1.shape
+    n2 = ranks2.shape[1]
+    # Number of values <= each rank, per row: the cumulated histogram of the (row, rank) pairs
+    rows = numpy.arange(r)[:, None] * levels
+    cdf1 = numpy.bincount((ranks1 + rows).ravel(), minlength=r * levels).reshape(r, levels).cumsum(axis=1)
+    cdf2 = numpy.bincount((ranks2 + rows).ravel(), minlength=r * levels).reshape(r, levels).cumsum(axis=1)
+    # n1 * n2 * (cdf1 - cdf2), in integers
+    diffs = cdf1 * n2 - cdf2 * n1
+    return numpy.maximum(diffs.max(axis=1), -diffs.min(axis=1)) / float(n1 * n2)
+
+
+def ks2_pvalues(dVals, n1, n2):
+    '''
+    ks_2samp p-values of the statistics dVals (sample sizes n1 and n2), computed once per distinct value
+    '''
+    unique, inverse = numpy.unique(dVals, return_inverse=True)
+    pVals = numpy.array([ks2_pvalue(float(d), n1, n2) for d in unique])
+    return pVals[inverse.reshape(-1)]
+
+
+@functools.lru_cache(maxsize=10000)
+def ks2_pvalue(d, n1, n2):
+    '''
+    p-value of ks_2samp (method auto, two-sided) for the statistic d: exact up to KS2_EXACT_MAX_N
+    samples, asymptotic (scipy.stats.kstwo) beyond
+    '''
+    if max(n1, n2) <= KS2_EXACT_MAX_N:
+        # d is a multiple of 1 / lcm(n1, n2)
+        h = int(round(d * (n1 // math.gcd(n1, n2)) * n2))
+        return ks2_exact_pvalue(n1, n2, h) if h else 1.0
+    m, n = sorted([float(n1), float(n2)], reverse=True)
+    return numpy.clip(scipy.stats.kstwo.sf(d, numpy.round(m * n / (m + n))), 0, 1)
+
+
+def ks2_exact_pvalue(n1, n2, h):
+    '''
+    Probability that two samples of sizes n1 and n2 from the same distribution are at least
+    h / lcm(n1, n2) apart (two sided K-S statistic), the exact method of ks_2samp.
+
+    Every order of the n1 + n2 values is a lattice path from (0, 0) to (n1, n2), all equally likely,
+    and the statistic is reached when the path leaves the band |i * n2 - j * n1| < h * gcd(n1, n2).
+    inside[j] is the share of the paths to (i, j) that stayed in the band so far, only the columns
+    j in the band of row i are updated. The p-value is 1 - the share of paths that stayed inside,
+    so p-values below about 1e-15 come out as 0.
+    '''
+    bound = h * math.gcd(n1, n2)
+    inside = [1.0 if j * n1 < bound else 0.0 for j in range(n2 + 1)]
+    for i in range(1, n1 + 1):
+        # columns with |i * n2 - j * n1| < bound
+        low = max((i * n2 - bound) // n1 + 1, 0)
+        high = min((i * n2 + bound - 1) // n1, n2)
+        previous = 0.0
+        for j in range(low, high + 1):
+            previous = (inside[j] * i + previous * j) / (i + j)
+            inside[j] = previous
+    return min(max(1.0 - inside[n2], 0.0), 1.0)
 
 
 def doTests(list1, list2, alpha=0.95):
-    list1_nonzero = [x for x in list1 if x > 0]
-    list2_nonzero = [x for x in list2 if x > 0]
-    if not list1_nonzero:
-        list1 = [0] * 10
-    if not list2_nonzero:
-        list2 = [0] * 10
-
-    # x1, y1 = list2CDF(list1)
-    # f1 = interpolate.interp1d(y1, x1)
-
-    # x2, y2 = list2CDF(list2)
-    # f2 = interpolate.interp1d(y2, x2)
-
-    # this essentially computes the difference between averages
-    # f1 is original and f2 is the random replay
-    # diffFunc = lambda x: f2(x) - f1(x)
-    # (area, err) = integrate.quad(diffFunc, 0.001, 1, limit=1000)
-
-    (xputMax1, xputMin1, xputAvg1, xputMed1, xputStd1) = (
-    max(list1), min(list1), numpy.average(list1), numpy.median(list1), numpy.std(list1))
-    (xputMax2, xputMin2, xputAvg2, xputMed2, xputStd2) = (
-    max(list2), min(list2), numpy.average(list2), numpy.median(list2), numpy.std(list2))
-    area = xputAvg2 - xputAvg1
-
-    xputMin = min(list1 + list2)
-    areaOvar = float(area) / max(xputAvg1, xputAvg2)
-    (ks2dVal, ks2pVal) = ks_2samp(list1_nonzero, list2_nonzero)
-    greater = True
-    if ks2pVal < (1 - alpha):
-        greater = False
-    [dVal_avg, pVal_avg, ks2AcceptRatio] = sampleKS2(list1, list2, greater, alpha=alpha)
-
-    return [areaOvar, ks2AcceptRatio, area, 0,
-            (xputMax1, xputMin1, xputAvg1, xputMed1, xputStd1),
-            (xputMax2, xputMin2, xputAvg2, xputMed2, xputStd2),
-            xputMin, dVal_avg, pVal_avg, ks2dVal, ks2pVal]
+    return doTestsBatch([(list1, list2)], alpha)[0]
+
+
+def doTestsBatch(pairs, alpha=0.95):
+    '''
+    doTests of every (list1, list2) of pairs, with the jackknife K-S tests of all of them run as one batch
+    '''
+    tests = []
+    for (list1, list2) in pairs:
+        list1_nonzero = [x for x in list1 if x > 0]
+        list2_nonzero = [x for x in list2 if x > 0]
+        if not list1_nonzero:
+            list1 = [0] * 10
+        if not list2_nonzero:
+            list2 = [0] * 10
+
+        # x1, y1 = list2CDF(list1)
+        # f1 = interpolate.interp1d(y1, x1)
+
+        # x2, y2 = list2CDF(list2)
+        # f2 = interpolate.interp1d(y2, x2)
+
+        # this essentially computes the difference between averages
+        # f1 is original and f2 is the random replay
+        # diffFunc = lambda x: f2(x) - f1(x)
+        # (area, err) = integrate.quad(diffFunc, 0.001, 1, limit=1000)
+
+        (xputMax1, xputMin1, xputAvg1, xputMed1, xputStd1) = (
+        max(list1), min(list1), numpy.average(list1), numpy.median(list1), numpy.std(list1))
+        (xputMax2, xputMin2, xputAvg2, xputMed2, xputStd2) = (
+        max(list2), min(list2), numpy.average(list2), numpy.median(list2), numpy.std(list2))
+        area = xputAvg2 - xputAvg1
+
+        xputMin = min(list1 + list2)
+        areaOvar = float(area) / max(xputAvg1, xputAvg2)
+        (ks2dVal, ks2pVal) = ks2_test(list1_nonzero, list2_nonzero)
+        greater = True
+        if ks2pVal < (1 - alpha):
+            greater = False
+        tests.append((list1, list2, greater, [areaOvar, area,
+                                              (xputMax1, xputMin1, xputAvg1, xputMed1, xputStd1),
+                                              (xputMax2, xputMin2, xputAvg2, xputMed2, xputStd2),
+                                              xputMin, ks2dVal, ks2pVal]))
+
+    ks2Results = sampleKS2Batch([(test[0], test[1]) for test in tests], [test[2] for test in tests], alpha=alpha)
+
+    results = []
+    for (test, [dVal_avg, pVal_avg, ks2AcceptRatio]) in zip(tests, ks2Results):
+        [areaOvar, area, stats1, stats2, xputMin, ks2dVal, ks2pVal] = test[3]
+        results.append([areaOvar, ks2AcceptRatio, area, 0, stats1, stats2,
+                        xputMin, dVal_avg, pVal_avg, ks2dVal, ks2pVal])
+    return results
 
 
 def main():
@@ -0,0 +1,4 @@
+import os, sys
+
+# The modules in src/ import each other by name (python src/replay_server.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
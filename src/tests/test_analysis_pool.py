@@ -0,0 +1,43 @@
+import sys
+import gevent, gevent.queue
+from analysis_pool import AnalysisPool
+
+
+def wait_idle(pool):
+    with gevent.Timeout(120):
+        while pool.pending:
+            gevent.sleep(0.05)
+
+
+def test_deduplicates_and_bounds_the_queue(tmp_path):
+    pool = AnalysisPool(str(tmp_path) + '/', 0.95, workers=1, maxQueue=2)
+    assert pool.submit(('user', 1, 1))
+    assert pool.submit(('user', '1', '1'))
+    assert len(pool.pending) == 1
+    assert pool.submit(('user', 1, 2))
+    assert not pool.submit(('user', 1, 3))
+
+
+def test_failed_jobs_can_be_submitted_again(tmp_path):
+    pool = AnalysisPool(str(tmp_path) + '/', 0.95, workers=1, timeout=120)
+    pool.run()
+
+    # No result files for this test: the analysis fails, and the job is no longer pending
+    pool.submit(('user', 1, 1))
+    wait_idle(pool)
+    assert pool.submit(('user', 1, 1))
+
+
+def test_hung_worker_is_killed(tmp_path):
+    errors = gevent.queue.Queue()
+    pool = AnalysisPool(str(tmp_path) + '/', 0.95, workers=1, errorlog_q=errors, timeout=0.5)
+    # a worker that never answers
+    pool.command = [sys.executable, '-c', 'import time; time.sleep(60)']
+    pool.run()
+
+    pool.submit(('user', 1, 1))
+    wait_idle(pool)
+    message, jobs, error = errors.get(timeout=1)
+    assert jobs == [('user', 1, 1)]
+    assert 'timed out' in error
+    assert ('user', 1, 1) not in pool.pending
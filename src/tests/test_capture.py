@@ -0,0 +1,50 @@
+import io
+from capture import Demux
+from pcap_tools import PcapReader
+from test_pcap_tools import write_pcap, read_pcap, sample_packets, CLIENT, SERVER, CLIENT6
+
+
+def demux_sample(tmp_path):
+    raw = str(tmp_path / 'raw.pcap')
+    write_pcap(raw, sample_packets())
+    with open(raw, 'rb') as f:
+        reader = PcapReader(io.BytesIO(f.read()))
+    return reader, Demux(reader.header, reader.endian, reader.linktype)
+
+
+def test_splits_by_host_and_ports(tmp_path):
+    reader, demux = demux_sample(tmp_path)
+    paths = dict((name, str(tmp_path / (name + '.pcap'))) for name in ['https', 'client', 'client6', 'all', 'server'])
+    demux.start(paths['https'], CLIENT, [443])
+    demux.start(paths['client'], CLIENT)
+    demux.start(paths['client6'], CLIENT6, [443])
+    demux.start(paths['all'])
+    demux.start(paths['server'], SERVER, [8080])
+
+    packets = list(reader)
+    for header, data in packets:
+        demux.write(header, data)
+    counts = dict((name, demux.stop(path)) for (name, path) in paths.items())
+
+    assert counts == {'https': 3, 'client': 4, 'client6': 2, 'all': 6, 'server': 0}
+    assert [data for (header, data) in read_pcap(paths['all'])] == [data for (header, data) in packets]
+    assert [data for (header, data) in read_pcap(paths['https'])] == [packets[i][1] for i in [0, 1, 2]]
+    assert read_pcap(paths['server']) == []
+    assert demux.writers == {} and demux.everything == [] and demux.files == {}
+
+
+def test_stopped_files_get_nothing(tmp_path):
+    reader, demux = demux_sample(tmp_path)
+    first, second = str(tmp_path / 'first.pcap'), str(tmp_path / 'second.pcap')
+    demux.start(first, CLIENT)
+    demux.start(second, CLIENT)
+
+    packets = iter(reader)
+    header, data = next(packets)
+    demux.write(header, data)
+    assert demux.stop(first) == 1
+    for header, data in packets:
+        demux.write(header, data)
+
+    assert len(read_pcap(first)) == 1
+    assert demux.stop(second) == 4
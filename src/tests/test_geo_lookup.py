@@ -0,0 +1,38 @@
+import pytest
+from geo_lookup import LRU, GeoService
+
+
+def test_lru():
+    cache = LRU(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # b is the least recently used
+    assert (cache.get('b'), cache.get('a'), cache.get('c')) == (None, 1, 3)
+    assert len(cache) == 2
+
+
+@pytest.fixture(scope='module')
+def service():
+    return GeoService(cacheSize=10)
+
+
+def test_update_locations(service):
+    boston = {'latitude': 42.3401, 'longitude': -71.0892}
+    paris = {'latitude': '48.8566', 'longitude': '2.3522'}
+    unknown = {'latitude': 0.0, 'longitude': 0.0}
+    service.update_locations([(boston, '2020-06-01 12:00:00'), (paris, '2020-01-01 12:00:00'),
+                              (unknown, '2020-01-01 12:00:00')])
+
+    assert (boston['country'], boston['latitude'], boston['longitude']) == ('United States', 42.3, -71.1)
+    assert boston['localTime'] == '2020-06-01 08:00:00-04:00'
+    assert paris['country'] == 'France'
+    assert paris['localTime'] == '2020-01-01 13:00:00+01:00'
+    assert unknown == {'latitude': '0.0', 'longitude': '0.0'}
+
+
+def test_places_are_cached_by_rounded_coordinates(service):
+    first = service.place(42.3401, -71.0892)
+    assert service.place(42.3399, -71.0901) is first
+    assert service.local_time('2020-06-01 12:00:00', 0.0, 0.0) is None
@@ -0,0 +1,56 @@
+import os, random
+import pytest
+from replay_server import GetLUT, getClosestCSP
+from benchmark_getlut import read_requests, build_getLUT, make_queries
+
+TRACES = os.path.join(os.path.dirname(__file__), '..', '..', 'replayTraces')
+
+
+def random_headers(rng):
+    # few values, so many entries tie and the insertion order decides
+    headersDict = {'GET': 'GET /{} HTTP/1.1'.format(rng.randrange(4))}
+    for name in ['Host', 'Accept', 'Cookie', 'User-Agent', 'X-Extra']:
+        if rng.random() < 0.7:
+            headersDict[name] = str(rng.randrange(3))
+    return headersDict
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_closest_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    plain = {}
+    for i in range(rng.randrange(0, 60)):
+        plain[('replay{}'.format(i % 3), 'csp{}'.format(i))] = random_headers(rng)
+    indexed = GetLUT(plain)
+
+    # updates and deletes keep the index and the tie order in step with the dict
+    for key in rng.sample(sorted(plain), min(5, len(plain))):
+        if rng.random() < 0.5:
+            del plain[key]
+            del indexed[key]
+        else:
+            plain[key] = indexed[key] = random_headers(rng)
+
+    for i in range(100):
+        headersDict = random_headers(rng)
+        assert getClosestCSP(indexed, headersDict) == getClosestCSP(plain, headersDict)
+
+
+def test_only_a_get_line():
+    plain = {('a', '1'): {'GET': 'GET / HTTP/1.1', 'Host': 'x'},
+             ('a', '2'): {'GET': 'GET / HTTP/1.1', 'Host': 'y'},
+             ('a', '3'): {'GET': 'GET /other HTTP/1.1'}}
+    indexed = GetLUT(plain)
+    for headersDict in [{'GET': 'GET / HTTP/1.1'}, {'GET': 'GET /none HTTP/1.1'}, {'GET': 'GET /other HTTP/1.1'}]:
+        assert getClosestCSP(indexed, headersDict) == getClosestCSP(plain, headersDict)
+    assert getClosestCSP(GetLUT(), {'GET': 'GET / HTTP/1.1'}) is None
+
+
+def test_shipped_traces():
+    requests = read_requests(TRACES)
+    if not requests:
+        pytest.skip('no GET requests in the shipped traces')
+    plain = build_getLUT(requests, 20)
+    indexed = GetLUT(plain)
+    for (kind, headersDict) in make_queries(requests):
+        assert getClosestCSP(indexed, headersDict) == getClosestCSP(plain, headersDict)
@@ -0,0 +1,90 @@
+import time
+import gevent
+import netaddr as neta
+from isp_lookup import parse_whois, WhoisCache
+
+ARIN = '''
+NetRange:       8.8.8.0 - 8.8.8.255
+CIDR:           8.8.8.0/24
+OrgName:        Google LLC
+'''
+
+RIPE = '''
+inetnum:        193.0.0.0 - 193.0.7.255
+netname:        RIPE-NCC
+org-name:       Reseaux IP Europeens Network Coordination Centre (RIPE NCC)
+'''
+
+LACNIC = '''
+inetnum:     200.160.0.0/20
+owner:       Nic.br
+'''
+
+
+def test_parse_whois():
+    IPRange, orgName = parse_whois(ARIN)
+    assert (IPRange, orgName.strip()) == (neta.IPRange('8.8.8.0', '8.8.8.255'), 'Google LLC')
+    IPRange, orgName = parse_whois(RIPE)
+    assert IPRange == neta.IPRange('193.0.0.0', '193.0.7.255')
+    assert orgName.strip().startswith('Reseaux IP Europeens')
+    IPRange, orgName = parse_whois(LACNIC)
+    assert (IPRange, orgName.strip()) == (neta.IPSet(['200.160.0.0/20']), 'Nic.br')
+    assert parse_whois('') == (None, None)
+
+
+def test_longest_prefix_and_expiry():
+    cache = WhoisCache()
+    now = time.time()
+    cache.add('10.0.0.0/8', 'Big', now + 100)
+    cache.add('10.1.0.0/16', 'Small', now + 100)
+    cache.add('2001:db8::/32', 'Six', now + 100)
+    cache.add('192.168.0.0/16', 'Expired', now - 1)
+
+    assert cache.get('10.1.2.3') == 'Small'
+    assert cache.get('10.2.0.1') == 'Big'
+    assert cache.get('2001:db8::1') == 'Six'
+    assert cache.get('192.168.1.1') is None
+    assert cache.get('11.0.0.1') is None
+
+    cache.expire()
+    assert len(cache) == 3
+    assert cache.prefixlens[4] == [16, 8]
+
+
+def test_lookup_is_cached_for_the_whole_range():
+    calls = []
+
+    def lookup(ip, timeout):
+        calls.append(ip)
+        return parse_whois(ARIN) if ip.startswith('8.') else (None, None)
+
+    cache = WhoisCache(lookup=lookup)
+    assert cache.lookup('8.8.8.8').strip() == 'Google LLC'
+    assert cache.lookup('8.8.8.4').strip() == 'Google LLC'
+    assert cache.lookup('1.1.1.1') is None
+    assert cache.lookup('1.1.1.1') is None
+    assert calls == ['8.8.8.8', '1.1.1.1']
+
+
+def test_slow_lookup_finishes_in_the_background():
+    def lookup(ip, timeout):
+        gevent.sleep(0.2)
+        return parse_whois(ARIN)
+
+    cache = WhoisCache(lookup=lookup)
+    assert cache.lookup('8.8.8.8', wait=0.01) is None
+    cache.pool.join()
+    assert cache.get('8.8.8.8').strip() == 'Google LLC'
+
+
+def test_snapshot(tmp_path):
+    snapshot = str(tmp_path / 'whois.json')
+    cache = WhoisCache(snapshot)
+    cache.add('8.8.8.0/24', 'Google', time.time() + 100)
+    cache.save()
+
+    other = WhoisCache(snapshot)
+    other.add('1.1.1.0/24', 'Cloudflare', time.time() + 100)
+    # saving merges the entries saved by the other processes
+    other.save()
+    assert sorted(orgName for (cidr, orgName, expires) in WhoisCache(snapshot).entries()) == ['Cloudflare', 'Google']
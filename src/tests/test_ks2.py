@@ -0,0 +1,43 @@
+import numpy
+import pytest
+import scipy.stats
+from testHypothesis import ks2_test, ks2_pvalue, ks2_exact_pvalue
+
+
+@pytest.mark.parametrize('n1,n2', [(1, 5), (10, 10), (20, 35), (100, 100), (100, 97), (7, 300), (400, 500)])
+@pytest.mark.parametrize('shift', [0, 0.3, 1])
+def test_ks2_test_matches_ks_2samp(n1, n2, shift):
+    rng = numpy.random.default_rng(n1 * 1000 + n2)
+    list1, list2 = rng.normal(size=n1), rng.normal(shift, size=n2)
+
+    d, p = ks2_test(list(list1), list(list2))
+    expected = scipy.stats.ks_2samp(list1, list2)
+
+    assert d == pytest.approx(expected.statistic, abs=1e-12)
+    assert p == pytest.approx(expected.pvalue, rel=1e-9, abs=1e-14)
+
+
+def test_ks2_test_ties_and_empty_lists():
+    list1, list2 = [1, 1, 2, 2, 3, 5, 5], [1, 2, 2, 2, 4, 5]
+    expected = scipy.stats.ks_2samp(list1, list2)
+    assert ks2_test(list1, list2) == pytest.approx((expected.statistic, expected.pvalue))
+    assert numpy.isnan(ks2_test([], list2)[1])
+
+
+def test_exact_pvalue_small_cases():
+    # n1 = n2 = 1: the statistic is always 1
+    assert ks2_exact_pvalue(1, 1, 1) == 1.0
+    # n1 = 1, n2 = 2: D = 1 for 2 of the 3 orders
+    assert ks2_exact_pvalue(1, 2, 2) == pytest.approx(2 / 3.0)
+    assert ks2_pvalue(0.0, 30, 40) == 1.0
+
+
+def test_asymptotic_pvalue_beyond_exact_sizes():
+    rng = numpy.random.default_rng(0)
+    list1, list2 = rng.normal(size=12000), rng.normal(0.03, size=11000)
+
+    d, p = ks2_test(list(list1), list(list2))
+    expected = scipy.stats.ks_2samp(list1, list2)
+
+    assert d == pytest.approx(expected.statistic, abs=1e-12)
+    assert p == pytest.approx(expected.pvalue, rel=1e-9)
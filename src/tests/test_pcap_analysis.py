@@ -0,0 +1,112 @@
+import os, re, struct, socket, shutil, subprocess
+import numpy
+import pytest
+from pcap_tools import PCAPNG_MAGIC
+from pcap_analysis import read_frames, bucket_bytes, xput_stats
+from test_pcap_tools import ethernet_ipv4, CLIENT, SERVER
+
+
+def tcp_frame(src, dst, sport, dport, seq, payload, flags=0x18):
+    frame = bytearray(ethernet_ipv4(src, dst, socket.IPPROTO_TCP, sport, dport, payload))
+    frame[38:42] = struct.pack('!I', seq)
+    frame[47] = flags
+    return bytes(frame)
+
+
+def sample_frames():
+    '''
+    (timestamp, frame): a 1 second transfer of 100 segments of 1000 bytes, the 50th one sent twice
+    '''
+    frames = []
+    for i in range(100):
+        frames.append((1000.0 + i / 99.0, tcp_frame(SERVER, CLIENT, 443, 50000, 1 + 1000 * i, b'x' * 1000)))
+    frames.insert(60, (frames[59][0] + 0.004, tcp_frame(SERVER, CLIENT, 443, 50000, 1 + 1000 * 50, b'x' * 1000)))
+    return frames
+
+
+def write_pcap(path, frames):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for timestamp, frame in frames:
+            f.write(struct.pack('<IIII', int(timestamp), int(round(timestamp % 1 * 1e6)), len(frame), len(frame)))
+            f.write(frame)
+
+
+def block(blockType, body):
+    body += b'\x00' * (-len(body) % 4)
+    return struct.pack('<II', blockType, len(body) + 12) + body + struct.pack('<I', len(body) + 12)
+
+
+def write_pcapng(path, frames, tsresol=9):
+    with open(path, 'wb') as f:
+        f.write(PCAPNG_MAGIC + block(0x0a0d0d0a, struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1))[4:])
+        options = struct.pack('<HHB3x', 9, 1, tsresol) + struct.pack('<HH', 0, 0)
+        f.write(block(1, struct.pack('<HHI', 1, 0, 0) + options))
+        # a block readers skip
+        f.write(block(5, b'statistics'))
+        for timestamp, frame in frames:
+            units = int(round(timestamp * 10 ** tsresol))
+            f.write(block(6, struct.pack('<IIIII', 0, units >> 32, units & 0xffffffff, len(frame), len(frame)) + frame))
+
+
+def test_pcapng_reads_like_pcap(tmp_path):
+    frames = sample_frames()
+    pcap, pcapng = str(tmp_path / 'a.pcap'), str(tmp_path / 'a.pcapng')
+    write_pcap(pcap, frames)
+    write_pcapng(pcapng, frames, tsresol=6)
+
+    expected, got = read_frames(pcap), read_frames(pcapng)
+    assert len(got) == len(expected) == 101
+    for field in ['time', 'length', 'version', 'protocol', 'sport', 'dport', 'seq', 'ack', 'flags', 'payload']:
+        assert numpy.array_equal(getattr(got, field), getattr(expected, field)), field
+
+
+def test_pcapng_nanosecond_timestamps(tmp_path):
+    pcapng = str(tmp_path / 'a.pcapng')
+    write_pcapng(pcapng, sample_frames(), tsresol=9)
+    frames = read_frames(pcapng)
+    assert frames.time[1] == pytest.approx(1 / 99.0, abs=1e-9)
+
+
+def test_retransmission_flagged(tmp_path):
+    pcap = str(tmp_path / 'a.pcap')
+    write_pcap(pcap, sample_frames())
+    assert numpy.nonzero(read_frames(pcap).retransmissions())[0].tolist() == [60]
+
+
+def test_last_frame_in_last_bucket(tmp_path):
+    pcap = str(tmp_path / 'a.pcap')
+    write_pcap(pcap, sample_frames())
+    frames = read_frames(pcap)
+
+    for buckets in [1, 7, 99, 100]:
+        starts, ends, counts = bucket_bytes(frames, frames.duration() / buckets)
+        assert len(counts) == buckets
+        assert ends[-1] == pytest.approx(frames.duration())
+        assert counts.sum() == frames.length.sum()
+
+    # Without the retransmission, every 1 / 99 second interval holds one segment
+    xput, duration = xput_stats(pcap, 99)
+    assert duration == '1.000'
+    assert len(xput) == 99
+    assert xput[-1] == pytest.approx(xput[0], rel=0.01)
+
+
+def tshark_io_stat(pcap, interval):
+    output = subprocess.check_output(['tshark', '-r', pcap, '-qz', 'io,stat,{},not tcp.analysis.retransmission'.format(
+        interval)]).decode('ascii', 'ignore')
+    return [int(match.group(1)) for match in re.finditer(r'<>\s*(?:[\d.]+|Dur)\s*\|\s*\d+\s*\|\s*(\d+)', output)]
+
+
+@pytest.mark.skipif(shutil.which('tshark') is None, reason='tshark is needed for the comparison')
+def test_same_buckets_as_tshark(tmp_path):
+    pcap = str(tmp_path / 'a.pcap')
+    write_pcap(pcap, sample_frames())
+    frames = read_frames(pcap)
+    interval = frames.duration() / 10
+    starts, ends, counts = bucket_bytes(frames, interval, ~frames.retransmissions())
+
+    tshark = tshark_io_stat(pcap, interval)
+    # tshark puts the last frame in an interval of its own
+    assert counts[:-1].tolist() == tshark[:len(counts) - 1]
+    assert counts.sum() == sum(tshark)
@@ -0,0 +1,154 @@
+import os, struct, shutil, socket, ipaddress
+import pytest
+from pcap_tools import rewrite_pcap, rewrite_pcap_external, PcapReader
+
+CLIENT = '10.1.2.3'
+SERVER = '192.0.2.10'
+ANONYMIZED = '10.1.2.0'
+CLIENT6 = '2001:db8::1234'
+SERVER6 = '2001:db8:1::1'
+ANONYMIZED6 = '2001:db8::'
+
+
+def ones_complement(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def l4_segment(protocol, src, dst, sport, dport, payload):
+    if protocol == socket.IPPROTO_TCP:
+        header = struct.pack('!HHIIBBHHH', sport, dport, 1, 0, 5 << 4, 0x18, 65535, 0, 0)
+        at = 16
+    else:
+        header = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0)
+        at = 6
+    segment = bytearray(header + payload)
+    pseudo = src + dst + struct.pack('!HH', protocol, len(segment))
+    segment[at:at + 2] = struct.pack('!H', ones_complement(pseudo + bytes(segment)))
+    return bytes(segment)
+
+
+def ethernet_ipv4(src, dst, protocol, sport, dport, payload):
+    src, dst = ipaddress.ip_address(src).packed, ipaddress.ip_address(dst).packed
+    segment = l4_segment(protocol, src, dst, sport, dport, payload)
+    header = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(segment), 1, 0, 64, protocol, 0, src, dst))
+    header[10:12] = struct.pack('!H', ones_complement(bytes(header)))
+    return b'\x00' * 12 + b'\x08\x00' + bytes(header) + segment
+
+
+def ethernet_ipv6(src, dst, protocol, sport, dport, payload):
+    src, dst = ipaddress.ip_address(src).packed, ipaddress.ip_address(dst).packed
+    segment = l4_segment(protocol, src, dst, sport, dport, payload)
+    header = struct.pack('!IHBB16s16s', 6 << 28, len(segment), protocol, 64, src, dst)
+    return b'\x00' * 12 + b'\x86\xdd' + header + segment
+
+
+def write_pcap(path, packets):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for i, packet in enumerate(packets):
+            f.write(struct.pack('<IIII', 1000 + i, i, len(packet), len(packet)))
+            f.write(packet)
+
+
+def read_pcap(path):
+    with open(path, 'rb') as f:
+        reader = PcapReader(f)
+        return [(reader.record.unpack(header), data) for header, data in reader]
+
+
+def sample_packets():
+    payload = bytes(range(256)) * 2
+    return [
+        ethernet_ipv4(CLIENT, SERVER, socket.IPPROTO_TCP, 50000, 443, payload),
+        ethernet_ipv4(SERVER, CLIENT, socket.IPPROTO_TCP, 443, 50000, payload[:40]),
+        ethernet_ipv4(CLIENT, SERVER, socket.IPPROTO_UDP, 50001, 443, payload),
+        ethernet_ipv4(CLIENT, SERVER, socket.IPPROTO_TCP, 50002, 80, payload),  # filtered out
+        ethernet_ipv6(CLIENT6, SERVER6, socket.IPPROTO_TCP, 50003, 443, payload),
+        ethernet_ipv6(SERVER6, CLIENT6, socket.IPPROTO_UDP, 443, 50003, payload[:10]),
+    ]
+
+
+def test_filters_ports_and_keeps_headers(tmp_path):
+    in_pcap, out_pcap = str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap')
+    packets = sample_packets()
+    write_pcap(in_pcap, packets)
+
+    read, written = rewrite_pcap(in_pcap, out_pcap, ['443'], CLIENT, ANONYMIZED)
+
+    assert (read, written) == (6, 5)
+    records = read_pcap(out_pcap)
+    # timestamps and original lengths are kept, the port 80 packet is gone
+    assert [header[0] for header, data in records] == [1000, 1001, 1002, 1004, 1005]
+    assert [header[3] for header, data in records] == [len(packets[i]) for i in (0, 1, 2, 4, 5)]
+    assert not os.path.exists(out_pcap + '.{}.tmp'.format(os.getpid()))
+
+
+def test_snaplen_and_chop(tmp_path):
+    in_pcap, out_pcap = str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap')
+    packets = sample_packets()
+    write_pcap(in_pcap, packets)
+
+    rewrite_pcap(in_pcap, out_pcap, [443], snaplen=100, chop=300)
+
+    records = read_pcap(out_pcap)
+    # bytes [snaplen, snaplen + chop) are removed, like editcap -C 100:300
+    assert records[0][1] == packets[0][:100] + packets[0][400:]
+    assert records[0][0][2] == len(records[0][1])
+    # shorter packets are left alone
+    assert records[1][1] == packets[1]
+    assert records[4][1] == packets[5]
+
+
+def test_anonymizes_addresses_and_fixes_checksums(tmp_path):
+    in_pcap, out_pcap = str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap')
+    packets = sample_packets()
+    write_pcap(in_pcap, packets)
+
+    rewrite_pcap(in_pcap, out_pcap, [443], CLIENT, ANONYMIZED)
+    records = [data for header, data in read_pcap(out_pcap)]
+
+    # Untruncated packets match packets built with the anonymized address from the start
+    assert records[1] == ethernet_ipv4(SERVER, ANONYMIZED, socket.IPPROTO_TCP, 443, 50000, bytes(range(40)))
+    # The IPv6 client is not the one being anonymized, so IPv6 packets are untouched
+    assert records[4] == packets[5]
+
+    # Truncated packets: headers are anonymized, and the transport checksum is the one of the
+    # whole anonymized packet (updated incrementally)
+    payload = bytes(range(256)) * 2
+    for record, protocol, sport in [(records[0], socket.IPPROTO_TCP, 50000), (records[2], socket.IPPROTO_UDP, 50001)]:
+        expected = ethernet_ipv4(ANONYMIZED, SERVER, protocol, sport, 443, payload)
+        assert record == expected[:128]
+        assert ones_complement(record[14:34]) == 0
+
+
+def test_anonymizes_ipv6(tmp_path):
+    in_pcap, out_pcap = str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap')
+    packets = sample_packets()
+    write_pcap(in_pcap, packets)
+
+    rewrite_pcap(in_pcap, out_pcap, [443], CLIENT6, ANONYMIZED6)
+    records = [data for header, data in read_pcap(out_pcap)]
+
+    assert records[0] == packets[0][:128]
+    assert records[4] == ethernet_ipv6(SERVER6, ANONYMIZED6, socket.IPPROTO_UDP, 443, 50003, bytes(range(10)))
+    expected = ethernet_ipv6(ANONYMIZED6, SERVER6, socket.IPPROTO_TCP, 50003, 443, bytes(range(256)) * 2)
+    assert records[3] == expected[:128]
+
+
+@pytest.mark.skipif(not all(shutil.which(tool) for tool in ['tcpdump', 'editcap', 'tcprewrite']),
+                    reason='tcpdump, editcap and tcprewrite are needed for the comparison')
+def test_same_output_as_external_tools(tmp_path):
+    in_pcap = str(tmp_path / 'in.pcap')
+    write_pcap(in_pcap, sample_packets())
+
+    for clientIP, anonymizedIP in [(CLIENT, ANONYMIZED), (CLIENT6, ANONYMIZED6)]:
+        out_pcap, external_pcap = str(tmp_path / 'out.pcap'), str(tmp_path / 'external.pcap')
+        rewrite_pcap(in_pcap, out_pcap, [443], clientIP, anonymizedIP)
+        rewrite_pcap_external(in_pcap, external_pcap, [443], clientIP, anonymizedIP)
+
+        assert read_pcap(out_pcap) == read_pcap(external_pcap)
@@ -0,0 +1,66 @@
+import os, json, socket
+import gevent
+from python_lib import clean_pcap
+from postprocess import PostProcessor
+from test_pcap_tools import write_pcap, read_pcap, ethernet_ipv4, CLIENT, SERVER, ANONYMIZED
+
+
+def make_dump(folder):
+    in_pcap = os.path.join(folder, 'dump_server_test.pcap')
+    write_pcap(in_pcap, [ethernet_ipv4(CLIENT, SERVER, socket.IPPROTO_TCP, 50000, 443, b'x' * 500)])
+    return in_pcap
+
+
+def test_clean_pcap_can_run_again(tmp_path):
+    in_pcap = make_dump(str(tmp_path))
+    results = str(tmp_path / 'results')
+    args = [in_pcap, CLIENT, ANONYMIZED, [443], 'realID', results]
+    out_pcap = os.path.join(results, 'realID', 'tcpdumpsResults', 'dump_server_test_out.pcap')
+
+    clean_pcap(*args)
+    assert not os.path.exists(in_pcap)
+    assert len(read_pcap(out_pcap)[0][1]) == 128
+
+    # e.g. the worker died after removing in_pcap, before the job was marked as done
+    clean_pcap(*args)
+    assert len(read_pcap(out_pcap)[0][1]) == 128
+
+
+def test_postprocessor_runs_and_journals_jobs(tmp_path):
+    in_pcap = make_dump(str(tmp_path))
+    results = str(tmp_path / 'results')
+    journal = str(tmp_path / 'journal')
+    postprocessor = PostProcessor(journal, workers=1, timeout=60)
+    postprocessor.run()
+
+    postprocessor.submit({'realID': 'realID', 'chown': None,
+                          'clean_pcap': [in_pcap, CLIENT, ANONYMIZED, [443], 'realID', results]})
+    postprocessor.submit({'realID': 'realID', 'chown': None,
+                          'clean_pcap': [str(tmp_path / 'missing.pcap'), CLIENT, ANONYMIZED, [443], 'realID', results]})
+    with gevent.Timeout(60):
+        while postprocessor.backlog():
+            gevent.sleep(0.05)
+
+    assert os.path.exists(os.path.join(results, 'realID', 'tcpdumpsResults', 'dump_server_test_out.pcap'))
+    # the job that fails is tried 3 times, then kept in failed/
+    assert [f for f in os.listdir(journal) if f.endswith('.json')] == []
+    failed = os.listdir(os.path.join(journal, 'failed'))
+    assert len(failed) == 1
+    with open(os.path.join(journal, 'failed', failed[0])) as f:
+        assert json.load(f)['attempts'] == 3
+
+
+def test_postprocessor_recovers_journals(tmp_path):
+    journal = str(tmp_path / 'journal')
+    os.makedirs(journal)
+    job = {'id': '1_1_1', 'realID': 'realID', 'clean_pcap': None, 'chown': None, 'created': 0, 'attempts': 0}
+    with open(os.path.join(journal, '1_1_1.json'), 'w') as f:
+        json.dump(job, f)
+
+    postprocessor = PostProcessor(journal, workers=1, timeout=60)
+    postprocessor.run()
+    assert postprocessor.backlog() == 1
+    with gevent.Timeout(60):
+        while postprocessor.backlog():
+            gevent.sleep(0.05)
+    assert not os.path.exists(os.path.join(journal, '1_1_1.json'))
@@ -0,0 +1,71 @@
+import os
+from replay_catalog import ReplayCatalog, split_version
+from test_replay_trace import server_objects
+from replay_trace import dump_server_trace
+
+
+def add_replay(parent, name, suffix='_server_all.wtrace'):
+    folder = parent / name
+    folder.mkdir()
+    path = str(folder / (name + suffix))
+    if suffix.endswith('.wtrace'):
+        Q, LUT, getLUT, udpServers, tcpServerPorts, replayName = server_objects()
+        dump_server_trace(path, Q, LUT, getLUT, udpServers, tcpServerPorts, name)
+    else:
+        open(path, 'wb').close()
+    return str(folder)
+
+
+def test_split_version():
+    assert split_version('Amazon_11252020') == ('Amazon', '20201125')
+    assert split_version('Amazon') == ('Amazon', None)
+    assert split_version('port_8443') == ('port_8443', None)
+
+
+def test_resolve(tmp_path):
+    old = add_replay(tmp_path, 'Amazon_11252020')
+    new = add_replay(tmp_path, 'Amazon_01152021', '_server_all.pickle')
+    add_replay(tmp_path, 'Amazon_06012021', '_client_all.json')
+    add_replay(tmp_path, 'AmazonRandom_12012021')
+
+    catalog = ReplayCatalog(str(tmp_path))
+    assert sorted(catalog.scan()) == ['AmazonRandom_12012021', 'Amazon_01152021', 'Amazon_06012021',
+                                      'Amazon_11252020']
+    assert catalog.resolve('Amazon-11252020').folder == old
+    # the latest version with server files, never AmazonRandom
+    assert catalog.resolve('Amazon').folder == new
+    assert catalog.resolve('AmazonRandom').name == 'AmazonRandom_12012021'
+    assert catalog.resolve('Netflix') is None
+
+    entry = catalog.resolve('Amazon_11252020')
+    assert (entry.replayName, entry.packets, entry.protocols) == ('Amazon_11252020', 5, 'tcp,udp')
+    assert entry.server_file('wtrace').endswith('_server_all.wtrace')
+    assert catalog.resolve('Amazon_01152021').server_file('wtrace').endswith('_server_all.pickle')
+
+
+def test_scan_only_reads_changes_and_is_saved(tmp_path):
+    parent = tmp_path / 'replays'
+    parent.mkdir()
+    add_replay(parent, 'Amazon_11252020')
+    catalogFile = str(tmp_path / 'cache' / 'catalog.json')
+
+    catalog = ReplayCatalog(str(parent), catalogFile)
+    assert catalog.scan() == ['Amazon_11252020']
+    assert catalog.scan() == []
+
+    # learnt stats survive a restart
+    catalog.set_stats(catalog.resolve('Amazon_11252020'), 'Amazon', 10, 'tcp')
+    catalog.scan()
+    restarted = ReplayCatalog(str(parent), catalogFile)
+    assert restarted.scan() == []
+    assert restarted.resolve('Amazon').packets == 10
+
+    add_replay(parent, 'Amazon_01152021')
+    assert restarted.scan() == ['Amazon_01152021']
+    assert restarted.resolve('Amazon').name == 'Amazon_01152021'
+
+    os.remove(os.path.join(str(parent), 'Amazon_01152021', 'Amazon_01152021_server_all.wtrace'))
+    os.rmdir(os.path.join(str(parent), 'Amazon_01152021'))
+    assert restarted.scan() == ['Amazon_01152021']
+    assert restarted.resolve('Amazon').name == 'Amazon_11252020'
+    assert len(restarted) == 1
@@ -0,0 +1,98 @@
+import os, pickle
+import pytest
+from python_lib import ResponseSet, OneResponse, RequestSet, UDPset
+from replay_trace import (dump_server_trace, load_server_trace, dump_client_trace, load_client_trace,
+                          load_client_json, convert_folder, TraceFile)
+
+TRACES = os.path.join(os.path.dirname(__file__), '..', '..', 'replayTraces')
+
+TCP_CSP = '010.000.000.001.50000-010.000.000.002.00080'
+UDP_CSP = '010.000.000.001.50001-010.000.000.002.00443'
+
+
+def server_objects():
+    hashed = ResponseSet('474554202f', [OneResponse('48545450', 0.0), OneResponse('00ff', 0.25)])
+    unhashed = ResponseSet('', [OneResponse('', 0.5)])
+    unhashed.request_hash = None
+    Q = {'tcp': {TCP_CSP: [hashed, unhashed]},
+         'udp': {UDP_CSP: [UDPset('aabb', 0.0, UDP_CSP), UDPset('cc', 1.5, UDP_CSP, end=True)]}}
+    LUT = {'tcp': {'x': ('Amazon', TCP_CSP)}}
+    getLUT = {('Amazon', TCP_CSP): {'GET': 'GET / HTTP/1.1', 'Host': 'example.com'}}
+    return Q, LUT, getLUT, {'10.0.0.2': ['00443']}, ['00080'], 'Amazon'
+
+
+@pytest.mark.parametrize('copy', [True, False])
+def test_server_round_trip(tmp_path, copy):
+    Q, LUT, getLUT, udpServers, tcpServerPorts, replayName = server_objects()
+    path = str(tmp_path / 'Amazon_server_all.wtrace')
+    dump_server_trace(path, Q, LUT, getLUT, udpServers, tcpServerPorts, replayName)
+
+    loaded = load_server_trace(path, copy=copy)
+    assert loaded[1:] == (LUT, getLUT, udpServers, tcpServerPorts, replayName)
+
+    tcp = loaded[0]['tcp'][TCP_CSP]
+    assert [(s.request_len, s.request_hash) for s in tcp] == [(s.request_len, s.request_hash) for s in Q['tcp'][TCP_CSP]]
+    assert tcp[1].request_hash is None
+    assert [[(bytes(r.payload), r.timestamp) for r in s.response_list] for s in tcp] == \
+           [[(bytes.fromhex(r.payload), r.timestamp) for r in s.response_list] for s in Q['tcp'][TCP_CSP]]
+    assert all(isinstance(r.payload, bytes if copy else memoryview) for s in tcp for r in s.response_list)
+
+    udp = loaded[0]['udp'][UDP_CSP]
+    assert [(bytes(u.payload), u.timestamp, u.c_s_pair, u.end) for u in udp] == \
+           [(b'\xaa\xbb', 0.0, UDP_CSP, False), (b'\xcc', 1.5, UDP_CSP, True)]
+
+
+def test_client_round_trip(tmp_path):
+    hashed = RequestSet('474554202f', TCP_CSP, '48545450', 0.0)
+    unhashed = RequestSet('00', TCP_CSP, None, 0.125)
+    Q = [hashed, UDPset('aabb', 0.2, UDP_CSP), unhashed, UDPset('cc', 0.3, UDP_CSP, end=True)]
+    path = str(tmp_path / 'Amazon_client_all.wtrace')
+    dump_client_trace(path, Q, ['50001'], [TCP_CSP], 'Amazon')
+
+    loaded, udpClientPorts, tcpCSPs, replayName = load_client_trace(path)
+    assert (udpClientPorts, tcpCSPs, replayName) == (['50001'], [TCP_CSP], 'Amazon')
+    assert [type(p) for p in loaded] == [type(p) for p in Q]
+    assert [(p.payload, p.c_s_pair, p.timestamp) for p in loaded] == \
+           [(bytes.fromhex(p.payload), p.c_s_pair, p.timestamp) for p in Q]
+    assert (loaded[0].response_hash, loaded[0].response_len) == (hashed.response_hash, 4)
+    assert (loaded[2].response_hash, loaded[2].response_len) == (None, 0)
+    assert (loaded[1].end, loaded[3].end) == (False, True)
+
+
+def test_odd_length_payload_is_refused(tmp_path):
+    Q = [UDPset('abc', 0.0, UDP_CSP)]
+    with pytest.raises(ValueError):
+        dump_client_trace(str(tmp_path / 'x_client_all.wtrace'), Q, [], [], 'x')
+
+
+def test_other_versions_are_refused(tmp_path):
+    path = str(tmp_path / 'x_client_all.wtrace')
+    dump_client_trace(path, [UDPset('aa', 0.0, UDP_CSP)], [], [], 'x')
+    with open(path, 'r+b') as f:
+        f.seek(8)
+        f.write(b'\x01\x00')
+    with pytest.raises(ValueError):
+        TraceFile(path)
+
+
+def test_convert_folder(tmp_path):
+    Q, LUT, getLUT, udpServers, tcpServerPorts, replayName = server_objects()
+    with open(str(tmp_path / 'Amazon_server_all.pickle'), 'wb') as f:
+        pickle.dump((Q, LUT, getLUT, udpServers, tcpServerPorts, replayName), f)
+    jsonFile = os.path.join(TRACES, 'Amazon_11252020', 'Amazon_11252020.pcap_client_all.json')
+    with open(jsonFile, 'rb') as src, open(str(tmp_path / 'Amazon_client_all.json'), 'wb') as dst:
+        dst.write(src.read())
+
+    converted = convert_folder(str(tmp_path))
+    assert sorted(os.path.basename(path) for path in converted) == ['Amazon_client_all.wtrace',
+                                                                   'Amazon_server_all.wtrace']
+    assert load_server_trace(str(tmp_path / 'Amazon_server_all.wtrace'))[1:] == \
+           (LUT, getLUT, udpServers, tcpServerPorts, replayName)
+
+    expected = load_client_json(jsonFile)
+    loaded = load_client_trace(str(tmp_path / 'Amazon_client_all.wtrace'))
+    assert loaded[1:] == expected[1:]
+    assert [(p.payload, p.c_s_pair, p.timestamp) for p in loaded[0]] == \
+           [(bytes.fromhex(p.payload), p.c_s_pair, p.timestamp) for p in expected[0]]
+    assert [getattr(p, 'response_hash', None) for p in loaded[0]] == \
+           [getattr(p, 'response_hash', None) for p in expected[0]]
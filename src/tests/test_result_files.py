@@ -0,0 +1,105 @@
+import os, json, errno
+import pytest
+import result_files
+from result_files import result_file, manifest_file, record_file, record_files, find_file, move_file, rebuild_manifest
+
+
+def write(path, content='{}'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def test_fixed_paths_are_not_recorded(tmp_path):
+    folder = str(tmp_path)
+    path = write(result_file(folder, 'user', 'decisions', 3, 1, 'Server'))
+    record_file(folder, 'user', 'decisions', 3, 1, path)
+    assert not os.path.exists(manifest_file(folder, 'user', 3))
+    assert find_file(folder, 'user', 'decisions', 3, 1, 'Server') == path
+    assert find_file(folder, 'user', 'decisions', 3, 1, 'Client') is None
+
+
+def test_manifest(tmp_path):
+    folder = str(tmp_path)
+    renamed = write(os.path.join(folder, 'user', 'replayInfo', 'replayInfo_old_3_1.json'))
+    elsewhere = write(os.path.join(folder, 'permanent', 'Xput_user_3_1.json'))
+    other = write(os.path.join(folder, 'user', 'replayInfo', 'replayInfo_old_4_0.json'))
+    record_files(folder, 'user', [('replayInfo', 3, 1, renamed), ('clientXputs', '3', '1', elsewhere),
+                                  ('replayInfo', 4, 0, other)])
+
+    # one manifest per history count, names in the kind folder are relative
+    with open(manifest_file(folder, 'user', 3)) as f:
+        assert json.load(f) == {'replayInfo': {'1': 'replayInfo_old_3_1.json'},
+                                'clientXputs': {'1': os.path.abspath(elsewhere)}}
+    with open(manifest_file(folder, 'user', 4)) as f:
+        assert json.load(f) == {'replayInfo': {'0': 'replayInfo_old_4_0.json'}}
+
+    manifests = {}
+    assert find_file(folder, 'user', 'replayInfo', 3, 1, manifests=manifests) == renamed
+    assert find_file(folder, 'user', 'clientXputs', 3, 1, manifests=manifests) == os.path.abspath(elsewhere)
+    assert list(manifests) == ['3']
+
+    # a file at its fixed path wins over the manifest
+    fixed = write(result_file(folder, 'user', 'replayInfo', 3, 1))
+    assert find_file(folder, 'user', 'replayInfo', 3, 1) == fixed
+
+    # recorded files that are gone are not found, and None removes the entry
+    os.remove(elsewhere)
+    assert find_file(folder, 'user', 'clientXputs', 3, 1) is None
+    record_file(folder, 'user', 'clientXputs', 3, 1, None)
+    with open(manifest_file(folder, 'user', 3)) as f:
+        assert json.load(f).get('clientXputs') == {}
+
+
+def test_rebuild_manifest(tmp_path):
+    folder = str(tmp_path)
+    write(os.path.join(folder, 'user', 'decisions', 'results_user_Client_7_0.json'))
+    renamed = write(os.path.join(folder, 'user', 'decisions', 'results_old_7_1.json'))
+    write(os.path.join(folder, 'user', 'decisions', 'notes.txt'))
+
+    assert rebuild_manifest(folder, 'user') == 2
+    with open(manifest_file(folder, 'user', 7)) as f:
+        assert json.load(f) == {'decisions': {'1': 'results_old_7_1.json'}}
+    assert find_file(folder, 'user', 'decisions', 7, 1) == renamed
+
+
+def test_move_file(tmp_path):
+    source = write(str(tmp_path / 'a' / 'Xput_user_1_0.json'), 'data')
+    (tmp_path / 'b').mkdir()
+    target = move_file(source, str(tmp_path / 'b'))
+    assert target == str(tmp_path / 'b' / 'Xput_user_1_0.json')
+    assert not os.path.exists(source)
+    with open(target) as f:
+        assert f.read() == 'data'
+
+
+def test_move_file_across_file_systems(tmp_path, monkeypatch):
+    source = write(str(tmp_path / 'a' / 'Xput_user_1_0.json'), 'data')
+    (tmp_path / 'b').mkdir()
+    replace = os.replace
+    calls = []
+
+    def cross_device(src, dst):
+        calls.append((src, dst))
+        # only the rename of the source itself crosses file systems
+        if src == source:
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        return replace(src, dst)
+
+    monkeypatch.setattr(result_files.os, 'replace', cross_device)
+    target = move_file(source, str(tmp_path / 'b'))
+
+    assert calls == [(source, target), (target + '.tmp', target)]
+    assert not os.path.exists(source)
+    assert not os.path.exists(target + '.tmp')
+    with open(target) as f:
+        assert f.read() == 'data'
+
+
+def test_move_file_other_errors(tmp_path):
+    source = write(str(tmp_path / 'a' / 'Xput_user_1_0.json'))
+    with pytest.raises(OSError) as e:
+        move_file(source, str(tmp_path / 'missing'))
+    assert e.value.errno == errno.ENOENT
+    assert os.path.exists(source)
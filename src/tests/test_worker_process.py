@@ -0,0 +1,58 @@
+import sys, textwrap
+import gevent
+from worker_process import WorkerProcess
+
+WORKER = textwrap.dedent('''
+    import sys, time
+    sys.path.insert(0, {path!r})
+    from worker_process import serve
+
+    def handle(request):
+        print('noise on stdout goes to stderr')
+        if request.get('sleep'):
+            time.sleep(request['sleep'])
+        if request.get('fail'):
+            raise ValueError('failed')
+        return {{'ok': True, 'echo': request['value']}}
+
+    serve(handle)
+''')
+
+
+def worker(tmp_path, timeout=None):
+    import worker_process, os
+    script = tmp_path / 'worker.py'
+    script.write_text(WORKER.format(path=os.path.dirname(os.path.abspath(worker_process.__file__))))
+    return WorkerProcess([sys.executable, str(script)], 'Test', timeout)
+
+
+def test_requests_and_errors(tmp_path):
+    process = worker(tmp_path)
+    assert process.request({'value': 1}) == {'ok': True, 'echo': 1}
+    assert process.request({'value': 2, 'fail': True}) == {'ok': False, 'error': 'ValueError: failed'}
+    # the same process keeps serving
+    pid = process.process.pid
+    assert process.request({'value': 3}) == {'ok': True, 'echo': 3}
+    assert process.process.pid == pid
+    process.stop()
+    assert process.process is None
+
+
+def test_hung_worker_is_killed_and_restarted(tmp_path):
+    process = worker(tmp_path, timeout=0.5)
+    assert process.request({'value': 1})['ok']
+    pid = process.process.pid
+
+    with gevent.Timeout(10):
+        answer = process.request({'value': 2, 'sleep': 30})
+    assert answer == {'ok': False, 'error': 'Test process timed out after 0.5 seconds'}
+    assert process.process is None
+
+    assert process.request({'value': 3}, timeout=10) == {'ok': True, 'echo': 3}
+    assert process.process.pid != pid
+    process.stop()
+
+
+def test_dead_worker(tmp_path):
+    process = WorkerProcess([sys.executable, '-c', 'pass'], 'Test')
+    assert process.request({'value': 1}) == {'ok': False, 'error': 'Test process died'}
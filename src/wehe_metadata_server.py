@@ -6,29 +6,12 @@ import logging
 import time
 import json
 import sys
-import reverse_geocode
-import subprocess
-from datetime import datetime
-from timezonefinder import TimezoneFinder
-from dateutil import tz
-import netaddr as neta
-from threading import Timer
+from isp_lookup import WhoisCache, getRangeAndOrg
+from geo_lookup import GeoService
 
 logger = logging.getLogger('replay_server')
 
 
-def timedRun(cmd, timeout_sec):
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    timer = Timer(timeout_sec, proc.kill)
-    stdout = ''
-    try:
-        timer.start()
-        stdout, stderr = proc.communicate()
-    finally:
-        timer.cancel()
-    return stdout
-
-
 def createRotatingLog(logger, logFile):
     formatter = logging.Formatter('%(asctime)s--%(name)s--%(levelname)s\t%(message)s', datefmt='%m/%d/%Y--%H:%M:%S')
     handler = logging.handlers.TimedRotatingFileHandler(logFile, backupCount=200, when="midnight")
@@ -78,72 +61,6 @@ def LOG_ACTION(logger, message, level=20, doPrint=True, indent=0, action=True, e
         PRINT_ACTION(message, indent, action=action, exit=exit)
 
 
-def getRangeAndOrg(ip):
-    out = timedRun(['whois', ip], 1)
-    out = out.decode('ascii', 'ignore')
-
-    IPRange = None
-    orgName = None
-    netRange = None
-
-    if 'NetRange:' in out:
-        netRange = out.split('NetRange:')[1].split('\n')[0]
-        netRange = netRange.split()
-        IPRange = neta.IPRange(netRange[0], netRange[2])
-
-
-    # LACNIC/RIPE format
-    elif 'inetnum:' in out:
-        netRange = out.split('inetnum:')[1].split('\n')[0]
-        if '/' in netRange:
-            netRange = netRange.split()[0]
-            IPRange = neta.IPSet(neta.IPNetwork(netRange))
-        else:
-            netRange = netRange.split()
-            IPRange = neta.IPRange(netRange[0], netRange[2])
-
-    # ways to extract ISP name out from the whois result
-    if 'OrgName:' in out:
-        orgName = out.split('OrgName:')[1].split('\n')[0]
-    elif 'Organization:' in out:
-        orgName = out.split('Organization:')[1].split('\n')[0]
-    elif 'owner:' in out:
-        orgName = out.split('owner:')[1].split('\n')[0]
-    elif 'org-name:' in out:
-        orgName = out.split('org-name:')[1].split('\n')[0]
-    elif 'abuse-mailbox:' in out:
-        orgName = out.split('abuse-mailbox:')[1].split('@')[1].split('.')[0]
-    elif 'netname:' in out:
-        orgName = out.split('netname:')[1].split('\n')[0]
-
-    if orgName and netRange:
-        return IPRange, orgName
-    else:
-        return None, None
-
-
-def getLocalTime(utcTime, lon, lat):
-    if (lat == lon == '0.0') or (lat == lon == 0.0) or lat == 'null':
-        return None
-
-    utcTime = datetime.strptime(utcTime, '%Y-%m-%d %H:%M:%S')
-
-    tf = TimezoneFinder()
-    # METHOD 1: from UTC
-    from_zone = tz.gettz('UTC')
-
-    to_zone = tf.timezone_at(lng=lon, lat=lat)
-
-    to_zone = tz.gettz(to_zone)
-
-    utc = utcTime.replace(tzinfo=from_zone)
-
-    # Convert time zone
-    convertedTime = str(utc.astimezone(to_zone))
-
-    return convertedTime
-
-
 def getCurrentResultsFolder(currentResultsFolder):
     if not os.path.exists(currentResultsFolder):
         os.mkdir(currentResultsFolder)
@@ -166,7 +83,8 @@ def getCurrentResultsFolder(currentResultsFolder):
 
 class SideChannel(object):
 
-    def __init__(self, publicIP, sidechannelPort, sidechannelTLSPort, certsFolder, resultsFolder, buff_size=4096):
+    def __init__(self, publicIP, sidechannelPort, sidechannelTLSPort, certsFolder, resultsFolder, whoisCacheFile=None,
+                 buff_size=4096):
         self.logger_q = gevent.queue.Queue()
         self.errorlog_q = gevent.queue.Queue()
         self.publicIP = publicIP
@@ -175,6 +93,8 @@ class SideChannel(object):
         self.pool = gevent.pool.Pool(10000)
         self.resultsFolder = resultsFolder
         self.buff_size = buff_size
+        self.whoisCache = WhoisCache(whoisCacheFile)
+        self.geo = GeoService()
         ssl_options = gevent.ssl.create_default_context(gevent.ssl.Purpose.CLIENT_AUTH)
         if sidechannelTLSPort and certsFolder:
             cert_location = os.path.join(certsFolder, 'server.crt')
@@ -194,6 +114,7 @@ class SideChannel(object):
     def run(self, errorsLog):
 
         gevent.Greenlet.spawn(self.error_logger, errorsLog)
+        gevent.Greenlet.spawn(self.whoisCache.run)
         gevent.Greenlet.spawn(self.run_http)
 
         # not making a separate thread since this loop keeps the main python process running
@@ -240,22 +161,11 @@ class SideChannel(object):
             # 1. reverse geolocate the GPS location, store it as another item in the locationInfo dictionary, the key is 'geoinfo'
             # 2. Truncate GPS locations to only two digits after decimal point
             mobileStats = json.loads(mobileStats)
-            lat = str(mobileStats['locationInfo']['latitude'])
-            lon = str(mobileStats['locationInfo']['longitude'])
-            if lat != '0.0' and lon != '0.0' and lat != 'nil':
-                coordinates = (float(lat), float(lon)), (float(lat), float(lon))
-                geoInfo = reverse_geocode.search(coordinates)[0]
-                lat = float("{0:.1f}".format(float(lat)))
-                lon = float("{0:.1f}".format(float(lon)))
-                mobileStats['locationInfo']['country'] = geoInfo['country']
-                mobileStats['locationInfo']['city'] = geoInfo['city']
-                mobileStats['locationInfo']['localTime'] = getLocalTime(incomingTime, lon, lat)
+            self.geo.update_location(mobileStats['locationInfo'], incomingTime)
             # 1. update the carrierName with network type info
             # 2. get ISP for WiFi connections via whois lookup
             mobileStats['updatedCarrierName'] = self.getCarrierName(mobileStats['carrierName'],
                                                                     mobileStats['networkType'], clientIP)
-            mobileStats['locationInfo']['latitude'] = lat
-            mobileStats['locationInfo']['longitude'] = lon
             mobileStats = json.dumps(mobileStats)
 
             resultsFolder = getCurrentResultsFolder(self.resultsFolder)
@@ -283,7 +193,7 @@ class SideChannel(object):
         # get WiFi network carrierName
         if networkType == 'WIFI':
             try:
-                IPrange, org = getRangeAndOrg(clientIP)
+                org = self.whoisCache.lookup(clientIP, wait=1)
                 if not org:
                     carrierName = ' (WiFi)'
                 else:
@@ -359,11 +269,12 @@ def main():
     sidechannelTLSPort = 55556
     resultsFolder = '/data/RecordReplay/ReplayDumpsTimestamped/'
     certsFolder = './ssl/'
+    whoisCacheFile = '/data/RecordReplay/whoisCache.json'
 
     createRotatingLog(logger, '/data/RecordReplay/logs/serverLog.log')
 
     side_channel = SideChannel(publicIP, sidechannelPort, sidechannelTLSPort, certsFolder,
-                               resultsFolder)
+                               resultsFolder, whoisCacheFile)
 
     side_channel.run('/data/RecordReplay/logs/errorsLog.log')
 
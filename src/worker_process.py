@@ -0,0 +1,133 @@
+'''
+#######################################################################################################
+#######################################################################################################
+
+Copyright 2018 Northeastern University
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Goal: long lived worker processes driven from a gevent loop, one JSON line per request and per answer
+
+Used for the post-processing (postprocess.py), the analyses (analysis_pool.py) and the shared
+packet capture (capture.py):
+    - the worker (serve) reads one request per line on its stdin, and writes one answer per line
+      on its stdout. Anything else it prints goes to stderr, so it cannot break the protocol
+    - the gevent side (WorkerProcess) writes a request and waits for the answer on the pipe, so
+      the loop keeps running. A worker that dies or does not answer within the timeout is killed,
+      and started again for the next request
+Answers are dicts with 'ok' (True or False) and, when it is False, 'error'.
+#######################################################################################################
+#######################################################################################################
+'''
+
+import sys, os, json
+import gevent, gevent.subprocess
+
+
+def answers_stream():
+    '''
+    Returns a file on the worker's original stdout for the answers, and sends stdout to stderr
+    '''
+    results = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    return results
+
+
+def serve(handle, results=None):
+    '''
+    Answers every request read from stdin with handle(request), until stdin is closed.
+    An exception in handle answers {'ok': False, 'error': ...}.
+    '''
+    if results is None:
+        results = answers_stream()
+    for line in sys.stdin:
+        try:
+            answer = handle(json.loads(line))
+        except Exception as e:
+            answer = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+        results.write(json.dumps(answer) + '\n')
+        results.flush()
+
+
+class WorkerProcess(object):
+    '''
+    One worker process running command. With ready=True, the worker writes a line once it is ready
+    (e.g. the capture once tcpdump runs), and start() waits for it.
+    Not safe for concurrent requests, callers serialize them (one greenlet per worker, or a lock).
+    '''
+
+    def __init__(self, command, name='Worker', timeout=None, ready=False):
+        self.command = command
+        self.name = name
+        self.timeout = timeout
+        self.ready = ready
+        self.process = None
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        '''
+        Starts the worker, raises RuntimeError if it exits before it is ready
+        '''
+        self.process = gevent.subprocess.Popen(self.command, stdin=gevent.subprocess.PIPE,
+                                               stdout=gevent.subprocess.PIPE)
+        if self.ready and not self.process.stdout.readline():
+            self.process.wait()
+            self.process = None
+            raise RuntimeError('The {} process did not start'.format(self.name.lower()))
+
+    def request(self, request, timeout=None):
+        '''
+        Returns the worker's answer to request. If the worker cannot be started, dies, or does not
+        answer within timeout (default self.timeout) seconds, it is killed and the answer is
+        {'ok': False, 'error': ...}
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        if not self.running():
+            try:
+                self.start()
+            except (RuntimeError, OSError) as e:
+                return {'ok': False, 'error': str(e)}
+
+        line = b''
+        error = '{} process died'.format(self.name)
+        try:
+            with gevent.Timeout(timeout):
+                self.process.stdin.write((json.dumps(request) + '\n').encode())
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+        except gevent.Timeout:
+            error = '{} process timed out after {} seconds'.format(self.name, timeout)
+        except (OSError, ValueError):
+            pass
+        if not line:
+            self.kill()
+            return {'ok': False, 'error': error}
+        return json.loads(line)
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def stop(self):
+        '''
+        Closes the worker's stdin, which makes serve() return, and waits for it to exit
+        '''
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None